@@ -1,6 +1,12 @@
 # Imports
 from enum import Enum
-from typing import Callable, List
+from typing import Callable, Iterator, List, NamedTuple
+import contextvars
+import re
+import time
+
+from conversation_log import AGENT1, AGENT2, SYSTEM, ConversationLog, other_agent
+from tracing import span
 
 
 class Model:
@@ -10,19 +16,52 @@ class Model:
     def prompt(self, messages: str | List[str]) -> str:
         raise NotImplemetedError
 
+    def stream(self, messages: List[dict]) -> Iterator[str]:
+        # Models that can't stream give the whole response as one chunk
+        yield self.prompt(messages)
+
+    def stream_chunk(self, chunk: str):
+        # Called with each chunk of the other agent's response as it is generated
+        pass
+
+    def stream_end(self,):
+        pass
+
 
 class UserInput(Model):
     def __init__(self,):
         print("Accepting user input")
+        self.shown = 0
+        self.streaming = False
+        self.streams = 0 # Responses streamed since the last prompt
+
+    def stream_chunk(self, chunk):
+        if not self.streaming:
+            self.streaming = True
+            print("Assistant: ", end="")
+        print(chunk, end="", flush=True)
+
+    def stream_end(self,):
+        if self.streaming:
+            print()
+            self.streaming = False
+            self.streams += 1
 
     def prompt(self, messages):
-        for message in messages:
+        # Only print what is new since the last prompt, skipping the responses that were already streamed (the last ones)
+        new = messages[self.shown:]
+        responses = [i for i, message in enumerate(new) if message["role"] == "user"]
+        streamed = set(responses[max(0, len(responses) - self.streams):])
+        for i, message in enumerate(new):
             if message["role"] == "assistant":
                 print(" > %s" % message["content"])
             elif message["role"] == "user":
-                print("Assistant: %s" % message["content"])
+                if i not in streamed:
+                    print("Assistant: %s" % message["content"])
             else:
                 print("System: %s" % message["content"])
+        self.shown = len(messages) + 1
+        self.streams = 0
 
         # print(messages)
         return input("> ")
@@ -41,6 +80,14 @@ class Tool:
     def get_commands(self,) -> List[tuple[str, str, Callable, tuple[str]]]:
         return [("HELP", "Get help using the %s tool" % self.get_name(), lambda x: x, ())]
 
+    def get_max_concurrency(self,) -> int:
+        # How many of this tool's commands from one response can run at the same time
+        return 1
+
+    def get_multiline_commands(self,) -> List[str]:
+        # Commands whose last argument can run over several lines, so generation isn't cut off at the first newline
+        return []
+
     def get_short_description(self,) -> str:
         raise NotImplementedError
 
@@ -50,109 +97,541 @@ class Tool:
     def get_starter_prompt(self,) -> str:
         raise NotImplemetedError
 
+    def get_spec(self,) -> "ToolSpec":
+        # Made from the get_ methods the first time the tool is used, they don't change after that
+        spec = getattr(self, "spec", None)
+        if spec is None:
+            spec = self.spec = ToolSpec(self)
+        return spec
+
     def __call__(self, args: List[str]) -> (ToolUseStatus, str):
+        with span("tool", tool=self.get_name(), command=args[0] if args else None) as s:
+            status, resp = self.dispatch(args)
+            s.set(status=status.name, output_chars=len(resp))
+            return status, resp
+
+    def dispatch(self, args: List[str]) -> (ToolUseStatus, str):
+        spec = self.get_spec()
         cmd = args[0]
-        cmds = {c[0]: c[2] for c in self.get_commands()}
 
         if cmd == "HELP":
-            status = ToolUseStatus.SUCCEEDED
-            s = "Information on using the %s tool:\n\nAvailable commands:\n%s\n\nExamples using the %s tool %s\n\n%s" % (
-                self.get_name(),
-                "\n".join(["%s: %s" % (c[0], c[1]) for c in self.get_commands()]),
-                self.get_name(),
-                self.get_two_examples()[0],
-                self.get_two_examples()[1]
-            )
-            return status, s
-        
-        elif cmd in cmds:
-            try:
-                return cmds[cmd](args[1:])
-            except IndexError:
-                cmds = {c[0]: c[3] for c in self.get_commands()}
-                args = cmds[cmd]
-                return ToolUseStatus.FAILED_REPROMPT, "Not enough arguments were included to run %%%%s %s.  The %s command requires %s as arguments, separated by spaces" % (
-                    self.get_name(), cmd, ", ".join(args)
-                )
+            return ToolUseStatus.SUCCEEDED, spec.get_help()
 
-        else:
+        command = spec.commands.get(cmd)
+        if command is None:
             return ToolUseStatus.FAILED_REPROMPT, "%%%s %s is not a valid %s command.  To view all of the commands, run %%%s HELP" % (
-                self.get_name(), cmd, self.get_name(), self.get_name()
+                spec.name, cmd, spec.name, spec.name
             )
 
+        try:
+            return command[0](args[1:])
+        except IndexError:
+            return ToolUseStatus.FAILED_REPROMPT, command[2]
 
-def main_loop(model1: Model, model2: Model, tools: List[Tool]):
-    model1_messages = []
-    model2_messages = []
 
-    initial_prompt = r"You are a machine learning agent (refered to as the assistant) in a conversation with 2 other agents - the user, who asks you questions, and the system, which can help you respond and instructs you on your responses.  You can interact with the system using a set of tools.  To use a tool, put % before the name of the tool (i.e. %FILE_MANAGER), followed by the command you want the tool to run.  For example, to list the contents of the current directory, you can run the LIST command, which is found in the FILE_MANAGER tool, by responding %FILE_MANAGER LIST.  If you think you should use a tool, DO NOT TELL THE USER that you are running the tool and JUST RESPOND WITH THE COMMAND.  You can ONLY tell the user AFTER running the command"
+class ToolWrapper(Tool):
+    """A tool that hands everything to another tool, subclasses override __call__ to do something around its commands"""
+    def __init__(self, tool: Tool):
+        self.tool = tool
 
-    ava_tools = "The commands avaliable to you are:\n"
-    for tool in tools:
-        ava_tools += " - %%%s: %s\n" % (tool.get_name(), tool.get_short_description())
-        for c in tool.get_commands():
-            ava_tools += "    - %%%s %s: %s\n" % (tool.get_name(), c[0], c[1])
+    def get_name(self,):
+        return self.tool.get_name()
 
-    inital_prompt = {"role": "system", "content": initial_prompt + ava_tools}
-    model1_messages.append(inital_prompt)
-    model2_messages.append(inital_prompt)
+    def get_commands(self,):
+        return self.tool.get_commands()
 
-    tools = {tool.get_name(): tool for tool in tools}
+    def get_max_concurrency(self,):
+        return self.tool.get_max_concurrency()
 
-    # Main loop
-    while True:
-        # Model 1
-        status = ToolUseStatus.PROMPTING
-        while status != ToolUseStatus.FINISHED:
-            resp = model1.prompt(model1_messages)
-            resp_split = resp.split(" ")
-            
-            model1_messages.append({"role": "assistant", "content": resp})
-            model2_messages.append({"role": "user", "content": resp})
-
-            if resp_split[0].startswith(r"%") and resp_split[0][1:] in tools:
-                status, resp = tools[resp_split[0][1:]](resp_split[1:])
-                if status == ToolUseStatus.SUCCEEDED:
-                    resp = {"role": "system", "content": resp + ".  Now, please inform the user of the command you just ran or run another command if you haven't completed their query."}
-                else:
-                    resp = {"role": "system", "content": resp + ".  Please try again before reporting back to the user."}
-                
-                model1_messages.append(resp)
-                model2_messages.append(resp)
+    def get_multiline_commands(self,):
+        return self.tool.get_multiline_commands()
 
-            elif resp_split[0].startswith(r"%"):
-                resp = {"role": "system", "content": "%%%s is not an avaliable tool.  %s" % (resp_split[0], ava_tools)}
-                
-                model1_messages.append(resp)
-                model2_messages.append(resp)
+    def get_short_description(self,):
+        return self.tool.get_short_description()
 
-            else:
-                status = ToolUseStatus.FINISHED
-                
-        # Model 2
-        status = ToolUseStatus.PROMPTING
-        while status != ToolUseStatus.FINISHED:
-            resp = model2.prompt(model2_messages)
-            resp_split = resp.split(" ")
-            
-            model2_messages.append({"role": "assistant", "content": resp})
-            model1_messages.append({"role": "user", "content": resp})
-
-            if resp_split[0].startswith(r"%") and resp_split[0][1:] in tools:
-                status, resp = tools[resp_split[0][1:]](resp_split[1:])
-                if status == ToolUseStatus.SUCCEEDED:
-                    resp = {"role": "system", "content": resp + ".\n\nNow, inform the user of the command you just ran or run another command if you haven't completed their query."}
+    def get_two_examples(self,):
+        return self.tool.get_two_examples()
+
+    def __call__(self, args):
+        return self.tool(args)
+
+    def close(self,):
+        if hasattr(self.tool, "close"):
+            self.tool.close()
+
+
+class ToolSpec:
+    """Everything main_loop needs from a tool, worked out once from its get_ methods
+
+    commands maps each command to its function, its argument names and what to say when arguments are missing.
+    All but the last argument of a command can be put in double quotes to include spaces (i.e.
+    %FILE_MANAGER WRITE "my notes.txt" ...).  The last one is the rest of the command as it was written, unless
+    it is one quoted token (i.e. %FILE_MANAGER READ "my notes.txt") and the command isn't multi-line.
+    """
+    def __init__(self, tool: Tool):
+        self.tool = tool
+        self.name = tool.get_name()
+        self.multiline = frozenset(tool.get_multiline_commands())
+        self.max_concurrency = tool.get_max_concurrency()
+        self.help = None
+
+        commands = tool.get_commands()
+        self.commands = {
+            c[0]: (c[2], tuple(c[3]), "Not enough arguments were included to run %%%s %s.  The %s command requires %s as arguments, separated by spaces" % (
+                self.name, c[0], c[0], ", ".join(c[3])
+            ))
+            for c in commands
+        }
+        self.descriptions = "\n".join(["%s: %s" % (c[0], c[1]) for c in commands])
+        self.listing = " - %%%s: %s\n" % (self.name, tool.get_short_description()) + "".join([
+            "    - %%%s %s: %s\n" % (self.name, c[0], c[1]) for c in commands
+        ])
+
+    def get_help(self,) -> str:
+        # Made on the first HELP, so tools that never get asked don't need examples
+        if self.help is None:
+            ex1, ex2 = self.tool.get_two_examples()
+            self.help = "Information on using the %s tool:\n\nAvailable commands:\n%s\n\nExamples using the %s tool %s\n\n%s" % (
+                self.name, self.descriptions, self.name, ex1, ex2
+            )
+        return self.help
+
+
+class FunctionTool(Tool):
+    """A tool made out of plain functions, so adding one doesn't take a Tool subclass
+
+        weather = FunctionTool("WEATHER", "Look up the weather anywhere")
+
+        @weather.command("FORECAST", "Get the forecast for a city", ("City",))
+        def forecast(args):
+            return "It will be sunny in %s" % " ".join(args)
+
+    Commands return a (ToolUseStatus, str) like any other tool's, or just the string when they succeeded.  Add
+    every command before the tool is used.
+    """
+    def __init__(self, name: str, description: str, examples: tuple[str, str] = ("", ""), max_concurrency: int = 1):
+        self.name = name
+        self.description = description
+        self.examples = tuple(examples)
+        self.max_concurrency = max_concurrency
+        self.commands = []
+        self.multiline = []
+
+    def command(self, name: str, description: str, args: tuple[str] = (), multiline: bool = False):
+        def add(fn):
+            def run(args):
+                resp = fn(args)
+                return resp if type(resp) == tuple else (ToolUseStatus.SUCCEEDED, resp)
+            self.commands.append((name, description, run, tuple(args)))
+            if multiline:
+                self.multiline.append(name)
+            return fn
+        return add
+
+    def get_name(self,):
+        return self.name
+
+    def get_short_description(self,):
+        return self.description
+
+    def get_commands(self,):
+        return self.commands + super().get_commands()
+
+    def get_max_concurrency(self,):
+        return self.max_concurrency
+
+    def get_multiline_commands(self,):
+        return self.multiline
+
+    def get_two_examples(self,):
+        return self.examples
+
+
+INITIAL_PROMPT = r"You are a machine learning agent (refered to as the assistant) in a conversation with 2 other agents - the user, who asks you questions, and the system, which can help you respond and instructs you on your responses.  You can interact with the system using a set of tools.  To use a tool, put % before the name of the tool (i.e. %FILE_MANAGER), followed by the command you want the tool to run.  For example, to list the contents of the current directory, you can run the LIST command, which is found in the FILE_MANAGER tool, by responding %FILE_MANAGER LIST.  If you think you should use a tool, DO NOT TELL THE USER that you are running the tool and JUST RESPOND WITH THE COMMAND.  You can ONLY tell the user AFTER running the command.  If you need to run several commands that don't depend on each other, put each command on its own line and they will all be run at once"
+
+
+class ScriptedModel(Model):
+    """Deterministic stand-in for a real model, answers each prompt with the next response in a script
+
+    token_latency is how many seconds each word of a response takes to "generate", so benchmarks can stand in
+    for a model of a given speed.
+    """
+    def __init__(self, responses: List[str] = (), default: str = None, token_latency: float = 0.0):
+        self.responses = list(responses)
+        self.default = default
+        self.token_latency = token_latency
+        self.i = 0
+
+    def next_response(self, messages):
+        if self.i < len(self.responses):
+            resp = self.responses[self.i]
+            self.i += 1
+            return resp
+        elif self.default is not None:
+            return self.default
+        else:
+            # Echo the last message so the conversation stays deterministic
+            return "You said: %s" % messages[-1]["content"]
+
+    def prompt(self, messages):
+        if type(messages[0]) == dict:
+            resp = self.next_response(messages)
+            if self.token_latency:
+                time.sleep(self.token_latency * len(resp.split()))
+            return resp
+        else:
+            resps = [self.next_response(message) for message in messages]
+            # A batch is generated together, so it takes as long as its longest response
+            if self.token_latency:
+                time.sleep(self.token_latency * max([len(resp.split()) for resp in resps]))
+            return resps
+
+    def stream(self, messages):
+        for token in re.findall(r"\s*\S+", self.next_response(messages)):
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            yield token
+
+
+class ScriptEnded(Exception):
+    pass
+
+
+class ScriptedUser(ScriptedModel):
+    """The user side of a scripted conversation, which ends the conversation by raising ScriptEnded once its script runs out"""
+    def next_response(self, messages):
+        if self.i == len(self.responses):
+            raise ScriptEnded
+        return super().next_response(messages)
+
+
+class Command(NamedTuple):
+    """One %TOOL CMD args command from a response"""
+    text: str # As the model wrote it
+    tool: str
+    args: List[str] # The command's name and then its arguments
+
+
+LEADING_SPACE = re.compile(r"\s*")
+CLOSING_QUOTE = re.compile(r'"(?= |\Z)')
+
+
+class ToolRegistry(dict):
+    """A session's tools by name, along with their ToolSpecs and the tool listing for the system prompt
+
+    Tools can be added at any point with register (or by setting registry[name]), everything about them is
+    worked out then instead of on every response.
+    """
+    def __init__(self, tools: List[Tool] = ()):
+        super().__init__()
+        self.specs = {}
+        self.listing = None
+        for tool in tools:
+            self.register(tool)
+
+    def __setitem__(self, name: str, tool: Tool):
+        super().__setitem__(name, tool)
+        self.specs[name] = tool.get_spec()
+        self.listing = None
+
+    def register(self, tool: Tool) -> Tool:
+        self[tool.get_name()] = tool
+        return tool
+
+    def get_listing(self,) -> str:
+        if self.listing is None:
+            self.listing = "The commands avaliable to you are:\n" + "".join([spec.listing for spec in self.specs.values()])
+        return self.listing
+
+    def get_system_prompt(self,) -> str:
+        return INITIAL_PROMPT + self.get_listing()
+
+    def get_max_concurrency(self, name: str) -> int:
+        spec = self.specs.get(name)
+        return spec.max_concurrency if spec else 1
+
+    def is_multiline(self, line: str) -> bool:
+        parts = line.split(" ", 2)
+        spec = self.specs.get(parts[0][1:])
+        return spec is not None and len(parts) > 1 and parts[1] in spec.multiline
+
+    def parse(self, text: str) -> (List[Command], bool):
+        """The %TOOL commands a response starts with, and whether the model has moved on from writing commands
+
+        Goes through the response once, a line at a time.  The lines after a multi-line command (i.e. the contents
+        of FILE_MANAGER WRITE) are part of it until the next command.  A response that doesn't start with a
+        command has no commands.
+        """
+        pos = LEADING_SPACE.match(text).end()
+        if not text.startswith("%", pos):
+            return [], pos < len(text)
+
+        spans = [] # [start, end] of each command
+        multiline = False
+        while pos <= len(text):
+            if multiline:
+                # Skip straight to the next command, everything before it belongs to this one
+                end = text.find("\n%", pos - 1)
+                spans[-1][1] = end if end != -1 else len(text)
+                if end == -1:
+                    break
+                pos = end + 1
+
+            end = text.find("\n", pos)
+            if end == -1:
+                end = len(text)
+            if text.startswith("%", pos):
+                spans.append([pos, end])
+                multiline = self.is_multiline(text[pos:end])
+            elif len(text[pos:end].strip()) > 0:
+                return [self.split(text[start:end]) for start, end in spans], True
+            pos = end + 1
+        return [self.split(text[start:end]) for start, end in spans], False
+
+    def split(self, text: str) -> Command:
+        """A command's tool and arguments, arguments are separated by single spaces unless they are quoted"""
+        parts = text.split(" ", 2)
+        args = parts[1:2]
+        if len(parts) == 3:
+            rest = parts[2]
+            spec = self.specs.get(parts[0][1:])
+            command = spec.commands.get(parts[1]) if spec else None
+            pos = 0
+            for _ in range(len(command[1]) - 1 if command else 0):
+                if rest.startswith('"', pos):
+                    close = CLOSING_QUOTE.search(rest, pos + 1)
+                    if close:
+                        args.append(rest[pos + 1:close.start()])
+                        pos = close.end() + 1
+                        continue
+                space = rest.find(" ", pos)
+                if space == -1:
+                    break
+                args.append(rest[pos:space])
+                pos = space + 1
+            if pos <= len(rest):
+                last = rest[pos:]
+                # The last argument loses its quotes too if it's one quoted token, unless it's a multi-line command's contents
+                close = CLOSING_QUOTE.search(last, 1) if last.startswith('"') else None
+                if close and close.end() == len(last) and not (spec and parts[1] in spec.multiline):
+                    args.append(last[1:-1])
                 else:
-                    resp = {"role": "system", "content": resp + ".\n\nPlease try again before reporting back to the user."}
-                
-                model1_messages.append(resp)
-                model2_messages.append(resp)
+                    args += last.split(" ")
+        return Command(text, parts[0][1:], args)
 
-            elif resp_split[0].startswith(r"%"):
-                resp = {"role": "system", "content": "%%s is not an avaliable tool.  %s" % (resp_split[0], ava_tools)}
-                
-                model1_messages.append(resp)
-                model2_messages.append(resp)
 
-            else:
-                status = ToolUseStatus.FINISHED
+class CommandWatcher:
+    """Follows a response as it streams in, to tell as soon as the model has moved on from writing commands
+
+    Looks at each line once, when it ends, instead of parsing the whole response again for every chunk.
+    """
+    def __init__(self, tools: ToolRegistry):
+        self.tools = tools
+        self.line_start = None # Start of the line being written, None until the response's first command
+        self.scanned = 0
+        self.multiline = False
+        self.answer = False # The response doesn't start with a command, so it has none
+
+    def feed(self, text: str) -> bool:
+        """Look at what has been added to the response since the last call, returns whether the commands are complete"""
+        if self.answer:
+            return False
+        if self.line_start is None:
+            pos = LEADING_SPACE.match(text).end()
+            if pos == len(text):
+                return False
+            if text[pos] != "%":
+                self.answer = True
+                return False
+            self.line_start = self.scanned = pos
+
+        # The same rules as ToolRegistry.parse, for the lines that ended since the last call
+        end = text.find("\n", self.scanned)
+        while end != -1:
+            line = text[self.line_start:end]
+            if line.startswith("%"):
+                self.multiline = self.tools.is_multiline(line)
+            elif not self.multiline and len(line.strip()) > 0:
+                return True
+            self.line_start = end + 1
+            end = text.find("\n", self.line_start)
+        self.scanned = len(text)
+
+        # The line being written counts as soon as it clearly isn't a command
+        return not self.multiline and not text.startswith("%", self.line_start) and len(text[self.line_start:].strip()) > 0
+
+
+def as_registry(tools: dict) -> ToolRegistry:
+    # For callers that still pass a plain {name: tool} dict
+    return tools if isinstance(tools, ToolRegistry) else ToolRegistry(tools.values())
+
+
+def get_tool_listing(tools: List[Tool]) -> str:
+    return ToolRegistry(tools).get_listing()
+
+
+def parse_commands(text: str, tools: dict) -> (List[Command], bool):
+    """Split a response into its %TOOL commands, and whether the model has moved on from writing commands"""
+    return as_registry(tools).parse(text)
+
+
+def run_command(command: Command, tools: dict) -> (ToolUseStatus, str):
+    tool = tools.get(command.tool)
+    if tool is None:
+        return ToolUseStatus.FAILED_REPROMPT, "%%%s is not an avaliable tool" % command.tool
+
+    try:
+        return tool(command.args)
+    except Exception as e:
+        return ToolUseStatus.FAILED_REPROMPT, "%s did not run because of %s" % (command.text, e)
+
+
+shared_tool_executor = None
+
+
+def get_tool_executor() -> "ThreadPoolExecutor":
+    global shared_tool_executor
+    if shared_tool_executor is None:
+        # Imported here since concurrent.futures (and the logging it imports) is most of the cost of importing this module
+        from concurrent.futures import ThreadPoolExecutor
+        shared_tool_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="command")
+    return shared_tool_executor
+
+
+def run_commands(commands: List[Command], tools: dict, executor: "ThreadPoolExecutor" = None) -> List[tuple[ToolUseStatus, str]]:
+    """Run the commands from one response concurrently, returning their results in the original order
+
+    Each tool gets get_max_concurrency() lanes and a lane runs its commands one after another, so a tool that
+    keeps state (like FILE_MANAGER's current directory) with a limit of 1 sees its commands in order.
+    """
+    if len(commands) == 1:
+        return [run_command(commands[0], tools)]
+
+    tools = as_registry(tools)
+    lanes = {}
+    counts = {}
+    for i, command in enumerate(commands):
+        n = counts.get(command.tool, 0)
+        counts[command.tool] = n + 1
+        lanes.setdefault((command.tool, n % tools.get_max_concurrency(command.tool)), []).append(i)
+
+    results = [None] * len(commands)
+
+    def run_lane(indexes):
+        for i in indexes:
+            results[i] = run_command(commands[i], tools)
+
+    # Each lane runs in a copy of this context, so its tool spans nest under the current turn
+    executor = executor or get_tool_executor()
+    for fut in [executor.submit(contextvars.copy_context().run, run_lane, indexes) for indexes in lanes.values()]:
+        fut.result()
+    return results
+
+
+def handle_response(resp: str, tools: dict, ava_tools: str) -> (ToolUseStatus, dict):
+    """Run the tools a response asks for, returns the status and the system message to add (or None)"""
+    tools = as_registry(tools)
+    commands, _ = tools.parse(resp)
+    if len(commands) == 0:
+        return ToolUseStatus.FINISHED, None
+
+    results = run_commands(commands, tools)
+    unknown = any([command.tool not in tools for command in commands])
+
+    if len(results) == 1:
+        status, resp = results[0]
+    else:
+        status = ToolUseStatus.SUCCEEDED if all([s == ToolUseStatus.SUCCEEDED for s, _ in results]) else ToolUseStatus.FAILED_REPROMPT
+        resp = "The results of the %d commands you ran are:\n\n%s" % (
+            len(results), "\n\n".join(["%d. %s: %s" % (i + 1, command.text, r) for i, (command, (_, r)) in enumerate(zip(commands, results))])
+        )
+
+    if unknown:
+        return ToolUseStatus.FAILED_REPROMPT, {"role": "system", "content": resp + ".  %s" % ava_tools}
+    elif status == ToolUseStatus.SUCCEEDED:
+        return status, {"role": "system", "content": resp + ".  Now, please inform the user of the command you just ran or run another command if you haven't completed their query."}
+    else:
+        return status, {"role": "system", "content": resp + ".  Please try again before reporting back to the user."}
+
+
+def stream_response(model: Model, messages: List[dict], tools: dict, observer: Model = None, metrics: List[dict] = None) -> str:
+    """Stream a response from the model, showing it to the observer as it arrives and stopping once the tool commands are complete"""
+    start = time.perf_counter()
+    first_token = None
+    chunks = 0
+    resp = ""
+    tools = as_registry(tools)
+    watcher = CommandWatcher(tools)
+
+    with span("model", model=type(model).__name__, messages=len(messages)) as s:
+        stream = model.stream(messages)
+        try:
+            for chunk in stream:
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                chunks += 1
+                resp += chunk
+                if observer:
+                    observer.stream_chunk(chunk)
+                if watcher.feed(resp):
+                    commands, done = tools.parse(resp)
+                    if done and len(commands) > 0:
+                        resp = "\n".join([command.text for command in commands])
+                        break
+        finally:
+            # Closing the generator early cancels the rest of the generation
+            stream.close()
+            if observer:
+                observer.stream_end()
+        s.set(chunks=chunks, time_to_first_token_ms=1000 * first_token if first_token is not None else None)
+
+    if metrics is not None:
+        total = time.perf_counter() - start
+        metrics.append({
+            "model": type(model).__name__,
+            "time_to_first_token": first_token,
+            "total_time": total,
+            "chunks": chunks,
+            "tokens_per_sec": chunks / (total - first_token) if first_token is not None and total > first_token else None,
+        })
+
+    return resp.strip()
+
+
+def finish_turn(log: ConversationLog, agent: int, tools: dict, ava_tools: str) -> (ToolUseStatus, int):
+    """Run the commands in the agent's last message and log their results, returns the status and the agent that goes next"""
+    status, resp = handle_response(log.contents[-1], tools, ava_tools)
+    if resp:
+        log.append(SYSTEM, resp["content"])
+    # The agent keeps going until it answers without running a command
+    return status, agent if status != ToolUseStatus.FINISHED else other_agent(agent)
+
+
+def main_loop(model1: Model, model2: Model, tools: List[Tool], metrics: List[dict] = None, log: ConversationLog = None):
+    """Run a conversation between two models, model1 going first
+
+    Both models see the same ConversationLog through their own view.  A log opened on the file of an earlier
+    session carries on where it stopped, only rerunning the commands of a last response whose results weren't saved.
+    """
+    log = log if log is not None else ConversationLog()
+    models = {AGENT1: model1, AGENT2: model2}
+    views = {agent: log.view(agent) for agent in models}
+
+    tools = ToolRegistry(tools)
+    ava_tools = tools.get_listing()
+
+    if len(log) == 0:
+        log.append(SYSTEM, tools.get_system_prompt())
+
+    agent = log.last_agent() or AGENT1
+    if log.authors[-1] == agent:
+        _, agent = finish_turn(log, agent, tools, ava_tools)
+
+    # Main loop
+    while True:
+        with span("turn", profile=True, agent="model%d" % agent) as s:
+            resp = stream_response(models[agent], views[agent], tools, observer=models[other_agent(agent)], metrics=metrics)
+            log.append(agent, resp)
+            status, next_agent = finish_turn(log, agent, tools, ava_tools)
+            s.set(status=status.name)
+        agent = next_agent
@@ -0,0 +1,198 @@
+# Imports
+from typing import Iterator, List
+import argparse
+import asyncio
+import json
+import time
+
+from base_classes import Model, ScriptedModel, Tool, ToolWrapper
+from session_server import ScheduledModel, SessionServer
+
+
+class SessionScript(ScriptedModel):
+    """The user side of an evaluation conversation, says each line of its script in turn and then ends the session with None"""
+    def next_response(self, messages):
+        if self.i == len(self.responses):
+            return None
+        return super().next_response(messages)
+
+
+class TracedTool(ToolWrapper):
+    """Records every command run through a tool, with its status and how long it took"""
+    def __init__(self, tool: Tool, trace: List[dict]):
+        super().__init__(tool)
+        self.trace = trace
+
+    def __call__(self, args):
+        start = time.perf_counter()
+        status, resp = self.tool(args)
+        self.trace.append({
+            "command": "%%%s %s" % (self.get_name(), " ".join(args)),
+            "status": status.name,
+            "time": time.perf_counter() - start,
+            "output_chars": len(resp),
+        })
+        return status, resp
+
+
+def make_tools(names: List[str], summary_model: Model) -> List[Tool]:
+    tools = []
+    for name in names:
+        if name == "FILE_MANAGER":
+            from file_manager import FileManagerTool
+            tools.append(FileManagerTool())
+        elif name == "PYTHON":
+            from python_runner import PythonTool
+            tools.append(PythonTool())
+        elif name == "WIKI":
+            from internet_tools import WikipediaTool
+            tools.append(WikipediaTool(summary_model=summary_model))
+        elif name == "GOOGLE":
+            from internet_tools import GoogleTool
+            tools.append(GoogleTool(summary_model=summary_model))
+        else:
+            raise ValueError("%s is not a tool" % name)
+    return tools
+
+
+def read_scripts(path: str, start: int = 0, end: int = None) -> Iterator[tuple[int, dict]]:
+    """(line number, script) for the lines of a scripts file from start up to end"""
+    with open(path, "r", encoding="utf-8") as f:
+        for n, line in enumerate(f):
+            if end is not None and n >= end:
+                break
+            if n >= start and len(line.strip()) > 0:
+                yield n, json.loads(line)
+
+
+def read_done(path: str) -> set:
+    """Line numbers of the scripts that already have results, cutting off a result that was only partly written"""
+    done = set()
+    try:
+        f = open(path, "rb+")
+    except FileNotFoundError:
+        return done
+
+    with f:
+        good = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                done.add(json.loads(line)["line"])
+            except (ValueError, KeyError):
+                break
+            good += len(line)
+        f.truncate(good)
+    return done
+
+
+def count_lines(path: str) -> int:
+    with open(path, "rb") as f:
+        return sum([chunk.count(b"\n") for chunk in iter(lambda: f.read(1024 * 1024), b"")])
+
+
+class BatchEvaluator:
+    """Runs many scripted conversations at once, with every model turn (and tool summary) batched across them
+
+    Each script is a JSON object with the user's messages in "turns", and optionally an "id", a "max_rounds" and
+    the "tools" to give that conversation.  Results are written to the output as each conversation finishes.
+    """
+    def __init__(self, model: Model, tools: List[str] = ("FILE_MANAGER", "PYTHON", "WIKI", "GOOGLE"), max_sessions: int = 256,
+                 max_batch_size: int = 64, max_wait: float = 0.01, max_rounds: int = None):
+        self.model = model
+        self.tools = list(tools)
+        self.max_sessions = max_sessions
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_rounds = max_rounds
+
+    async def run_one(self, server: SessionServer, n: int, script: dict) -> dict:
+        trace = []
+        metrics = []
+        start = time.perf_counter()
+        record = {"line": n, "id": script.get("id", n)}
+        tools = []
+        try:
+            # Tools summarize with the same model, so their prompts join the batches too
+            tools = [TracedTool(tool, trace) for tool in make_tools(script.get("tools", self.tools), ScheduledModel(server.scheduler))]
+            messages = await server.run_session(
+                SessionScript(script["turns"]),
+                max_rounds=script.get("max_rounds", self.max_rounds),
+                tools=tools,
+                metrics=metrics,
+            )
+            record["messages"] = messages[1:] # Without the initial prompt, which is the same for every conversation
+        except Exception as e:
+            record["error"] = "%s: %s" % (type(e).__name__, e)
+        finally:
+            for tool in tools:
+                tool.close()
+
+        model_times = [m["total_time"] for m in metrics]
+        record["tools"] = trace
+        record["timings"] = {
+            "wall_sec": time.perf_counter() - start,
+            "model_turns": len(model_times),
+            "model_sec": sum(model_times),
+            "tool_calls": len(trace),
+            "tool_sec": sum([t["time"] for t in trace]),
+        }
+        return record
+
+    async def run(self, scripts: Iterator[tuple[int, dict]], output_path: str) -> dict:
+        done = read_done(output_path)
+        todo = ((n, script) for n, script in scripts if n not in done)
+        stats = {"skipped": len(done), "ran": 0, "failed": 0}
+        start = time.perf_counter()
+
+        with open(output_path, "a", encoding="utf-8") as out:
+            async with SessionServer(self.model, lambda: [], max_batch_size=self.max_batch_size, max_wait=self.max_wait) as server:
+                async def worker():
+                    # The workers share one iterator, so each script is only run once
+                    for n, script in todo:
+                        record = await self.run_one(server, n, script)
+                        out.write(json.dumps(record) + "\n")
+                        out.flush()
+                        stats["ran"] += 1
+                        stats["failed"] += "error" in record
+
+                await asyncio.gather(*[worker() for _ in range(self.max_sessions)])
+                stats["batches"] = server.scheduler.num_batches
+                stats["prompts"] = server.scheduler.num_prompts
+
+        stats["wall_sec"] = time.perf_counter() - start
+        return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a JSONL file of scripted user conversations in batches, writing one JSON line of results per conversation")
+    parser.add_argument("scripts", help="JSONL file with one script per line, i.e. {\"id\": \"greeting\", \"turns\": [\"Hello\", \"What is 2 + 2?\"]}")
+    parser.add_argument("output", help="JSONL file to write the results to, rerunning skips the scripts that already have results")
+    parser.add_argument("--start", type=int, default=0, help="First line of the scripts file to run")
+    parser.add_argument("--end", type=int, default=None, help="Line of the scripts file to stop before")
+    parser.add_argument("--shard", default=None, help="i/n to run the i-th of n equal line ranges (counting from 0), instead of --start and --end")
+    parser.add_argument("--tools", default="FILE_MANAGER,PYTHON,WIKI,GOOGLE", help="Comma separated tools to give each conversation")
+    parser.add_argument("--max-sessions", type=int, default=256, help="How many conversations to run at once")
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-rounds", type=int, default=None)
+    parser.add_argument("--stub", action="store_true", help="Answer with a scripted stub instead of loading the model")
+    args = parser.parse_args()
+
+    start, end = args.start, args.end
+    if args.shard:
+        i, n = [int(x) for x in args.shard.split("/")]
+        total = count_lines(args.scripts)
+        start, end = total * i // n, total * (i + 1) // n
+
+    if args.stub:
+        model = ScriptedModel(default="This is a scripted answer.")
+    else:
+        from context_manager import ContextWindow
+        from llama_model import Llama_Model
+        llama_model = Llama_Model()
+        model = ContextWindow(llama_model, count_tokens=llama_model.count_tokens)
+
+    evaluator = BatchEvaluator(model, tools=args.tools.split(","), max_sessions=args.max_sessions, max_batch_size=args.max_batch_size, max_rounds=args.max_rounds)
+    stats = asyncio.run(evaluator.run(read_scripts(args.scripts, start, end), args.output))
+    print(json.dumps(stats))
@@ -0,0 +1,735 @@
+# Imports
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from base_classes import Model, ScriptedModel, ScriptedUser, ScriptEnded, Tool, ToolUseStatus, ToolWrapper, main_loop
+from context_manager import ContextWindow
+from stub_servers import CompletionServer, FixtureServer, make_wiki_page
+
+
+class RenderingModel(Model):
+    """Stub model whose cost grows with the prompt, like rendering and tokenizing the whole history would"""
+    def __init__(self,):
+        self.model = ScriptedModel(default="ok")
+
+    def prompt(self, messages):
+        if type(messages[0]) == dict:
+            "".join(["<%s>%s" % (m["role"], m["content"]) for m in messages]).encode("utf-8")
+        return self.model.prompt(messages)
+
+
+def bench_context_window(turns: int = 150, tool_output_chars: int = 40000):
+    """Per-turn latency of a tool-heavy conversation, with and without a ContextWindow"""
+    results = {}
+    for name, model in [("unbounded", RenderingModel()), ("context_window", ContextWindow(RenderingModel()))]:
+        messages = [{"role": "system", "content": "You are a helpful assistant.  " * 100}]
+        latencies = []
+        for i in range(turns):
+            messages.append({"role": "user", "content": "Question %d" % i})
+            messages.append({"role": "assistant", "content": "%%WIKI GET Topic %d" % i})
+            messages.append({"role": "system", "content": ("Article %d says " % i) + "lorem ipsum " * (tool_output_chars // 12)})
+
+            start = time.perf_counter()
+            messages.append({"role": "assistant", "content": model.prompt(messages)})
+            latencies.append(time.perf_counter() - start)
+
+        results[name] = {
+            "first_10_turns_ms": 1000 * sum(latencies[:10]) / 10,
+            "last_10_turns_ms": 1000 * sum(latencies[-10:]) / 10,
+        }
+    return results
+
+
+def peak_rss_mb() -> float:
+    # VmHWM starts over in a new process, ru_maxrss carries over from the parent through fork and exec on Linux
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_corpus(corpus_dir: str = None, n: int = 20):
+    if corpus_dir is None:
+        return [make_wiki_page(i) for i in range(n)]
+    pages = []
+    for name in sorted(os.listdir(corpus_dir)):
+        with open(os.path.join(corpus_dir, name), "r", errors="ignore") as f:
+            pages.append(f.read())
+    return pages
+
+
+def run_extraction(path: str, corpus_dir: str = None):
+    from bs4 import BeautifulSoup
+    from internet_tools import extract_sections
+
+    pages = load_corpus(corpus_dir)
+    total_bytes = sum([len(page) for page in pages])
+    base_rss = peak_rss_mb()
+
+    start = time.perf_counter()
+    for page in pages:
+        if path == "beautifulsoup":
+            container = BeautifulSoup(page).find_all("div", {"class": "mw-page-container-inner"})[0]
+            [tag.get_text() for tag in container.find_all(["h2", "p"])]
+        else:
+            extract_sections(page, "div", container_class="mw-page-container-inner")
+    elapsed = time.perf_counter() - start
+
+    return {
+        "pages_per_sec": len(pages) / elapsed,
+        "mb_per_sec": total_bytes / elapsed / 1e6,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_rss_growth_mb": peak_rss_mb() - base_rss,
+    }
+
+
+def bench_html_extraction(corpus_dir: str = None):
+    """Throughput and peak RSS of the BeautifulSoup tree path against the streaming extractor, each in a fresh process"""
+    results = {}
+    for path in ["beautifulsoup", "streaming"]:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            results[path] = pool.submit(run_extraction, path, corpus_dir).result()
+    return results
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def bench_python_tool(calls: int = 1000, cold_calls: int = 20):
+    """Calls/sec and latency of PythonTool on the warm worker pool, against starting an interpreter per call"""
+    from python_runner import PythonTool, PythonWorkerPool
+
+    pool = PythonWorkerPool(n_workers=2)
+    tool = PythonTool(pool=pool)
+    tool.run(["x = 3"])
+
+    latencies = []
+    for i in range(calls):
+        start = time.perf_counter()
+        tool.run(["x * %d" % i])
+        latencies.append(time.perf_counter() - start)
+    pool.close()
+
+    cold = []
+    for i in range(cold_calls):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "print(3 * %d)" % i], capture_output=True)
+        cold.append(time.perf_counter() - start)
+
+    return {
+        "warm_pool": {"calls_per_sec": calls / sum(latencies), "p50_ms": 1000 * percentile(latencies, 0.5), "p99_ms": 1000 * percentile(latencies, 0.99)},
+        "subprocess_per_call": {"calls_per_sec": cold_calls / sum(cold), "p50_ms": 1000 * percentile(cold, 0.5), "p99_ms": 1000 * percentile(cold, 0.99)},
+    }
+
+
+def make_tree(root: str, n_files: int, files_per_dir: int = 100, seed: int = 0):
+    rng = random.Random(seed)
+    vocab = ["word%d" % i for i in range(5000)]
+    paths = []
+    for i in range(n_files):
+        d = os.path.join(root, "dir%d" % (i // (files_per_dir * files_per_dir)), "sub%d" % (i // files_per_dir))
+        if i % files_per_dir == 0:
+            os.makedirs(d, exist_ok=True)
+        path = os.path.join(d, "file%d.txt" % i)
+        with open(path, "w") as f:
+            for _ in range(5):
+                f.write(" ".join(rng.choices(vocab, k=10)) + "\n")
+        paths.append(path)
+    return paths
+
+
+def bench_file_index(n_files: int = 100000, queries: int = 50, touch_fraction: float = 0.01):
+    """Initial build, query latency (with and without the check for changed files) and the cost of reindexing after touching some of the files"""
+    from file_index import FileIndex
+
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as root:
+        paths = make_tree(root, n_files)
+        index_path = os.path.join(root, ".index.pickle")
+
+        start = time.perf_counter()
+        index = FileIndex(root, index_path=index_path)
+        index.refresh(force=True)
+        build = time.perf_counter() - start
+
+        # Searches in a conversation are seconds apart, so each one normally walks the tree to check for changes first
+        latencies = {}
+        for name, interval in [("query", 0.0), ("query_index_only", 3600.0)]:
+            index.refresh_interval = interval
+            latencies[name] = []
+            for _ in range(queries):
+                query = "word%d word%d" % (rng.randrange(5000), rng.randrange(5000))
+                start = time.perf_counter()
+                index.search(query)
+                latencies[name].append(time.perf_counter() - start)
+
+        for path in rng.sample(paths, int(n_files * touch_fraction)):
+            with open(path, "a") as f:
+                f.write("touched\n")
+
+        start = time.perf_counter()
+        stats = index.refresh(force=True)
+        reindex = time.perf_counter() - start
+
+        start = time.perf_counter()
+        FileIndex(root, index_path=index_path)
+        load = time.perf_counter() - start
+
+    return {
+        "files": n_files,
+        "build_sec": build,
+        "query_p50_ms": 1000 * percentile(latencies["query"], 0.5),
+        "query_p99_ms": 1000 * percentile(latencies["query"], 0.99),
+        "query_index_only_p50_ms": 1000 * percentile(latencies["query_index_only"], 0.5),
+        "query_index_only_p99_ms": 1000 * percentile(latencies["query_index_only"], 0.99),
+        "reindex_sec": reindex,
+        "reindexed_files": stats["updated"],
+        "load_sec": load,
+    }
+
+
+def run_wiki_lookups(dump_path: str, titles: List[str]):
+    from wiki_dump import WikipediaDump
+
+    dump = WikipediaDump(dump_path, cache_pages=0)
+    latencies = []
+    for title in titles:
+        start = time.perf_counter()
+        dump.get_sections(title)
+        latencies.append(time.perf_counter() - start)
+
+    return {
+        "lookup_p50_ms": 1000 * percentile(latencies, 0.5),
+        "lookup_p99_ms": 1000 * percentile(latencies, 0.99),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def bench_wiki_dump(n_pages: int = 20000, lookups: int = 500):
+    """Title lookups in an offline multistream dump, with the page cache off so every lookup decompresses a block"""
+    from wiki_dump import write_multistream, build_index
+
+    rng = random.Random(2)
+    paragraph = "Filler sentence about the topic of the page with [[a link|some links]] and {{a template}}. " * 8
+    pages = [("Page %d" % i, "\n\n".join(["== Section %d ==\n%s" % (j, paragraph) for j in range(6)])) for i in range(n_pages)]
+
+    with tempfile.TemporaryDirectory() as root:
+        dump_path = os.path.join(root, "bench-multistream.xml.bz2")
+        write_multistream(dump_path, pages)
+        del pages
+
+        start = time.perf_counter()
+        build_index(dump_path, dump_path + ".titles", dump_index_path=os.path.join(root, "bench-multistream-index.txt.bz2"))
+        build = time.perf_counter() - start
+
+        titles = ["page %d" % rng.randrange(n_pages) for _ in range(lookups)]
+        # A fresh interpreter so the resident set is only what the lookups need
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            results = pool.submit(run_wiki_lookups, dump_path, titles).result()
+
+    results.update({"pages": n_pages, "index_build_sec": build})
+    return results
+
+
+class Stages:
+    """Wall times of each stage of a benchmark run"""
+    def __init__(self,):
+        self.times = {} # Stage name -> list of seconds
+        self.lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self.lock:
+            self.times.setdefault(stage, []).append(seconds)
+
+    def get_stats(self,) -> dict:
+        return {
+            stage: {"count": len(times), "p50_ms": 1000 * percentile(times, 0.5), "p99_ms": 1000 * percentile(times, 0.99)}
+            for stage, times in sorted(self.times.items())
+        }
+
+
+class TimedModel(Model):
+    def __init__(self, model: Model, stages: Stages, stage: str):
+        self.model = model
+        self.stages = stages
+        self.stage = stage
+
+    def prompt(self, messages):
+        start = time.perf_counter()
+        try:
+            return self.model.prompt(messages)
+        finally:
+            self.stages.add(self.stage, time.perf_counter() - start)
+
+    def stream(self, messages):
+        start = time.perf_counter()
+        try:
+            yield from self.model.stream(messages)
+        finally:
+            self.stages.add(self.stage, time.perf_counter() - start)
+
+    def stream_chunk(self, chunk):
+        self.model.stream_chunk(chunk)
+
+    def stream_end(self,):
+        self.model.stream_end()
+
+
+class TimedTool(ToolWrapper):
+    """Times every command run through a tool, as a stage named after the tool and command (i.e. WIKI GET)"""
+    def __init__(self, tool: Tool, stages: Stages):
+        super().__init__(tool)
+        self.stages = stages
+
+    def __call__(self, args):
+        start = time.perf_counter()
+        try:
+            return self.tool(args)
+        finally:
+            self.stages.add("%s %s" % (self.get_name(), args[0] if args else ""), time.perf_counter() - start)
+
+
+def run_isolated(fn: Callable, *args) -> dict:
+    """Run a benchmark in a fresh interpreter, adding its peak RSS to the results"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_child, fn, *args).result()
+
+
+def run_child(fn: Callable, *args) -> dict:
+    # Anything the tools print goes to stderr, stdout is kept for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        results = fn(*args)
+    results["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+
+def run_main_loop(user: Model, assistant: Model, tools: List[Tool], stages: Stages) -> (float, List[dict]):
+    # Seconds until the user's script ran out, and main_loop's per-response metrics
+    metrics = []
+    start = time.perf_counter()
+    try:
+        main_loop(TimedModel(user, stages, "user"), TimedModel(assistant, stages, "assistant"), [TimedTool(tool, stages) for tool in tools], metrics=metrics)
+    except ScriptEnded:
+        pass
+    return time.perf_counter() - start, metrics
+
+
+def conversation_results(turns: int, elapsed: float, metrics: List[dict], stages: Stages) -> dict:
+    first_tokens = [m["time_to_first_token"] for m in metrics if m["model"] == "TimedModel" and m["time_to_first_token"] is not None]
+    return {
+        "turns": turns,
+        "turns_per_sec": turns / elapsed,
+        "time_to_first_token_p50_ms": 1000 * percentile(first_tokens, 0.5),
+        "time_to_first_token_p99_ms": 1000 * percentile(first_tokens, 0.99),
+        "stages": stages.get_stats(),
+    }
+
+
+def run_conversation(turns: int, token_latency: float, answer_words: int) -> dict:
+    stages = Stages()
+    user = ScriptedUser(["Question %d, can you tell me more about topic %d?" % (i, i) for i in range(turns)], token_latency=token_latency)
+    assistant = ScriptedModel(default=" ".join(["word%d" % i for i in range(answer_words)]), token_latency=token_latency)
+    elapsed, metrics = run_main_loop(user, assistant, [], stages)
+    return conversation_results(2 * turns, elapsed, metrics, stages)
+
+
+def bench_conversation(turns: int = 200, token_latency: float = 0.0, answer_words: int = 60):
+    """Multi-turn main_loop conversation between two scripted models, without tools"""
+    return run_isolated(run_conversation, turns, token_latency, answer_words)
+
+
+def run_tool_session(rounds: int, token_latency: float, fixtures_dir: str) -> dict:
+    from file_manager import FileManagerTool
+    from internet_tools import Fetcher, GoogleTool, SummaryCache, Summarizer, WikipediaTool
+    from python_runner import PythonTool, PythonWorkerPool
+
+    stages = Stages()
+    server = FixtureServer(fixtures_dir)
+    pool = PythonWorkerPool(n_workers=1)
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(os.path.join(root, "files"), 500)
+        fetcher = Fetcher(cache_dir=os.path.join(root, "http"))
+        summary_model = TimedModel(ScriptedModel(default="A short summary of the snippet.", token_latency=token_latency), stages, "summarize")
+
+        wiki = WikipediaTool(fetcher=fetcher, base_url=server.url)
+        google = GoogleTool(fetcher=fetcher, google_url=server.url, scholar_url=server.url)
+        for tool in [wiki, google]:
+            tool.summarizer = Summarizer(summary_model, cache=SummaryCache(cache_dir=None))
+        tools = [wiki, google, PythonTool(pool=pool), FileManagerTool(os.path.join(root, "files"))]
+
+        script = []
+        for i in range(rounds):
+            script += [
+                "%%WIKI GET Topic %d" % i,
+                "%%GOOGLE SEARCH topic %d" % i,
+                "%GOOGLE CLICK 1",
+                "%%GOOGLE SCHOLAR topic %d\n%%PYTHON RUN sum(range(%d))" % (i, i),
+                "%FILE_MANAGER LS",
+                "Topic %d is a topic with a long history, and here is what I found out about it." % i,
+            ]
+        user = ScriptedUser(["What can you find out about topic %d?" % i for i in range(rounds)], token_latency=token_latency)
+        assistant = ScriptedModel(script, token_latency=token_latency)
+        elapsed, metrics = run_main_loop(user, assistant, tools, stages)
+
+        results = conversation_results(rounds + len(script), elapsed, metrics, stages)
+        results["rounds_per_sec"] = rounds / elapsed
+        results["fetcher"] = fetcher.get_stats()
+    pool.close()
+    server.close()
+    return results
+
+
+def bench_tool_session(rounds: int = 20, token_latency: float = 0.0, fixtures_dir: str = None):
+    """main_loop sessions where the assistant uses every tool, against the local fixture server"""
+    return run_isolated(run_tool_session, rounds, token_latency, fixtures_dir)
+
+
+def run_summarization(pages: int, sections: int, token_latency: float, fixtures_dir: str) -> dict:
+    from internet_tools import Fetcher, SummaryCache, Summarizer, extract_sections
+
+    server = FixtureServer(fixtures_dir, wiki_sections=sections)
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        fetcher = Fetcher(cache_dir=os.path.join(root, "http"))
+        summarizer = Summarizer(ScriptedModel(default="A short summary of the snippet.", token_latency=token_latency), cache=SummaryCache(cache_dir=None))
+
+        # The second pass finds every page and summary in the caches
+        for name in ["cold", "warm"]:
+            stages = Stages()
+            start = time.perf_counter()
+            for i in range(pages):
+                t = time.perf_counter()
+                page = fetcher.get("%s/wiki/Page_%d" % (server.url, i))
+                stages.add("fetch", time.perf_counter() - t)
+
+                t = time.perf_counter()
+                page_sections = extract_sections(page, "div", container_class="mw-page-container-inner")
+                stages.add("extract", time.perf_counter() - t)
+
+                t = time.perf_counter()
+                summarizer.summarize_sections(page_sections)
+                stages.add("summarize", time.perf_counter() - t)
+
+            results[name] = {"pages_per_sec": pages / (time.perf_counter() - start), "stages": stages.get_stats()}
+        results["page_bytes"] = len(page)
+        results["summarizer"] = summarizer.get_stats()
+    server.close()
+    return results
+
+
+def bench_summarization(pages: int = 10, sections: int = 60, token_latency: float = 0.0, fixtures_dir: str = None):
+    """Fetching, extracting and map-reduce summarizing large Wikipedia pages, with cold and then warm caches"""
+    return run_isolated(run_summarization, pages, sections, token_latency, fixtures_dir)
+
+
+def run_file_manager(n_files: int, rounds: int, big_file_lines: int) -> dict:
+    from file_index import FileIndex
+    from file_manager import FileManagerTool
+
+    stages = Stages()
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(os.path.join(root, "tree"), n_files)
+        with open(os.path.join(root, "tree", "big.log"), "w") as f:
+            for i in range(big_file_lines):
+                f.write("%d INFO request %d took %d ms\n" % (i, i, i % 997))
+
+        tool = TimedTool(FileManagerTool(os.path.join(root, "tree")), stages)
+        tool.tool.file_index = FileIndex(tool.tool.root, index_path=os.path.join(root, "index.pickle"))
+
+        rng = random.Random(3)
+        for _ in range(rounds):
+            i = rng.randrange(n_files)
+            sub = "dir%d/sub%d" % (i // 10000, i // 100)
+            middle = rng.randrange(big_file_lines)
+            for command in [
+                "LS",
+                "READ big.log %d %d" % (middle, middle + 100),
+                "TAIL big.log",
+                "GREP took\\s9[0-9]{2}\\sms big.log",
+                "SEARCH word%d word%d" % (rng.randrange(5000), rng.randrange(5000)),
+                "CD %s" % sub,
+                "LS",
+                "READ file%d.txt" % i,
+                "HEAD file%d.txt 3" % i,
+                "CD ../..",
+            ]:
+                status, resp = tool(command.split(" "))
+                if status != ToolUseStatus.SUCCEEDED:
+                    raise RuntimeError("%%FILE_MANAGER %s failed: %s" % (command, resp))
+
+    return {"files": n_files, "stages": stages.get_stats()}
+
+
+def bench_file_manager(n_files: int = 5000, rounds: int = 50, big_file_lines: int = 500000):
+    """Latency of each FileManager command on a generated tree and a large log file"""
+    return run_isolated(run_file_manager, n_files, rounds, big_file_lines)
+
+
+def run_openai_model(conversations: int, answer_words: int, latency: float, token_latency: float) -> dict:
+    from openai_model import OpenAIModel
+
+    server = CompletionServer(answer_words=answer_words, latency=latency, token_latency=token_latency)
+    model = OpenAIModel(base_url=server.url, backoff=0.01)
+    try:
+        batch = [[{"role": "system", "content": "You are a helpful assistant."}, {"role": "user", "content": "Question %d" % i}] for i in range(conversations)]
+        results = {}
+
+        start = time.perf_counter()
+        for messages in batch:
+            model.prompt(messages)
+        results["sequential"] = {"prompts_per_sec": conversations / (time.perf_counter() - start)}
+
+        start = time.perf_counter()
+        model.prompt(batch)
+        results["concurrent"] = {"prompts_per_sec": conversations / (time.perf_counter() - start)}
+
+        first_chunk, total = [], []
+        for _ in range(10):
+            start = time.perf_counter()
+            for i, chunk in enumerate(model.stream(batch[0])):
+                if i == 0:
+                    first_chunk.append(time.perf_counter() - start)
+            total.append(time.perf_counter() - start)
+        results["stream"] = {"first_chunk_ms": 1000 * percentile(first_chunk, 0.5), "total_ms": 1000 * percentile(total, 0.5)}
+
+        # Stop reading after a few chunks, the server should notice and stop generating.  Tokens have to take some
+        # time for that, otherwise the whole answer is already sent by the time the stream is closed
+        cancelled = server.get_stats()["cancelled"]
+        server.token_latency = max(token_latency, 0.005)
+        stream = model.stream(batch[0])
+        for _ in range(3):
+            next(stream)
+        stream.close()
+        deadline = time.perf_counter() + 1 + server.token_latency * answer_words
+        while server.get_stats()["cancelled"] == cancelled and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        results["cancel_seen_by_server"] = server.get_stats()["cancelled"] > cancelled
+        server.token_latency = token_latency
+
+        server.fail_next = 2
+        results["answered_after_503s"] = model.prompt(batch[0]) is not None
+
+        results["server"] = server.get_stats()
+        return results
+    finally:
+        model.close()
+        server.close()
+
+
+def bench_openai_model(conversations: int = 32, answer_words: int = 60, latency: float = 0.02, token_latency: float = 0.0):
+    """OpenAIModel against a local stub server: sequential vs concurrent prompts, stream latency, cancellation, retries and connection reuse"""
+    return run_isolated(run_openai_model, conversations, answer_words, latency, token_latency)
+
+
+def bench_tool_dispatch(calls: int = 100000, responses: int = 2000, write_lines: int = 200):
+    """Overhead of getting a command to its function: dispatch, HELP, parsing a response and running all of its commands"""
+    from base_classes import FunctionTool, ToolRegistry, handle_response
+    from file_manager import FileManagerTool
+    from python_runner import PythonTool
+
+    noop = FunctionTool("NOOP", "Does nothing", max_concurrency=4)
+    noop.command("RUN", "Do nothing", ("Anything",))(lambda args: "")
+    noop.command("WRITE", "Do nothing with some lines", ("Name", "contents"), multiline=True)(lambda args: "")
+    tools = ToolRegistry([noop, FileManagerTool(), PythonTool()])
+
+    def rate(fn, n):
+        start = time.perf_counter()
+        for _ in range(n):
+            fn()
+        elapsed = time.perf_counter() - start
+        return {"calls_per_sec": n / elapsed, "us_per_call": 1e6 * elapsed / n}
+
+    args = ["RUN", "a", "b"]
+    response = "%%NOOP RUN a\n%%NOOP WRITE \"out file.txt\" %s\n%%NOOP RUN b\nThat is everything" % "\n".join(["line %d of the file" % i for i in range(write_lines)])
+    single = "%NOOP RUN a b"
+    return {
+        "dispatch": rate(lambda: noop.dispatch(args), calls),
+        "call": rate(lambda: noop(args), calls),
+        "help": rate(lambda: noop(["HELP"]), calls),
+        "parse": rate(lambda: tools.parse(response), responses),
+        "handle_response": rate(lambda: handle_response(single, tools, ""), responses),
+    }
+
+
+STARTUP_MODULES = ["base_classes", "file_manager", "python_runner", "internet_tools", "llama_model"]
+HEAVY_MODULES = ["vllm", "transformers", "torch", "urllib3", "bs4"]
+
+# Set up a session and exit as soon as the user is asked for their first message
+STARTUP_SCRIPT = """
+import os, sys
+sys.path.insert(0, %r)
+from base_classes import Model, ScriptedModel, main_loop
+from file_manager import FileManagerTool
+from internet_tools import GoogleTool, WikipediaTool
+from python_runner import PythonTool
+
+class FirstPrompt(Model):
+    def __init__(self,):
+        pass
+
+    def prompt(self, messages):
+        print("READY", flush=True)
+        os._exit(0)
+
+%s
+main_loop(FirstPrompt(), model, [FileManagerTool(), PythonTool(), WikipediaTool(summary_model=model), GoogleTool()])
+"""
+
+STARTUP_MODELS = {
+    "tool_only": "model = ScriptedModel()",
+    "model_backed": "from context_manager import ContextWindow\nfrom llama_model import Llama_Model\nllama_model = Llama_Model(background=True)\nmodel = ContextWindow(llama_model, count_tokens=llama_model.count_tokens)",
+}
+
+# Time from starting the interpreter to the first prompt, the model loads in the background after that
+STARTUP_TARGETS_MS = {"tool_only": 250, "model_backed": 400}
+
+
+def import_time_ms(module: str) -> float:
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stderr
+    for line in out.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].rstrip() == " %s" % module:
+            return int(parts[1]) / 1000
+    raise RuntimeError("Importing %s failed: %s" % (module, out[-500:]))
+
+
+def bench_startup(repeats: int = 5):
+    """Import time of each module, which heavy dependencies it pulls in, and time to the first prompt with and without the model"""
+    root = os.path.dirname(os.path.abspath(__file__))
+    results = {"import_ms": {}, "heavy_imports": {}, "first_prompt": {}}
+    for module in STARTUP_MODULES:
+        results["import_ms"][module] = percentile([import_time_ms(module) for _ in range(repeats)], 0.5)
+        results["heavy_imports"][module] = subprocess.run(
+            [sys.executable, "-c", "import sys, %s; print(' '.join([m for m in %r if m in sys.modules]))" % (module, HEAVY_MODULES)],
+            capture_output=True, text=True, cwd=root,
+        ).stdout.split()
+
+    for name, model in STARTUP_MODELS.items():
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            process = subprocess.Popen([sys.executable, "-c", STARTUP_SCRIPT % (root, model)], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            if process.stdout.readline().strip() != "READY":
+                raise RuntimeError("The %s session exited before its first prompt" % name)
+            times.append(time.perf_counter() - start)
+            process.wait()
+        first_prompt = 1000 * percentile(times, 0.5)
+        results["first_prompt"][name] = {"first_prompt_ms": first_prompt, "target_ms": STARTUP_TARGETS_MS[name], "meets_target": first_prompt <= STARTUP_TARGETS_MS[name]}
+    return results
+
+
+def flatten(results: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in results.items():
+        if type(value) == dict:
+            flat.update(flatten(value, prefix + key + "."))
+        elif type(value) in [int, float]:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(baseline: dict, results: dict, threshold: float, noise_floor_ms: float = 1.0) -> List[str]:
+    """Metrics that got more than threshold (a fraction) worse than the baseline
+
+    Names ending in per_sec are better when higher, and ones ending in _ms, _sec or _mb are better when lower.
+    Times that stay under noise_floor_ms are too small to compare.
+    """
+    baseline = flatten(baseline)
+    regressions = []
+    for key, value in flatten(results).items():
+        old = baseline.get(key)
+        if old is None or old == 0:
+            continue
+        if key.endswith("per_sec"):
+            change = (old - value) / old
+        elif key.endswith(("_ms", "_sec", "_mb")):
+            floor = noise_floor_ms / 1000 if key.endswith("_sec") else noise_floor_ms
+            if key.endswith(("_ms", "_sec")) and max(old, value) < floor:
+                continue
+            change = (value - old) / old
+        else:
+            continue
+        if change > threshold:
+            regressions.append("%s went from %.4g to %.4g (%.0f%% worse)" % (key, old, value, 100 * change))
+    return regressions
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+BENCHMARKS = {
+    "context_window": bench_context_window,
+    "html_extraction": bench_html_extraction,
+    "python_tool": bench_python_tool,
+    "file_index": bench_file_index,
+    "wiki_dump": bench_wiki_dump,
+    "conversation": bench_conversation,
+    "tool_session": bench_tool_session,
+    "summarization": bench_summarization,
+    "file_manager": bench_file_manager,
+    "openai_model": bench_openai_model,
+    "tool_dispatch": bench_tool_dispatch,
+    "startup": bench_startup,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*", default=list(BENCHMARKS), help="Benchmarks to run (default: all)")
+    parser.add_argument("--corpus-dir", default=None, help="Directory of saved HTML pages for html_extraction (default: generated pages)")
+    parser.add_argument("--fixtures-dir", default=None, help="Directory with saved wiki.html, google.html, scholar.html and page.html for the fixture server (default: generated pages)")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Seconds per generated word for the scripted models")
+    parser.add_argument("--output", default=None, help="Also write the results to this file, to compare against later")
+    parser.add_argument("--compare", default=None, help="Results file from an earlier run to check for regressions against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="How much worse (as a fraction) a metric can get before it counts as a regression")
+    args = parser.parse_args()
+
+    kwargs = {
+        "html_extraction": {"corpus_dir": args.corpus_dir},
+        "conversation": {"token_latency": args.token_latency},
+        "tool_session": {"token_latency": args.token_latency, "fixtures_dir": args.fixtures_dir},
+        "summarization": {"token_latency": args.token_latency, "fixtures_dir": args.fixtures_dir},
+        "openai_model": {"token_latency": args.token_latency},
+    }
+    report = {
+        "commit": get_commit(),
+        "python": sys.version.split()[0],
+        "token_latency": args.token_latency,
+        "results": {name: BENCHMARKS[name](**kwargs.get(name, {})) for name in args.names},
+    }
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(baseline.get("results", baseline), report["results"], args.threshold)
+        for regression in regressions:
+            print("REGRESSION: %s" % regression, file=sys.stderr)
+        if len(regressions) > 0:
+            sys.exit(1)
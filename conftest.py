@@ -0,0 +1,22 @@
+# Shared pytest fixtures
+import pytest
+
+from base_classes import FunctionTool, ToolRegistry, ToolUseStatus
+
+
+@pytest.fixture
+def notes():
+    """A registry with one NOTES tool, and the notes it has written"""
+    tool = FunctionTool("NOTES", "Keeps notes", max_concurrency=2)
+    written = {}
+
+    @tool.command("WRITE", "Write a note", ("Name", "contents"), multiline=True)
+    def write(args):
+        written[args[0]] = " ".join(args[1:])
+        return "Wrote %s" % args[0]
+
+    @tool.command("GET", "Read a note", ("Name",))
+    def get(args):
+        return ToolUseStatus.SUCCEEDED, written[args[0]]
+
+    return ToolRegistry([tool]), written
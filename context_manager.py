@@ -0,0 +1,133 @@
+# Imports
+from collections import OrderedDict
+from typing import Callable, List
+
+from base_classes import Model
+
+
+def approx_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+class ContextWindow(Model):
+    """Sits between main_loop and a Model, keeping each conversation inside a token budget
+
+    The system prompt and the most recent messages are passed through verbatim, older tool outputs are
+    compacted (summarized by summary_model if one is given, otherwise truncated) and if that still isn't
+    enough the oldest messages are dropped.  Subclass and override compact to change how messages shrink.
+    """
+    def __init__(self, model: Model, budget: int = 6144, keep_recent: int = 6, count_tokens: Callable[[str], int] = approx_tokens,
+                 compact_tokens: int = 256, summary_model: Model = None, cache_size: int = 4096):
+        self.model = model
+        self.budget = budget
+        self.keep_recent = keep_recent
+        self.count_tokens = count_tokens
+        self.compact_tokens = compact_tokens
+        self.summarizer = summary_model
+        self.cache_size = cache_size
+
+        self.token_counts = OrderedDict() # Message content -> token count
+        self.compacted = OrderedDict() # Message content -> compacted message content
+        self.conversations = OrderedDict() # id of a message list -> ConversationState
+
+    def count(self, content: str) -> int:
+        # Strings cache their own hash, so this lookup doesn't rescan the content
+        n = self.token_counts.get(content)
+        if n is None:
+            n = self.count_tokens(content)
+            self.token_counts[content] = n
+            if len(self.token_counts) > self.cache_size:
+                self.token_counts.popitem(last=False)
+        return n
+
+    def compact(self, message: dict) -> dict:
+        # Only tool output (system messages) gets compacted, the conversation itself is kept as is
+        if message["role"] != "system" or self.count(message["content"]) <= self.compact_tokens:
+            return message
+
+        content = message["content"]
+        if content not in self.compacted:
+            if self.summarizer:
+                short = self.summarizer.prompt([
+                    {
+                        "role": "system",
+                        "content": "You are a summarization model that shortens the output of tools an assistant has used.  My next message will be the tool output.  Please summarize it in a few sentences, while keeping essential information including dates, names, numbers and file names.  Do not preface your summary or mention that you are summarizing."
+                    },
+                    {
+                        "role": "system",
+                        "content": "The tool output says %s" % content
+                    },
+                ])
+            else:
+                keep = len(content) * self.compact_tokens // self.count(content)
+                short = "%s... [%d tokens of earlier tool output truncated]" % (content[:keep], self.count(content) - self.compact_tokens)
+
+            self.compacted[content] = short
+            if len(self.compacted) > self.cache_size:
+                self.compacted.popitem(last=False)
+
+        return {"role": message["role"], "content": self.compacted[content]}
+
+    def fit(self, messages: List[dict]) -> List[dict]:
+        state = self.conversations.get(id(messages))
+        if state is None or not state.matches(messages):
+            state = ConversationState()
+            self.conversations[id(messages)] = state
+            if len(self.conversations) > self.cache_size:
+                self.conversations.popitem(last=False)
+
+        # Move the messages that fell out of the recent window into the compacted part
+        recent_start = max(1, len(messages) - self.keep_recent)
+        while state.n_old < recent_start - 1:
+            message = self.compact(messages[1 + state.n_old])
+            state.old.append(message)
+            state.old_counts.append(self.count(message["content"]))
+            state.old_tokens += state.old_counts[-1]
+            state.n_old += 1
+        state.last = messages[-1]["content"]
+        state.length = len(messages)
+
+        recent_tokens = sum([self.count(m["content"]) for m in messages[recent_start:]])
+        fixed_tokens = self.count(messages[0]["content"]) + recent_tokens
+
+        # Drop the oldest compacted messages until the whole conversation fits
+        while state.start < len(state.old) and fixed_tokens + state.old_tokens > self.budget:
+            state.old_tokens -= state.old_counts[state.start]
+            state.start += 1
+
+        recent = messages[recent_start:]
+
+        # If the recent messages alone are too big, compact their tool outputs too (except the newest message)
+        for i in range(len(recent) - 1):
+            if fixed_tokens <= self.budget:
+                break
+            message = self.compact(recent[i])
+            fixed_tokens -= self.count(recent[i]["content"]) - self.count(message["content"])
+            recent[i] = message
+
+        return messages[:1] + state.old[state.start:] + recent
+
+    def prompt(self, messages):
+        if type(messages[0]) == dict:
+            return self.model.prompt(self.fit(messages))
+        else:
+            return self.model.prompt([self.fit(message) for message in messages])
+
+    def stream(self, messages):
+        return self.model.stream(self.fit(messages))
+
+
+class ConversationState:
+    def __init__(self,):
+        self.n_old = 0 # Messages after the system prompt that have been compacted
+        self.old = []
+        self.old_counts = []
+        self.old_tokens = 0
+        self.start = 0 # First compacted message still inside the budget
+        self.length = 0
+        self.last = None
+
+    def matches(self, messages):
+        # The same list (or conversation log view) is passed every turn and only ever appended to.  Views make new
+        # message dicts on every read, but the content strings are the same objects
+        return len(messages) >= self.length and (self.length == 0 or messages[self.length - 1]["content"] is self.last)
@@ -0,0 +1,119 @@
+from typing import List
+import json
+import os
+
+
+# Who wrote a message, the role each agent sees it under depends on which agent is looking
+SYSTEM = 0
+AGENT1 = 1
+AGENT2 = 2
+
+ROLES = {
+    AGENT1: ("system", "assistant", "user"),
+    AGENT2: ("system", "user", "assistant"),
+}
+
+
+def other_agent(agent: int) -> int:
+    return AGENT2 if agent == AGENT1 else AGENT1
+
+
+class ConversationLog:
+    """Append-only record of a conversation between two agents and the system, shared by both agents
+
+    Each message is stored once, as its author (in a bytearray) and its content.  view() gives one agent's side of
+    the conversation as a list of message dicts.  With a path, every message is appended to that file as it is
+    logged, and a log opened on an existing file picks up where that conversation stopped.
+    """
+    def __init__(self, path: str = None, sync: bool = False):
+        self.authors = bytearray()
+        self.contents = []
+        self.path = path
+        self.sync = sync
+        self.file = None
+
+        if path:
+            self.load()
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.file = open(path, "a", encoding="utf-8")
+
+    def load(self,):
+        try:
+            f = open(self.path, "rb+")
+        except FileNotFoundError:
+            return
+
+        with f:
+            good = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    author, content = json.loads(line)
+                except ValueError:
+                    break
+                self.authors.append(author)
+                self.contents.append(content)
+                good += len(line)
+
+            # A crash can leave half a line at the end, cut it off so new messages start on a line of their own
+            f.truncate(good)
+
+    def __len__(self,):
+        return len(self.contents)
+
+    def append(self, author: int, content: str):
+        self.authors.append(author)
+        self.contents.append(content)
+        if self.file:
+            self.file.write(json.dumps([author, content]) + "\n")
+            self.file.flush()
+            if self.sync:
+                os.fsync(self.file.fileno())
+
+    def last_agent(self,) -> int:
+        """The agent who wrote the most recent non-system message, or None"""
+        for i in range(len(self.authors) - 1, -1, -1):
+            if self.authors[i] != SYSTEM:
+                return self.authors[i]
+        return None
+
+    def view(self, agent: int) -> "ConversationView":
+        return ConversationView(self, agent)
+
+    def close(self,):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class ConversationView:
+    """One agent's side of a ConversationLog, the agent's own messages are the assistant's and the other agent's are the user's
+
+    Message dicts are made as they are read, so the log is never copied.
+    """
+    def __init__(self, log: ConversationLog, agent: int):
+        self.log = log
+        self.roles = ROLES[agent]
+
+    def message(self, i: int) -> dict:
+        return {"role": self.roles[self.log.authors[i]], "content": self.log.contents[i]}
+
+    def __len__(self,):
+        return len(self.log.contents)
+
+    def __getitem__(self, i):
+        if type(i) == slice:
+            return [self.message(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("message index out of range")
+        return self.message(i)
+
+    def __iter__(self,):
+        for i in range(len(self)):
+            yield self.message(i)
+
+    def to_list(self,) -> List[dict]:
+        return self[:]
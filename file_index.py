@@ -0,0 +1,203 @@
+from array import array
+from typing import List
+import hashlib
+import math
+import os
+import pickle
+import re
+import time
+
+
+TERM_RE = re.compile(r"[a-z0-9_]{2,}")
+
+
+def get_terms(text: str) -> dict:
+    counts = {}
+    for term in TERM_RE.findall(text.lower()):
+        counts[term] = counts.get(term, 0) + 1
+    return counts
+
+
+class FileIndex:
+    """Inverted index of the text files under a directory, kept up to date from their mtimes and sizes
+
+    Postings are append only arrays of (file id, term count) pairs.  A file that changes gets a new id and its
+    old id is marked dead, so an update never has to search through the postings, and the index is compacted
+    once too many of the ids are dead.
+    """
+    VERSION = 1
+
+    def __init__(self, root: str, index_path: str = None, refresh_interval: float = 2.0, max_file_bytes: int = 1024 * 1024):
+        self.root = os.path.realpath(root)
+        self.index_path = index_path or os.path.join(
+            os.path.expanduser("~"), ".cache", "language_model_tooling", "file_index",
+            hashlib.sha256(self.root.encode("utf-8")).hexdigest()[:32] + ".pickle"
+        )
+        self.refresh_interval = refresh_interval
+        self.max_file_bytes = max_file_bytes
+
+        self.files = {} # Path relative to root -> (file id, mtime, size)
+        self.paths = {} # File id -> path relative to root, only for live ids
+        self.postings = {} # Term -> array of file id, count, file id, count...
+        self.next_id = 0
+        self.last_refresh = 0
+
+        self.load()
+
+    def load(self,):
+        try:
+            with open(self.index_path, "rb") as f:
+                data = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return
+        if data.get("version") != self.VERSION or data.get("root") != self.root:
+            return
+
+        self.files = data["files"]
+        self.postings = data["postings"]
+        self.next_id = data["next_id"]
+        self.paths = {fid: path for path, (fid, _, _) in self.files.items()}
+
+    def save(self,):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        with open(self.index_path + ".tmp", "wb") as f:
+            pickle.dump({
+                "version": self.VERSION,
+                "root": self.root,
+                "files": self.files,
+                "postings": self.postings,
+                "next_id": self.next_id,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def walk(self,):
+        # Iterative scandir walk yielding (relative path, stat) for every regular file, skipping hidden entries
+        stack = [self.root]
+        prefix = len(os.path.join(self.root, ""))
+        while stack:
+            path = stack.pop()
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.name.startswith("."):
+                            continue
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                            elif entry.is_file(follow_symlinks=False):
+                                yield entry.path[prefix:], entry.stat(follow_symlinks=False)
+                        except OSError:
+                            pass
+            except OSError:
+                pass
+
+    def read_text(self, rel: str) -> str:
+        try:
+            with open(os.path.join(self.root, rel), "rb") as f:
+                data = f.read(self.max_file_bytes)
+        except OSError:
+            return None
+        # Binary files aren't indexed
+        if b"\0" in data[:1024]:
+            return None
+        return data.decode("utf-8", errors="ignore")
+
+    def add_file(self, rel: str, st):
+        text = self.read_text(rel)
+        fid = self.next_id
+        self.next_id += 1
+        self.files[rel] = (fid, st.st_mtime_ns, st.st_size)
+        self.paths[fid] = rel
+
+        if text:
+            for term, count in get_terms(text).items():
+                postings = self.postings.get(term)
+                if postings is None:
+                    postings = self.postings[term] = array("I")
+                postings.append(fid)
+                postings.append(count)
+
+    def remove_file(self, rel: str):
+        fid, _, _ = self.files.pop(rel)
+        del self.paths[fid]
+
+    def refresh(self, force: bool = False) -> dict:
+        """Reindex the files that were added, changed or removed since the last refresh"""
+        if not force and time.time() - self.last_refresh < self.refresh_interval:
+            return {"added": 0, "updated": 0, "removed": 0}
+
+        stats = {"added": 0, "updated": 0, "removed": 0}
+        seen = set()
+        for rel, st in self.walk():
+            seen.add(rel)
+            old = self.files.get(rel)
+            if old is None:
+                self.add_file(rel, st)
+                stats["added"] += 1
+            elif old[1] != st.st_mtime_ns or old[2] != st.st_size:
+                self.remove_file(rel)
+                self.add_file(rel, st)
+                stats["updated"] += 1
+
+        for rel in [rel for rel in self.files if rel not in seen]:
+            self.remove_file(rel)
+            stats["removed"] += 1
+
+        if stats["added"] or stats["updated"] or stats["removed"]:
+            if self.next_id > 2 * len(self.files) + 1024:
+                self.compact()
+            self.save()
+        self.last_refresh = time.time()
+        return stats
+
+    def compact(self,):
+        # Drop the postings of dead file ids and renumber the live ones
+        new_ids = {fid: i for i, fid in enumerate(sorted(self.paths))}
+        for term in list(self.postings):
+            old = self.postings[term]
+            new = array("I")
+            for i in range(0, len(old), 2):
+                if old[i] in new_ids:
+                    new.append(new_ids[old[i]])
+                    new.append(old[i + 1])
+            if len(new) > 0:
+                self.postings[term] = new
+            else:
+                del self.postings[term]
+
+        self.files = {rel: (new_ids[fid], mtime, size) for rel, (fid, mtime, size) in self.files.items()}
+        self.paths = {fid: rel for rel, (fid, _, _) in self.files.items()}
+        self.next_id = len(self.files)
+
+    def search(self, query: str, limit: int = 10) -> List[tuple[str, float]]:
+        """Files ranked by tf-idf over the query terms"""
+        self.refresh()
+
+        n_files = max(1, len(self.files))
+        scores = {}
+        for term in get_terms(query):
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+
+            live = [(postings[i], postings[i + 1]) for i in range(0, len(postings), 2) if postings[i] in self.paths]
+            if len(live) == 0:
+                continue
+            idf = math.log(1 + n_files / len(live))
+            for fid, count in live:
+                scores[fid] = scores.get(fid, 0) + (1 + math.log(count)) * idf
+
+        best = sorted(scores, key=lambda fid: -scores[fid])[:limit]
+        return [(self.paths[fid], scores[fid]) for fid in best]
+
+    def get_snippets(self, rel: str, query: str, max_snippets: int = 3, max_chars: int = 200) -> List[tuple[int, str]]:
+        terms = list(get_terms(query))
+        text = self.read_text(rel) or ""
+        snippets = []
+        for i, line in enumerate(text.splitlines()):
+            lower = line.lower()
+            if any([term in lower for term in terms]):
+                snippets.append((i + 1, line.strip()[:max_chars]))
+                if len(snippets) == max_snippets:
+                    break
+        return snippets
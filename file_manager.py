@@ -1,13 +1,57 @@
+from bisect import bisect_left
 from typing import List
+import mmap
 import os
+import re
 
 from base_classes import Tool, ToolUseStatus
+from file_index import FileIndex
+
+
+class LineIndex:
+    """Sparse line index of a file, the number of lines before the start of every block_size bytes"""
+    def __init__(self, mm: mmap.mmap, block_size: int):
+        self.block_size = block_size
+        self.block_lines = []
+
+        lines = 0
+        for start in range(0, len(mm), block_size):
+            self.block_lines.append(lines)
+            lines += mm[start:start + block_size].count(b"\n")
+
+        # A last line without a newline still counts
+        self.total_lines = lines + (1 if len(mm) > 0 and mm[-1:] != b"\n" else 0)
+
+    def line_offset(self, mm: mmap.mmap, line: int) -> int:
+        """Byte offset of the start of a line (0-based), found by jumping to its block and scanning from there"""
+        if line <= 0:
+            return 0
+        block = bisect_left(self.block_lines, line) - 1
+        pos = block * self.block_size
+        for _ in range(line - self.block_lines[block]):
+            pos = mm.find(b"\n", pos)
+            if pos == -1:
+                return len(mm)
+            pos += 1
+        return pos
 
 
 class FileManagerTool(Tool):
-    def __init__(self, path="."):
+    def __init__(self, path=".", page_lines: int = 200, page_bytes: int = 16384, max_matches: int = 50, chunk_size: int = 1024 * 1024, index_block_size: int = 65536):
         self.path = path
 
+        # Limits on how much one command puts into the conversation, the model is told how to get the next page
+        self.page_lines = page_lines
+        self.page_bytes = page_bytes
+        self.max_matches = max_matches
+        self.chunk_size = chunk_size
+        self.index_block_size = index_block_size
+        self.line_indexes = {} # Real path -> (mtime, size, LineIndex)
+
+        # Full text index of everything under the starting directory, built on the first SEARCH
+        self.root = os.path.realpath(path)
+        self.file_index = None
+
     def get_name(self,):
         return "FILE_MANAGER"
 
@@ -20,9 +64,78 @@ class FileManagerTool(Tool):
             ("PWD", "Print the current directory's path", self.pwd, ()),
             ("CD", "Change directory", self.cd, ("Relative path to new directory",)),
             ("WRITE", "Write a file", self.write, ("File name", "file contents")),
-            ("READ", "Read a file", self.read, ("File name",)),
+            ("APPEND", "Add to the end of a file, to write a large file in several parts", self.append, ("File name", "contents to add")),
+            ("READ", "Read a file, optionally from one line to another (i.e. READ log.txt 100 200) or by bytes (i.e. READ data.bin BYTES 0 4096)", self.read, ("File name", "[first line or BYTES]", "[last line or first byte]", "[last byte]")),
+            ("HEAD", "Read the first lines of a file", self.head, ("File name", "[number of lines]")),
+            ("TAIL", "Read the last lines of a file", self.tail, ("File name", "[number of lines]")),
+            ("GREP", "Find the lines of a file that match a regular expression", self.grep, ("Pattern", "File name", "[first match to show]")),
+            ("SEARCH", "Search the contents of every file for some words, listing the best matching files", self.search, ("Search terms",)),
         ] + super().get_commands()
 
+    def get_multiline_commands(self,):
+        return ["WRITE", "APPEND"]
+
+    def resolve(self, name: str) -> str:
+        return os.path.join(self.path, os.path.expanduser(name))
+
+    def get_line_index(self, path: str, mm: mmap.mmap) -> LineIndex:
+        # Cached per file until it changes
+        st = os.stat(path)
+        key = os.path.realpath(path)
+        cached = self.line_indexes.get(key)
+        if cached is None or cached[0] != st.st_mtime_ns or cached[1] != st.st_size:
+            cached = (st.st_mtime_ns, st.st_size, LineIndex(mm, self.index_block_size))
+            self.line_indexes[key] = cached
+        return cached[2]
+
+    def open_mmap(self, path: str):
+        f = open(path, "rb")
+        if os.fstat(f.fileno()).st_size == 0:
+            f.close()
+            return None
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        return mm
+
+    def read_lines(self, name: str, first: int, last: int = None) -> (ToolUseStatus, str):
+        """Lines first to last (1-based, inclusive, defaults to the end of the file) of a file, cut down to the page limits"""
+        path = self.resolve(name)
+        mm = self.open_mmap(path)
+        if mm is None:
+            return ToolUseStatus.SUCCEEDED, "The file %s is empty" % name
+
+        with mm:
+            index = self.get_line_index(path, mm)
+            first = max(1, first)
+            if first > index.total_lines:
+                return ToolUseStatus.FAILED_REPROMPT, "The file %s only has %d lines, so it has no line %d" % (name, index.total_lines, first)
+            if last is not None and last < first:
+                return ToolUseStatus.FAILED_REPROMPT, "The last line to read (%d) comes before the first (%d)" % (last, first)
+            requested_last = index.total_lines if last is None else min(last, index.total_lines)
+            last = min(requested_last, first + self.page_lines - 1)
+
+            start = index.line_offset(mm, first - 1)
+            end = index.line_offset(mm, last)
+            long_line = False
+            if end - start > self.page_bytes:
+                # Stop at the last whole line that fits in the page
+                cut = mm.rfind(b"\n", start, start + self.page_bytes)
+                if cut == -1:
+                    end = start + self.page_bytes
+                    long_line = True
+                    last = first
+                else:
+                    end = cut + 1
+                    last = first + mm[start:end].count(b"\n") - 1
+            text = mm[start:end].decode("utf-8", errors="replace")
+
+        s = "The file %s's lines %d to %d (of %d) are: '%s'" % (name, first, last, index.total_lines, text)
+        if long_line:
+            s += "\n[Line %d is too long to show at once.  To read all of it, run %%FILE_MANAGER READ %s BYTES %d %d]" % (first, name, start, start + 2 * self.page_bytes)
+        elif last < requested_last:
+            s += "\n[Output was cut off at line %d.  To keep reading, run %%FILE_MANAGER READ %s %d %d]" % (last, name, last + 1, last + self.page_lines)
+        return ToolUseStatus.SUCCEEDED, s
+
     def list(self, args: List[str]):
         return ToolUseStatus.SUCCEEDED, "These files are in the current directory: '%s'" % ", ".join(os.listdir(self.path))
     
@@ -39,22 +152,210 @@ class FileManagerTool(Tool):
 
     def write(self, args: List[str]):
         try:
-            with open(args[0], "w+") as f:
+            with open(self.resolve(args[0]), "w+") as f:
                 f.write(" ".join(args[1:]))
             return ToolUseStatus.SUCCEEDED, "Successfully wrote to %s" % args[0]
         except IOError as e:
             return ToolUseStatus.FAILED_REPROMPT, "File opening failed because of %s" % e
 
+    def append(self, args: List[str]):
+        try:
+            with open(self.resolve(args[0]), "a") as f:
+                f.write(" ".join(args[1:]))
+            return ToolUseStatus.SUCCEEDED, "Successfully added to %s" % args[0]
+        except IOError as e:
+            return ToolUseStatus.FAILED_REPROMPT, "File opening failed because of %s" % e
+
     def read(self, args: List[str]):
         try:
-            with open(args[0], "r") as f:
-                s = f.read()
-            return ToolUseStatus.SUCCEEDED, "The file %s's contents are: '%s'" % (args[0], s)
+            if len(args) > 1 and args[1].upper() == "BYTES":
+                path = self.resolve(args[0])
+                size = os.path.getsize(path)
+                start = int(args[2]) if len(args) > 2 else 0
+                requested_end = int(args[3]) if len(args) > 3 else size
+                if size == 0:
+                    return ToolUseStatus.SUCCEEDED, "The file %s is empty" % args[0]
+                if start < 0 or start >= size:
+                    return ToolUseStatus.FAILED_REPROMPT, "The file %s has bytes 0 to %d, so it has no byte %d" % (args[0], size, start)
+                if requested_end <= start:
+                    return ToolUseStatus.FAILED_REPROMPT, "The end of the bytes to read (%d) is not after the start (%d)" % (requested_end, start)
+                end = min(requested_end, size, start + self.page_bytes)
+
+                mm = self.open_mmap(path)
+                if mm is None:
+                    return ToolUseStatus.SUCCEEDED, "The file %s is empty" % args[0]
+                with mm:
+                    text = mm[start:end].decode("utf-8", errors="replace")
+
+                s = "The file %s's bytes %d to %d (of %d) are: '%s'" % (args[0], start, end, size, text)
+                if end < min(requested_end, size):
+                    s += "\n[Output was cut off at byte %d.  To keep reading, run %%FILE_MANAGER READ %s BYTES %d %d]" % (end, args[0], end, end + self.page_bytes)
+                return ToolUseStatus.SUCCEEDED, s
+
+            first = int(args[1]) if len(args) > 1 else 1
+            last = int(args[2]) if len(args) > 2 else None
+            return self.read_lines(args[0], first, last)
+        except ValueError as e:
+            return ToolUseStatus.FAILED_REPROMPT, "The line or byte numbers were not valid numbers (%s)" % e
+        except IOError as e:
+            return ToolUseStatus.FAILED_REPROMPT, "File opening failed because of %s" % e
+
+    def head(self, args: List[str]):
+        try:
+            requested = int(args[1]) if len(args) > 1 else 20
+            n = min(requested, self.page_lines)
+            mm = self.open_mmap(self.resolve(args[0]))
+            if mm is None:
+                return ToolUseStatus.SUCCEEDED, "The file %s is empty" % args[0]
+
+            with mm:
+                # Only look as far as a page goes, so the head of a huge file doesn't need the whole file's line index
+                limit = min(len(mm), self.page_bytes)
+                end = 0
+                lines = 0
+                while lines < n and end < limit:
+                    newline = mm.find(b"\n", end, limit)
+                    if newline == -1:
+                        break
+                    end = newline + 1
+                    lines += 1
+                long_line = False
+                if lines < n and end < limit and limit == len(mm):
+                    # The last line of the file has no newline
+                    end = limit
+                    lines += 1
+                elif lines == 0:
+                    end = limit
+                    lines = 1
+                    long_line = True
+                text = mm[:end].decode("utf-8", errors="replace")
+                more = end < len(mm)
+
+            s = "The file %s's lines 1 to %d are: '%s'" % (args[0], lines, text)
+            if long_line:
+                s += "\n[Line 1 is too long to show at once.  To read all of it, run %%FILE_MANAGER READ %s BYTES 0 %d]" % (args[0], 2 * self.page_bytes)
+            elif more and lines < requested:
+                s += "\n[Output was cut off at line %d.  To keep reading, run %%FILE_MANAGER READ %s %d %d]" % (lines, args[0], lines + 1, lines + self.page_lines)
+            return ToolUseStatus.SUCCEEDED, s
+        except ValueError as e:
+            return ToolUseStatus.FAILED_REPROMPT, "The number of lines was not a valid number (%s)" % e
+        except IOError as e:
+            return ToolUseStatus.FAILED_REPROMPT, "File opening failed because of %s" % e
+
+    def tail(self, args: List[str]):
+        try:
+            requested = int(args[1]) if len(args) > 1 else 20
+            n = min(requested, self.page_lines)
+            path = self.resolve(args[0])
+            mm = self.open_mmap(path)
+            if mm is None:
+                return ToolUseStatus.SUCCEEDED, "The file %s is empty" % args[0]
+
+            with mm:
+                # Walk back from the end of the file one newline at a time
+                end = len(mm)
+                start = end - 1 if mm[-1:] == b"\n" else end
+                for _ in range(n):
+                    start = mm.rfind(b"\n", 0, start)
+                    if start == -1:
+                        break
+                start += 1
+
+                cut = start > 0 and requested > n
+                if end - start > self.page_bytes:
+                    # Start on the first whole line that fits in the page
+                    newline = mm.find(b"\n", end - self.page_bytes, end - 1)
+                    start = newline + 1 if newline != -1 else end - self.page_bytes
+                    cut = True
+                text = mm[start:end].decode("utf-8", errors="replace")
+
+            s = "The last lines of the file %s are: '%s'" % (args[0], text)
+            if cut:
+                s += "\n[Output was cut off at byte %d.  To read what comes before it, run %%FILE_MANAGER READ %s BYTES %d %d]" % (start, args[0], max(0, start - self.page_bytes), start)
+            return ToolUseStatus.SUCCEEDED, s
+        except ValueError as e:
+            return ToolUseStatus.FAILED_REPROMPT, "The number of lines was not a valid number (%s)" % e
+        except IOError as e:
+            return ToolUseStatus.FAILED_REPROMPT, "File opening failed because of %s" % e
+
+    def grep(self, args: List[str]):
+        try:
+            pattern = re.compile(args[0].encode("utf-8"), re.MULTILINE)
+            skip = int(args[2]) - 1 if len(args) > 2 else 0
+            mm = self.open_mmap(self.resolve(args[1]))
+            if mm is None:
+                return ToolUseStatus.SUCCEEDED, "The file %s is empty" % args[1]
+
+            matches = []
+            n_matches = 0
+            more = False
+            with mm:
+                # Scan the file a chunk at a time, each chunk ending on a line boundary
+                start = 0
+                line = 1
+                while start < len(mm) and not more:
+                    end = mm.find(b"\n", min(start + self.chunk_size, len(mm)))
+                    end = len(mm) if end == -1 else end + 1
+                    chunk = mm[start:end]
+
+                    counted = 0
+                    pos = 0
+                    while True:
+                        match = pattern.search(chunk, pos)
+                        if match is None:
+                            break
+                        line_start = chunk.rfind(b"\n", 0, match.start()) + 1
+                        line_end = chunk.find(b"\n", line_start)
+                        line_end = len(chunk) if line_end == -1 else line_end
+                        # Each line counts once, and a match that runs onto the next line only counts if the line matches on its own
+                        pos = line_end + 1
+                        if match.end() > line_end and pattern.search(chunk, line_start, line_end) is None:
+                            continue
+                        line += chunk.count(b"\n", counted, line_start)
+                        counted = line_start
+
+                        n_matches += 1
+                        if n_matches <= skip:
+                            continue
+                        if len(matches) == self.max_matches:
+                            more = True
+                            break
+                        matches.append("%d: %s" % (line, chunk[line_start:line_end].decode("utf-8", errors="replace")))
+
+                    line += chunk.count(b"\n", counted)
+                    start = end
+
+            s = "The lines of %s that match %s are:\n%s" % (args[1], args[0], "\n".join(matches)) if matches else "No lines of %s match %s" % (args[1], args[0])
+            if more:
+                s += "\n[Output was cut off after %d matches.  To see more, run %%FILE_MANAGER GREP %s %s %d]" % (len(matches), args[0], args[1], skip + len(matches) + 1)
+            return ToolUseStatus.SUCCEEDED, s
+        except re.error as e:
+            return ToolUseStatus.FAILED_REPROMPT, "%s is not a valid regular expression (%s)" % (args[0], e)
+        except ValueError as e:
+            return ToolUseStatus.FAILED_REPROMPT, "The match number was not a valid number (%s)" % e
         except IOError as e:
             return ToolUseStatus.FAILED_REPROMPT, "File opening failed because of %s" % e
     
+    def search(self, args: List[str]):
+        query = " ".join(args)
+        if len(query.strip()) == 0:
+            raise IndexError
+
+        if self.file_index is None:
+            self.file_index = FileIndex(self.root)
+        results = self.file_index.search(query, limit=self.page_lines // 20)
+        if len(results) == 0:
+            return ToolUseStatus.SUCCEEDED, "No files under %s contain %s" % (self.root, query)
+
+        s = ""
+        for i, (rel, _) in enumerate(results):
+            s += "%d. %s\n" % (i + 1, os.path.join(self.root, rel))
+            for line, snippet in self.file_index.get_snippets(rel, query):
+                s += "    %d: %s\n" % (line, snippet)
+        return ToolUseStatus.SUCCEEDED, "The files that best match %s are:\n%s" % (query, s)
+
     def get_two_examples(self,):
-        ex1 = "user: What files are on my desktop\nassistant: %FILE_MANAGER CD ~/Desktop\nsystem: Changed the current directory to ~/Desktop\nassistant: %FILE_MANAGER LS\nsystem: These files are in the current directory: 'dogs.txt, example.png'\nassistant: The files dogs.txt and example.png are on your desktop\nuser: What is in dogs.txt\nassistant: %FILE_MANAGER READ dogs.txt\nsystem: The file dogs.txt's contents are: 'golden retriever, german shepherd, french bulldog'\nassistant: The dogs.txt file includes the names of three dog breeds"
+        ex1 = "user: What files are on my desktop\nassistant: %FILE_MANAGER CD ~/Desktop\nsystem: Changed the current directory to ~/Desktop\nassistant: %FILE_MANAGER LS\nsystem: These files are in the current directory: 'dogs.txt, example.png'\nassistant: The files dogs.txt and example.png are on your desktop\nuser: What is in dogs.txt\nassistant: %FILE_MANAGER READ dogs.txt\nsystem: The file dogs.txt's lines 1 to 1 (of 1) are: 'golden retriever, german shepherd, french bulldog'\nassistant: The dogs.txt file includes the names of three dog breeds"
 
         ex2 = "user: Can you make a list of where I want to go on vacation?\nassistant: Sure, which destinations did you have in mind?\nuser: I want to go Mexico between Janurary 1st and 4, Germany between March 7th and 12th, and Italy between March 12th and 21st.  Can you save that information with my documents\nassistant: %FILE_MANAGER CD ~/Documents\nsystem: Changed the current directory to ~/Documents\nassistant: %FILEMANAGER WRITE vacations.txt Mexico: 1/1-1/4\nGermany: 3/7-3/12\nItaly: 3/12-3/21\nsystem: Successfully wrote to vacations.txt\nassistant: I noted those destinations in your documents folder"
 
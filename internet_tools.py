@@ -1,71 +1,532 @@
-from typing import List
-import urllib3
-
-from bs4 import BeautifulSoup
-from bs4.element import Tag
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from typing import Callable, List
+import hashlib
+import json
+import os
+import threading
+import time
 
 from base_classes import Tool, ToolUseStatus, Model
+from context_manager import approx_tokens
+from tracing import get_current_span, span
+
+
+HEADERS = {"User-Agent": "Chrome", "Accept-Encoding": "UTF-8"}
+
+
+class Fetcher:
+    """Shared HTTP fetcher with pooled keep-alive connections, retries and an on-disk response cache
+
+    Responses are stored content-addressed (by the hash of the body) under cache_dir/data, with one small
+    metadata file per URL under cache_dir/meta.  Entries older than ttl are revalidated with their ETag or
+    Last-Modified date, and the least recently used entries are evicted once the cache is over max_cache_bytes.
+    """
+    def __init__(self, cache_dir: str = os.path.join(os.path.expanduser("~"), ".cache", "language_model_tooling", "http"),
+                 ttl: float = 24 * 60 * 60, max_cache_bytes: int = 256 * 1024 * 1024, timeout: float = 10.0, retries: int = 3, maxsize: int = 4):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_cache_bytes = max_cache_bytes
+        self.timeout = timeout
+        self.retries = retries
+        self.maxsize = maxsize
+        self.pool = None # Made on the first download, so making a Fetcher doesn't import urllib3
+
+        self.lock = threading.Lock()
+        self.entries = None # URL hash -> metadata, loaded on first use
+        self.refs = {} # Body hash -> number of URLs pointing at it
+        self.cache_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.bytes_fetched = 0
+
+    def get_pool(self,):
+        with self.lock:
+            if self.pool is None:
+                import urllib3
+
+                # PoolManager keeps one keep-alive connection pool per host
+                self.pool = urllib3.PoolManager(
+                    num_pools=32,
+                    maxsize=self.maxsize,
+                    headers=HEADERS,
+                    timeout=urllib3.Timeout(connect=self.timeout, read=self.timeout),
+                    retries=urllib3.Retry(total=self.retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False),
+                )
+            return self.pool
+
+    def get_stats(self,) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "revalidated": self.revalidated, "bytes_fetched": self.bytes_fetched, "cache_bytes": self.cache_bytes}
+
+    def load(self,):
+        self.entries = {}
+        meta_dir = os.path.join(self.cache_dir, "meta")
+        if not os.path.isdir(meta_dir):
+            return
+
+        for name in os.listdir(meta_dir):
+            try:
+                with open(os.path.join(meta_dir, name), "r") as f:
+                    meta = json.load(f)
+            except (IOError, ValueError):
+                continue
+            if not os.path.exists(self.data_path(meta["body"])):
+                continue
+
+            self.entries[name] = meta
+            self.refs[meta["body"]] = self.refs.get(meta["body"], 0) + 1
+            if self.refs[meta["body"]] == 1:
+                self.cache_bytes += meta["size"]
+
+    def data_path(self, body_hash: str) -> str:
+        return os.path.join(self.cache_dir, "data", body_hash[:2], body_hash)
+
+    def read_entry(self, key: str):
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            meta = self.entries.get(key)
+            if meta is None:
+                return None, None
+            meta["used"] = time.time()
 
+        try:
+            with open(self.data_path(meta["body"]), "rb") as f:
+                return meta, f.read()
+        except IOError:
+            return None, None
+
+    def write_entry(self, key: str, url: str, data: bytes, headers):
+        body_hash = hashlib.sha256(data).hexdigest()
+        meta = {
+            "url": url,
+            "body": body_hash,
+            "size": len(data),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "fetched": time.time(),
+            "used": time.time(),
+        }
+
+        path = self.data_path(body_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.makedirs(os.path.join(self.cache_dir, "meta"), exist_ok=True)
+        if not os.path.exists(path):
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        self.write_meta(key, meta)
+
+        with self.lock:
+            # The new body is counted before the old entry is dropped, as a re-download often has the same body
+            self.refs[body_hash] = self.refs.get(body_hash, 0) + 1
+            if self.refs[body_hash] == 1:
+                self.cache_bytes += len(data)
+            self.remove_entry(key, delete_meta=False)
+            self.entries[key] = meta
+            self.evict()
+
+    def write_meta(self, key: str, meta: dict):
+        path = os.path.join(self.cache_dir, "meta", key)
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+
+    def remove_entry(self, key: str, delete_meta: bool = True):
+        # Must be called with the lock held
+        meta = self.entries.pop(key, None)
+        if meta is None:
+            return
+
+        if delete_meta:
+            try:
+                os.remove(os.path.join(self.cache_dir, "meta", key))
+            except OSError:
+                pass
+
+        self.refs[meta["body"]] -= 1
+        if self.refs[meta["body"]] == 0:
+            del self.refs[meta["body"]]
+            self.cache_bytes -= meta["size"]
+            try:
+                os.remove(self.data_path(meta["body"]))
+            except OSError:
+                pass
+
+    def evict(self,):
+        # Must be called with the lock held
+        if self.cache_bytes <= self.max_cache_bytes:
+            return
+        for key in sorted(self.entries, key=lambda k: self.entries[k]["used"]):
+            if self.cache_bytes <= self.max_cache_bytes:
+                break
+            self.remove_entry(key)
+
+    def fetch(self, url: str) -> bytes:
+        with span("fetch", url=url) as s:
+            data, cache = self.fetch_or_revalidate(url)
+            s.set(bytes=len(data), cache=cache)
+            return data
+
+    def fetch_or_revalidate(self, url: str) -> (bytes, str):
+        # The body, and whether it was a cache hit, a revalidated cache entry or a miss
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        meta, data = self.read_entry(key)
+
+        if meta is not None and time.time() - meta["fetched"] < self.ttl:
+            self.hits += 1
+            return data, "hit"
+
+        # Stale entries are revalidated instead of downloaded again
+        headers = {}
+        if meta is not None:
+            if meta["etag"]:
+                headers["If-None-Match"] = meta["etag"]
+            if meta["last_modified"]:
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        resp = self.get_pool().request("GET", url, headers=headers)
+        self.bytes_fetched += len(resp.data)
+
+        if resp.status == 304 and meta is not None:
+            self.revalidated += 1
+            meta["fetched"] = time.time()
+            self.write_meta(key, meta)
+            return data, "revalidated"
+
+        self.misses += 1
+        if resp.status == 200 and "no-store" not in resp.headers.get("Cache-Control", ""):
+            self.write_entry(key, url, resp.data, resp.headers)
+        return resp.data, "miss"
+
+    def get(self, url: str) -> str:
+        return self.fetch(url).decode("utf-8", errors="ignore")
+
+
+shared_fetcher = None
+
+
+def get_fetcher() -> Fetcher:
+    global shared_fetcher
+    if shared_fetcher is None:
+        shared_fetcher = Fetcher()
+    return shared_fetcher
+
+
+
+class SectionExtractor(HTMLParser):
+    """Event based HTML parser that pulls the text out of one container without building a tree
+
+    The container is the first tag with the given name (and class, if one is given).  With sub_header set it
+    collects (header, section text) pairs from the header and <p> tags the same way get_summary does, otherwise
+    it collects all of the text in the container, like Tag.get_text.
+    """
+    SKIP_TAGS = {"script", "style", "template"}
+    BLOCK_TAGS = {"p", "div", "h1", "h2", "h3", "h4", "h5", "h6", "ul", "ol", "table", "section", "blockquote", "pre"}
+
+    def __init__(self, container: str, container_class: str = None, sub_header: str = None):
+        super().__init__(convert_charrefs=True)
+        self.container = container
+        self.container_class = container_class
+        self.sub_header = sub_header
+
+        self.depth = 0 # Nesting of the container tag inside the container, 0 when outside it
+        self.found = False
+        self.done = False
+        self.skip = 0
+        self.capture = None # Header or p tag whose text is being collected
+
+        self.text = []
+        self.sections = [(None, [])]
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+
+        if self.depth == 0:
+            if tag == self.container and (self.container_class is None or self.container_class in (dict(attrs).get("class") or "").split()):
+                self.found = True
+                self.depth = 1
+            return
+
+        if tag == self.container:
+            self.depth += 1
+        if tag in self.SKIP_TAGS:
+            self.skip += 1
+
+        if self.sub_header is not None:
+            # A new block closes an unclosed <p>, like an HTML parser building the tree would
+            if self.capture == "p" and tag in self.BLOCK_TAGS:
+                self.end_capture()
+            if self.capture is None and (tag == "p" or tag == self.sub_header):
+                self.capture = tag
+                self.text = []
+
+    def handle_endtag(self, tag):
+        if self.done or self.depth == 0:
+            return
+
+        if tag == self.capture:
+            self.end_capture()
+        if tag in self.SKIP_TAGS and self.skip > 0:
+            self.skip -= 1
+
+        if tag == self.container:
+            self.depth -= 1
+            if self.depth == 0:
+                if self.capture is not None:
+                    self.end_capture()
+                self.done = True
+
+    def handle_data(self, data):
+        if self.depth > 0 and not self.done and self.skip == 0 and (self.sub_header is None or self.capture is not None):
+            self.text.append(data)
+
+    def end_capture(self,):
+        if self.capture == self.sub_header:
+            self.sections.append(("".join(self.text), []))
+        else:
+            self.sections[-1][1].append("".join(self.text) + "\n")
+        self.capture = None
+        self.text = []
 
-def get_summary(model, page: Tag, sub_header="h2"):
-    tags = page.find_all([sub_header, "p"])
+    def feed_all(self, html: str, chunk_size: int = 65536):
+        for i in range(0, len(html), chunk_size):
+            self.feed(html[i:i + chunk_size])
+            if self.done:
+                break
+        if not self.done:
+            self.close()
+            if self.capture is not None:
+                self.end_capture()
 
-    processed_summary = []
-    prompts = []
-    cur_section = ""
+        if not self.found:
+            raise ValueError("The page has no <%s%s> to read" % (self.container, " class=%s" % self.container_class if self.container_class else ""))
+
+
+def extract_sections(html: str, container: str = "body", container_class: str = None, sub_header: str = "h2") -> List[tuple[str, str]]:
+    with span("parse", chars=len(html)):
+        parser = SectionExtractor(container, container_class=container_class, sub_header=sub_header)
+        parser.feed_all(html)
+        return [(header, "".join(section)) for header, section in parser.sections]
 
-    # Add prompts or headers to summary to be processed
-    for tag in tags:
-        if tag.name == sub_header:
-            if len(cur_section) > 0:
-                processed_summary.append(None)
-                prompts.append([
-                    {
-                        "role": "system",
-                        "content": "You are a summarization model that summarizes parts of webpages that a user has asked about.  My next message will be the page snippet.  Please summarize it so that the user can better understand it, while keeping essential information including dates, names, and other information.  Do not preface your summary or mention that you are summarizing."
-                    },
-                    {
-                        "role": "system",
-                        "content": "The snippet says %s" % cur_section
-                    },
-                ])
-            processed_summary.append(tag.get_text())
-            cur_section = ""
-        else:
-            cur_section += tag.get_text() + "\n"
 
-    if len(cur_section) > 0:
-        processed_summary.append(None)
-        prompts.append([
-            {
-                "role": "system",
-                "content": "You are a summarization model that summarizes parts of webpages that a user has asked about.  My next message will be the page snippet.  Please summarize it so that the user can better understand it, while keeping essential information including dates, names, and other information.  Do not preface your summary or mention that you are summarizing."
-            },
-            {
-                "role": "system",
-                "content": "The snippet says %s" % cur_section
-            },
-        ])
+def extract_text(html: str, container: str = "body", container_class: str = None) -> str:
+    with span("parse", chars=len(html)):
+        parser = SectionExtractor(container, container_class=container_class)
+        parser.feed_all(html)
+        return "".join(parser.text)
 
-    # Run the prompts
-    summarized = model.prompt(prompts)
 
-    # Add prompts back to summary
-    i = 0
-    for j, txt in enumerate(processed_summary):
-        if not txt:
-            processed_summary[j] = summarized[i]
-            print(summarized[i])
-            i += 1
+SUMMARY_PROMPT = "You are a summarization model that summarizes parts of webpages that a user has asked about.  My next message will be the page snippet.  Please summarize it so that the user can better understand it, while keeping essential information including dates, names, and other information.  Do not preface your summary or mention that you are summarizing."
 
-    print(processed_summary)
+REDUCE_PROMPT = "You are a summarization model that combines summaries of consecutive parts of one section of a webpage that a user has asked about.  My next message will be the partial summaries, in order.  Please combine them into one summary, while keeping essential information including dates, names, and other information.  Do not preface your summary or mention that you are summarizing."
+
+
+class SummaryCache:
+    """Summaries keyed by the hash of the prompt and the content, in an LRU backed by files under cache_dir"""
+    def __init__(self, cache_dir: str = os.path.join(os.path.expanduser("~"), ".cache", "language_model_tooling", "summaries"), max_entries: int = 4096):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, prompt: str, content: str) -> str:
+        return hashlib.sha256(prompt.encode("utf-8") + b"\0" + content.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir, key[:2], key), "r") as f:
+                summary = f.read()
+        except IOError:
+            return None
+        self.remember(key, summary)
+        return summary
+
+    def put(self, key: str, summary: str):
+        self.remember(key, summary)
+        if self.cache_dir is None:
+            return
+        path = os.path.join(self.cache_dir, key[:2], key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                f.write(summary)
+            os.replace(path + ".tmp", path)
+        except IOError:
+            pass
+
+    def remember(self, key: str, summary: str):
+        with self.lock:
+            self.entries[key] = summary
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+shared_summary_cache = None
+
+
+def get_summary_cache() -> SummaryCache:
+    global shared_summary_cache
+    if shared_summary_cache is None:
+        shared_summary_cache = SummaryCache()
+    return shared_summary_cache
+
+
+class Summarizer:
+    """Map-reduce summarization of page sections
+
+    Sections are split into chunks of at most chunk_tokens, the chunks that aren't cached are sorted by length
+    and summarized in batches of batch_size, and sections that needed several chunks get a reduce pass that
+    combines the chunk summaries.  Every summary is cached by the hash of its prompt and content.
+    """
+    def __init__(self, model: Model, chunk_tokens: int = 1536, batch_size: int = 16, count_tokens: Callable[[str], int] = approx_tokens, cache: SummaryCache = None):
+        self.model = model
+        self.chunk_tokens = chunk_tokens
+        self.batch_size = batch_size
+        self.count_tokens = count_tokens
+        self.cache = cache or get_summary_cache()
+
+        self.chunks_summarized = 0
+        self.chunks_cached = 0
+
+    def get_stats(self,) -> dict:
+        return {"chunks_summarized": self.chunks_summarized, "chunks_cached": self.chunks_cached}
+
+    def split(self, text: str) -> List[str]:
+        if self.count_tokens(text) <= self.chunk_tokens:
+            return [text]
+
+        # Pack whole lines (paragraphs) into chunks, cutting up any line that is too big on its own
+        chunks = []
+        cur, cur_tokens = "", 0
+        for line in text.splitlines(keepends=True):
+            n = self.count_tokens(line)
+            if n > self.chunk_tokens:
+                step = max(1, len(line) * self.chunk_tokens // n)
+                pieces = [line[i:i + step] for i in range(0, len(line), step)]
+            else:
+                pieces = [line]
+
+            for piece in pieces:
+                n = self.count_tokens(piece)
+                if cur_tokens + n > self.chunk_tokens and len(cur) > 0:
+                    chunks.append(cur)
+                    cur, cur_tokens = "", 0
+                cur += piece
+                cur_tokens += n
+        if len(cur) > 0:
+            chunks.append(cur)
+        return chunks
+
+    def run(self, prompt: str, contents: List[str]) -> List[str]:
+        results = [None] * len(contents)
+        todo = {} # Cache key -> (content, indexes waiting on it), so repeated content is only summarized once
+
+        for i, content in enumerate(contents):
+            key = self.cache.key(prompt, content)
+            summary = self.cache.get(key)
+            if summary is not None:
+                self.chunks_cached += 1
+                results[i] = summary
+            else:
+                todo.setdefault(key, (content, []))[1].append(i)
+
+        # Similar lengths go in the same batch so one long chunk doesn't hold up a batch of short ones
+        keys = sorted(todo, key=lambda k: len(todo[k][0]))
+        for b in range(0, len(keys), self.batch_size):
+            batch = keys[b:b + self.batch_size]
+            with span("summarize.batch", size=len(batch), prompt_tokens=sum([self.count_tokens(todo[key][0]) for key in batch])) as s:
+                summarized = self.model.prompt([
+                    [
+                        {"role": "system", "content": prompt},
+                        {"role": "system", "content": "The snippet says %s" % todo[key][0]},
+                    ]
+                    for key in batch
+                ])
+                s.set(completion_tokens=sum([self.count_tokens(summary) for summary in summarized]))
+
+            for key, summary in zip(batch, summarized):
+                self.chunks_summarized += 1
+                self.cache.put(key, summary)
+                for i in todo[key][1]:
+                    results[i] = summary
+
+        return results
+
+    def summarize_sections(self, sections: List[tuple[str, str]]) -> str:
+        with span("summarize", sections=len(sections)) as s:
+            summarized, cached = self.chunks_summarized, self.chunks_cached
+            summary = self.map_reduce(sections)
+            s.set(chunks_summarized=self.chunks_summarized - summarized, chunks_cached=self.chunks_cached - cached, chars=len(summary))
+            return summary
+
+    def map_reduce(self, sections: List[tuple[str, str]]) -> str:
+        # Map: summarize every chunk of every section
+        chunks = [self.split(section) if len(section) > 0 else [] for _, section in sections]
+        flat = self.run(SUMMARY_PROMPT, [chunk for section in chunks for chunk in section])
+
+        parts = []
+        i = 0
+        for section in chunks:
+            parts.append(flat[i:i + len(section)])
+            i += len(section)
+
+        # Reduce: combine the chunk summaries of each section until there is one summary per section
+        while any([len(p) > 1 for p in parts]):
+            groups = [self.split("\n".join(p)) if len(p) > 1 else None for p in parts]
+            # Summaries that aren't getting any shorter are combined in one go so this always finishes
+            groups = [["\n".join(p)] if g is not None and len(g) >= len(p) else g for g, p in zip(groups, parts)]
+            combined = self.run(REDUCE_PROMPT, [group for g in groups if g is not None for group in g])
+            i = 0
+            for j, g in enumerate(groups):
+                if g is not None:
+                    parts[j] = combined[i:i + len(g)]
+                    i += len(g)
+
+        processed_summary = []
+        for (header, _), p in zip(sections, parts):
+            if header is not None:
+                processed_summary.append(header)
+            processed_summary += p
+
+        return "\n".join(processed_summary)
+
+
+def summarize_sections(model, sections: List[tuple[str, str]]) -> str:
+    return Summarizer(model).summarize_sections(sections)
+
+
+def get_summary(model, page, sub_header="h2"):
+    # page is a BeautifulSoup Tag
+    sections = [(None, "")]
+    for tag in page.find_all([sub_header, "p"]):
+        if tag.name == sub_header:
+            sections.append((tag.get_text(), ""))
+        else:
+            sections[-1] = (sections[-1][0], sections[-1][1] + tag.get_text() + "\n")
 
-    return "\n".join(processed_summary)
+    return summarize_sections(model, sections)
 
 
 class WikipediaTool(Tool):
-    def __init__(self, summary_model:Model=None):
-        self.summarizer = summary_model
+    def __init__(self, summary_model:Model=None, fetcher:Fetcher=None, dump=None, base_url:str="https://en.wikipedia.org"):
+        self.summarizer = Summarizer(summary_model) if summary_model else None
+        self.fetcher = fetcher or get_fetcher()
+        self.base_url = base_url
+        # A wiki_dump.WikipediaDump to read pages from instead of en.wikipedia.org
+        self.dump = dump
 
     def get_name(self,):
         return "WIKI"
@@ -78,23 +539,28 @@ class WikipediaTool(Tool):
             ("GET", "Download and read a wikipedia article", self.get, ("Article topic",)),
         ] + super().get_commands()
 
+    def get_max_concurrency(self,):
+        # Lookups don't share any state, so several articles can download at once
+        return 4
+
     def get(self, args: List[str]):
         try:
-            # Download page
             query = "_".join(args)
-            req = urllib3.request(
-                "GET",
-                "https://en.wikipedia.org/wiki/%s" % query,
-                headers={"User-Agent": "Chrome", "Accept-Encoding": "UTF-8"}
-            ).data.decode("utf-8", errors="ignore")
+            if self.dump:
+                sections = self.dump.get_sections(query)
+                if self.summarizer:
+                    page = self.summarizer.summarize_sections(sections)
+                else:
+                    page = "".join([(header + "\n" if header else "") + section for header, section in sections])
+                return ToolUseStatus.SUCCEEDED, "The wikipedia page for %s says '%s'" % (query, page)
+
+            # Download page
+            req = self.fetcher.get("%s/wiki/%s" % (self.base_url, query))
 
             if self.summarizer:
-                page = get_summary(
-                    self.summarizer,
-                    BeautifulSoup(req).find_all("div", {"class": "mw-page-container-inner"})[0]
-                )
+                page = self.summarizer.summarize_sections(extract_sections(req, "div", container_class="mw-page-container-inner"))
             else:
-                page = BeautifulSoup(req).find_all("div", {"class": "mw-page-container-inner"})[0].get_text()
+                page = extract_text(req, "div", container_class="mw-page-container-inner")
             
             return ToolUseStatus.SUCCEEDED, "The wikipedia page for %s says '%s'" % (query, page)
         except Exception as e:
@@ -109,9 +575,19 @@ class WikipediaTool(Tool):
 
 
 class GoogleTool(Tool):
-    def __init__(self, summary_model:Model=None):
+    def __init__(self, summary_model:Model=None, fetcher:Fetcher=None, prefetch:int=0, prefetch_workers:int=4,
+                 google_url:str="https://google.com", scholar_url:str="https://scholar.google.com"):
         self.links = []
-        self.summarizer = summary_model
+        self.summarizer = Summarizer(summary_model) if summary_model else None
+        self.fetcher = fetcher or get_fetcher()
+        self.google_url = google_url
+        self.scholar_url = scholar_url
+
+        # Optionally download and parse the top results in the background right after searching
+        self.prefetch = prefetch
+        self.prefetch_pool = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix="prefetch") if prefetch > 0 else None
+        self.prefetched = {} # URL -> future of the parsed page body
+        self.click_latencies = {"hit": [], "miss": []}
 
     def get_name(self,):
         return "GOOGLE"
@@ -130,26 +606,25 @@ class GoogleTool(Tool):
         try:
             # Download page
             query = "_".join(args)
-            req = urllib3.request(
-                "GET",
-                "https://google.com/search?q=%s" % query,
-                headers={"User-Agent": "Chrome", "Accept-Encoding": "UTF-8"}
-            ).data.decode("utf-8", errors="ignore")
+            req = self.fetcher.get("%s/search?q=%s" % (self.google_url, query))
 
-            self.links = []
+            self.set_links([])
             page = ""
             
-            links = BeautifulSoup(req).find_all("a")
+            with span("parse", chars=len(req)):
+                from bs4 import BeautifulSoup
+                links = BeautifulSoup(req).find_all("a")
             for link in links:
                 try:
                     url = "".join(link.attrs["href"].split("=")[1:]).split("&")[0]
-                    print(url)
                     url_only_site = url.split("/")[2]
     
                     self.links.append(url)
                     page += "LINK %d: %s (from %s)\n" % (len(self.links), link.get_text(), url_only_site)
                 except IndexError:
                     pass
+            get_current_span().set(links=len(self.links))
+            self.start_prefetch()
             
             return ToolUseStatus.SUCCEEDED, "The Google Search page for %s says '%s'.  You can call %%GOOGLE CLICK [LINK #] to click on a page" % (query, page)
         except Exception as e:
@@ -159,16 +634,14 @@ class GoogleTool(Tool):
         try:
             # Download page
             query = "_".join(args)
-            req = urllib3.request(
-                "GET",
-                "https://scholar.google.com/scholar?q=%s" % query,
-                headers={"User-Agent": "Chrome", "Accept-Encoding": "UTF-8"}
-            ).data.decode("utf-8", errors="ignore")
+            req = self.fetcher.get("%s/scholar?q=%s" % (self.scholar_url, query))
 
-            self.links = []
+            self.set_links([])
             page = ""
             
-            papers = BeautifulSoup(req).find_all("div", {"class": "gs_or"})
+            with span("parse", chars=len(req)):
+                from bs4 import BeautifulSoup
+                papers = BeautifulSoup(req).find_all("div", {"class": "gs_or"})
 
             for paper in papers:
                 title = paper.find_all("h3")[0]
@@ -176,30 +649,64 @@ class GoogleTool(Tool):
                 self.links.append(title.find_all("a")[0].attrs["href"])
                 
                 page += "LINK #%d: %s\n%s\n\n" % (len(self.links), title.get_text(), desc)
+            self.start_prefetch()
             
             return ToolUseStatus.SUCCEEDED, "The Google Scholar page for %s says '%s'.  You can call %%GOOGLE CLICK [LINK #] to click on a page" % (query, page)
         except Exception as e:
             return ToolUseStatus.FAILED_REPROMPT, "The Google Scholar page was not returned because of %s" % e
 
+    def set_links(self, links: List[str]):
+        # A new search replaces the links, so anything still being prefetched for the old ones is thrown away
+        for fut in self.prefetched.values():
+            fut.cancel()
+        self.prefetched = {}
+        self.links = links
+
+    def start_prefetch(self,):
+        if self.prefetch_pool is None:
+            return
+        for url in self.links[:self.prefetch]:
+            if url not in self.prefetched:
+                self.prefetched[url] = self.prefetch_pool.submit(self.load_page, url)
+
+    def load_page(self, url: str):
+        # Sections to summarize if there is a summarizer, otherwise the page's text
+        if self.summarizer:
+            return extract_sections(self.fetcher.get(url), "body", sub_header="") # No headers, all of the text is one section
+        else:
+            return extract_text(self.fetcher.get(url), "body")
+
+    def get_click_stats(self,) -> dict:
+        stats = {}
+        for kind, latencies in self.click_latencies.items():
+            latencies = sorted(latencies)
+            stats[kind] = {
+                "count": len(latencies),
+                "p50": latencies[len(latencies) // 2] if latencies else None,
+                "max": latencies[-1] if latencies else None,
+            }
+        return stats
+
     def click(self, args: List[str]):
+        start = time.perf_counter()
         try:
-            # Download page
-            req = urllib3.request(
-                "GET",
-                self.links[int(args[0]) - 1],
-                headers={"User-Agent": "Chrome", "Accept-Encoding": "UTF-8"}
-            ).data.decode("utf-8", errors="ignore")
+            url = self.links[int(args[0]) - 1]
 
-            if self.summarizer:
-                page = get_summary(
-                    self.summarizer,
-                    BeautifulSoup(req).find_all("body")[0],
-                    sub_header="asdasdfasdf" # Garbage that isn't a real HTML tag
-                )
+            # Serve the page from the prefetch cache if it was downloaded in the background
+            fut = self.prefetched.get(url)
+            if fut is not None and not fut.cancelled() and (not fut.done() or fut.exception() is None):
+                kind = "hit"
+                page = fut.result()
             else:
-                page = BeautifulSoup(req).find_all("body")[0].get_text()
+                kind = "miss"
+                page = self.load_page(url)
+
+            if self.summarizer:
+                page = self.summarizer.summarize_sections(page)
 
-            return ToolUseStatus.SUCCEEDED, "The page at %s says '%s'." % (self.links[int(args[0]) - 1], page)
+            self.click_latencies[kind].append(time.perf_counter() - start)
+            get_current_span().set(prefetch=kind)
+            return ToolUseStatus.SUCCEEDED, "The page at %s says '%s'." % (url, page)
         except IndexError:
             return ToolUseStatus.FAILED_REPROMPT, "The page was not returned because that was not a valid link"
         except Exception as e:
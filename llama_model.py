@@ -1,51 +1,217 @@
 # Imports
-from vllm import LLM, SamplingParams
-from transformers import AutoTokenizer
+from collections import OrderedDict
+import hashlib
+import itertools
+import threading
+from typing import List
 
 from base_classes import Model, UserInput, main_loop
+from context_manager import ContextWindow
 from file_manager import FileManagerTool
 from python_runner import PythonTool
 from internet_tools import WikipediaTool, GoogleTool
+from tracing import Tracer, default_trace_path, set_tracer, span
+
+
+class PromptCache:
+    """LRU cache of rendered chat prompts, so each turn only renders and tokenizes the messages that are new"""
+    def __init__(self, tokenizer, max_entries: int = 256):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # Hash of a message prefix -> (rendered text, token ids)
+
+        self.hits = 0
+        self.misses = 0
+
+        # Work out what the chat template adds before the first message and after the last one
+        dummy = [{"role": "user", "content": "x"}]
+        self.generation_prompt = self.render_text(dummy, add_generation_prompt=True)[len(self.render_text(dummy)):]
+        self.generation_ids = self.tokenizer.encode(self.generation_prompt, add_special_tokens=False)
+        self.bos = self.tokenizer.bos_token or ""
+
+    def render_text(self, messages, add_generation_prompt=False):
+        return self.tokenizer.apply_chat_template(
+                messages,
+                tokenize=False,
+                add_generation_prompt=add_generation_prompt
+        ).replace("<|eot_id|>", "")
+
+    def prefix_hashes(self, messages):
+        hashes = []
+        h = hashlib.blake2b(digest_size=16)
+        for message in messages:
+            h.update(message["role"].encode("utf-8") + b"\0" + message["content"].encode("utf-8") + b"\0")
+            hashes.append(h.copy().digest())
+        return hashes
+
+    def render(self, messages) -> (str, List[int]):
+        hashes = self.prefix_hashes(messages)
+
+        # Find the longest prefix of this conversation that was rendered before
+        start, text, ids = 0, "", []
+        for i in range(len(hashes) - 1, -1, -1):
+            if hashes[i] in self.entries:
+                text, ids = self.entries.pop(hashes[i])
+                start = i + 1
+                self.hits += 1
+                break
+        else:
+            self.misses += 1
+
+        # Render and tokenize only the new messages, message boundaries are special tokens so the ids line up
+        if start < len(messages):
+            delta = self.render_text(messages[start:])
+            if start > 0 and self.bos and delta.startswith(self.bos):
+                delta = delta[len(self.bos):]
+            text = text + delta
+            ids = ids + self.tokenizer.encode(delta, add_special_tokens=False)
+
+        self.entries[hashes[-1]] = (text, ids)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        return text + self.generation_prompt, ids + self.generation_ids
 
 
 class Llama_Model(Model):
-    def __init__(self,):
-        model_id = "meta-llama/Meta-Llama-3-8B-Instruct" # casperhansen/llama-3-70b-instruct-awq" # meta-llama/Meta-Llama-3-8B-Instruct" # ""
-        
-        self.tokenizer = AutoTokenizer.from_pretrained(model_id)
-        self.LLM = LLM(model=model_id) #, tensor_parallel_size=2, max_model_len=3124, gpu_memory_utilization=0.9, swap_space=80) #, max_num_seqs=1)
-        
-        self.terminators = [
-            self.tokenizer.eos_token_id,
-            # tokenizer.convert_tokens_to_ids("<|eot_id|>")
-        ]
-
-        self.sampling_params = SamplingParams(n=1, max_tokens=8192, stop_token_ids=self.terminators, temperature=0.6, top_p=0.9)
+    """Llama 3 on vLLM
+
+    vllm and transformers are only imported, and the weights only loaded, on the first prompt.  With
+    background=True loading starts in a thread straight away, so it happens while the user types.
+    """
+    def __init__(self, model_id: str = "meta-llama/Meta-Llama-3-8B-Instruct", background: bool = False): # casperhansen/llama-3-70b-instruct-awq
+        self.model_id = model_id
+        self.tokenizer = None
+        self.prompt_cache = None
+        self.LLM = None
+        self.request_ids = itertools.count()
+        self.outputs = {} # Request id -> its latest output, for every request the engine is running
+
+        self.load_lock = threading.Lock()
+        self.load_error = None
+        # Tools summarize from their own threads (i.e. parallel %WIKI GETs) while a response may be streaming, and
+        # neither the engine nor the prompt cache can be used from two threads at once
+        self.lock = threading.RLock()
+        if background:
+            threading.Thread(target=self.load, name="model-load", daemon=True).start()
+
+    def load(self,):
+        # The first caller loads the model, any others wait for it to finish
+        with self.load_lock:
+            if self.LLM is None and self.load_error is None:
+                try:
+                    from vllm import LLM, SamplingParams
+                    from transformers import AutoTokenizer
+
+                    self.tokenizer = AutoTokenizer.from_pretrained(self.model_id)
+                    self.prompt_cache = PromptCache(self.tokenizer)
+                    self.terminators = [
+                        self.tokenizer.eos_token_id,
+                        # tokenizer.convert_tokens_to_ids("<|eot_id|>")
+                    ]
+                    self.sampling_params = SamplingParams(n=1, max_tokens=8192, stop_token_ids=self.terminators, temperature=0.6, top_p=0.9)
+
+                    # Prefix caching lets conversations that share the system prompt reuse its KV cache
+                    self.LLM = LLM(model=self.model_id, enable_prefix_caching=True) #, tensor_parallel_size=2, max_model_len=3124, gpu_memory_utilization=0.9, swap_space=80) #, max_num_seqs=1)
+                except Exception as e:
+                    self.load_error = e
+        if self.load_error is not None:
+            raise RuntimeError("%s failed to load because of %s" % (self.model_id, self.load_error)) from self.load_error
+
+    def count_tokens(self, text: str) -> int:
+        self.load()
+        with self.lock:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def render(self, messages: List[List[dict]]) -> List[List[int]]:
+        self.load()
+        with self.lock, span("render", prompts=len(messages)) as s:
+            hits = self.prompt_cache.hits
+            ids = [self.prompt_cache.render(message)[1] for message in messages]
+            s.set(cache_hits=self.prompt_cache.hits - hits, prompt_tokens=sum([len(i) for i in ids]))
+            return ids
+
+    def add_request(self, prompt_ids: List[int]) -> str:
+        request_id = "%d" % next(self.request_ids)
+        with self.lock:
+            self.LLM.llm_engine.add_request(request_id, {"prompt_token_ids": prompt_ids}, self.sampling_params)
+            self.outputs[request_id] = None
+        return request_id
+
+    def next_output(self, request_id: str, seen=None):
+        """The request's output once it has moved on from seen, stepping the engine until it does
+
+        Every request runs on the LLM's one engine, so whichever caller steps it hands each output to its own
+        request.  A caller that finds its request already moved on by another caller's step doesn't step at all.
+        """
+        with self.lock:
+            engine = self.LLM.llm_engine
+            while self.outputs[request_id] is seen:
+                if not engine.has_unfinished_requests():
+                    raise RuntimeError("Request %s is no longer running" % request_id)
+                for out in engine.step():
+                    if out.request_id in self.outputs:
+                        self.outputs[out.request_id] = out
+            out = self.outputs[request_id]
+            if out.finished:
+                del self.outputs[request_id]
+            return out
+
+    def abort_request(self, request_id: str):
+        with self.lock:
+            if request_id in self.outputs:
+                del self.outputs[request_id]
+                self.LLM.llm_engine.abort_request(request_id)
 
     def prompt(self, messages):
-        if type(messages[0]) == dict:
-            prompt = [self.tokenizer.apply_chat_template(
-                    messages, 
-                    tokenize=False, 
-                    add_generation_prompt=True
-            ).replace("<|eot_id|>", "")]
-           
-            output = self.LLM.generate(prompt, self.sampling_params)[0].outputs[0]
-            return output.text.strip()
-            
-        else:
-            prompt = [self.tokenizer.apply_chat_template(
-                    message, 
-                    tokenize=False, 
-                    add_generation_prompt=True
-            ).replace("<|eot_id|>", "") for message in messages]
+        single = type(messages[0]) == dict
+        prompts = self.render([messages] if single else messages)
+
+        with span("generate", prompts=len(prompts), prompt_tokens=sum([len(ids) for ids in prompts])) as s:
+            # Added together so the engine batches them, along with any other requests it's running
+            request_ids = [self.add_request(ids) for ids in prompts]
+            outputs = []
+            try:
+                for request_id in request_ids:
+                    out = None
+                    while out is None or not out.finished:
+                        out = self.next_output(request_id, out)
+                    outputs.append(out)
+            finally:
+                for request_id in request_ids[len(outputs):]:
+                    self.abort_request(request_id)
+            s.set(completion_tokens=sum([len(out.outputs[0].token_ids) for out in outputs]))
+
+        texts = [out.outputs[0].text.strip() for out in outputs]
+        return texts[0] if single else texts
+
+    def stream(self, messages):
+        # Steps the LLM's own engine instead of starting a second (async) engine with its own copy of the weights
+        prompt_ids = self.render([messages])[0]
+        request_id = self.add_request(prompt_ids)
 
-            print(prompt)
-            
-            outputs = self.LLM.generate(prompt, self.sampling_params)
-            return [out.outputs[0].text.strip() for out in outputs]
+        sent = 0
+        out = None
+        with span("generate", prompts=1, prompt_tokens=len(prompt_ids), stream=True) as s:
+            try:
+                while out is None or not out.finished:
+                    # The lock is only held for a step at a time, not while the caller has the chunk
+                    out = self.next_output(request_id, out)
+                    text = out.outputs[0].text
+                    if len(text) > sent:
+                        yield text[sent:]
+                        sent = len(text)
+            finally:
+                # The caller stopped early (i.e. a tool command was complete), so free the sequence
+                finished = out is not None and out.finished
+                if not finished:
+                    self.abort_request(request_id)
+                s.set(completion_tokens=len(out.outputs[0].token_ids) if out is not None else 0, cancelled=not finished)
 
 
 if __name__ == "__main__":
-    llama_model = Llama_Model()
-    main_loop(UserInput(), llama_model, [FileManagerTool(), PythonTool(), WikipediaTool(summary_model=llama_model), GoogleTool()])
+    set_tracer(Tracer(default_trace_path(), profile_turns=5))
+    # The model loads while the user types their first message
+    llama_model = Llama_Model(background=True)
+    context = ContextWindow(llama_model, count_tokens=llama_model.count_tokens)
+    main_loop(UserInput(), context, [FileManagerTool(), PythonTool(), WikipediaTool(summary_model=llama_model), GoogleTool()])
@@ -0,0 +1,144 @@
+# Imports
+from typing import Iterator, List
+import contextvars
+import json
+import threading
+
+from base_classes import Model
+from tracing import span
+
+
+class OpenAIModel(Model):
+    """Model served by an OpenAI-compatible /v1/chat/completions endpoint (i.e. vllm serve)
+
+    Lets many agent processes share one inference server instead of each loading the model.  Requests go over
+    pooled keep-alive connections, the conversations of a batched prompt are sent as concurrent requests (the
+    server batches them itself), and connection errors, 429s and 5xx responses are retried with exponential
+    backoff.  Closing a stream early drops its connection, which makes the server abort the generation.
+    """
+    def __init__(self, base_url: str = "http://localhost:8000/v1", model: str = "meta-llama/Meta-Llama-3-8B-Instruct", api_key: str = None,
+                 max_tokens: int = 8192, temperature: float = 0.6, top_p: float = 0.9, timeout: float = 600.0, retries: int = 3,
+                 backoff: float = 0.5, max_connections: int = 16):
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+        self.sampling = {"max_tokens": max_tokens, "temperature": temperature, "top_p": top_p}
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_connections = max_connections
+
+        # Made on first use, so that creating the model doesn't import urllib3 or start threads
+        self.pool = None
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_pool(self,):
+        with self.lock:
+            if self.pool is None:
+                import urllib3
+
+                headers = {"Content-Type": "application/json"}
+                if self.api_key:
+                    headers["Authorization"] = "Bearer %s" % self.api_key
+                # block=True makes extra requests wait for a free connection instead of opening ones that aren't kept
+                self.pool = urllib3.PoolManager(
+                    num_pools=4,
+                    maxsize=self.max_connections,
+                    block=True,
+                    headers=headers,
+                    timeout=urllib3.Timeout(connect=10.0, read=self.timeout),
+                    retries=urllib3.Retry(
+                        total=self.retries,
+                        backoff_factor=self.backoff,
+                        status_forcelist=[429, 500, 502, 503, 504],
+                        allowed_methods=None, # Retrying a POST is safe here, a failed completion has no side effects
+                        raise_on_status=False,
+                    ),
+                )
+            return self.pool
+
+    def get_executor(self,):
+        with self.lock:
+            if self.executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.executor = ThreadPoolExecutor(max_workers=self.max_connections, thread_name_prefix="completion")
+            return self.executor
+
+    def post(self, messages: List[dict], stream: bool):
+        body = {"model": self.model, "messages": [{"role": m["role"], "content": m["content"]} for m in messages], "stream": stream}
+        body.update(self.sampling)
+
+        resp = self.get_pool().request(
+            "POST",
+            self.base_url + "/chat/completions",
+            body=json.dumps(body).encode("utf-8"),
+            preload_content=not stream,
+        )
+        if resp.status != 200:
+            error = resp.data[:500].decode("utf-8", errors="ignore")
+            resp.release_conn()
+            raise RuntimeError("%s/chat/completions returned %d: %s" % (self.base_url, resp.status, error))
+        return resp
+
+    def complete(self, messages: List[dict]) -> str:
+        with span("generate", model=self.model, prompts=1) as s:
+            reply = json.loads(self.post(messages, stream=False).data)
+            usage = reply.get("usage") or {}
+            s.set(prompt_tokens=usage.get("prompt_tokens"), completion_tokens=usage.get("completion_tokens"))
+            return (reply["choices"][0]["message"]["content"] or "").strip()
+
+    def prompt(self, messages):
+        if type(messages[0]) == dict:
+            return self.complete(messages)
+        else:
+            # One request per conversation, the server batches whichever of them are running at the same time
+            executor = self.get_executor()
+            futures = [executor.submit(contextvars.copy_context().run, self.complete, m) for m in messages]
+            return [future.result() for future in futures]
+
+    def stream(self, messages) -> Iterator[str]:
+        with span("generate", model=self.model, prompts=1, stream=True) as s:
+            resp = self.post(messages, stream=True)
+            finished = False
+            chunks = 0
+            try:
+                for line in iter_lines(resp):
+                    # Server-sent events, one "data: {json}" line per chunk and "data: [DONE]" at the end
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == b"[DONE]":
+                        # Keep reading to the end of the body, so the connection can go back to the pool
+                        finished = True
+                        continue
+                    delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                    if delta:
+                        chunks += 1
+                        yield delta
+                finished = True
+            finally:
+                if not finished:
+                    # Dropping the connection is how the server finds out the generation isn't wanted any more
+                    resp.close()
+                resp.release_conn()
+                s.set(chunks=chunks, cancelled=not finished)
+
+    def close(self,):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+        if self.pool:
+            self.pool.clear()
+
+
+def iter_lines(resp) -> Iterator[bytes]:
+    # Chunked responses stream chunk by chunk, otherwise read1 returns whatever has arrived instead of waiting for a full buffer
+    chunks = resp.stream(decode_content=True) if resp.chunked else iter(lambda: resp.read1(65536), b"")
+    buffer = b""
+    for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r")
+    if len(buffer) > 0:
+        yield buffer
@@ -1,11 +1,177 @@
 from typing import List
+import contextlib
+import io
+import itertools
+import json
+import os
+import resource
+import select
+import subprocess
+import sys
+import threading
 
 from base_classes import Tool, ToolUseStatus
 
 
+def worker_main():
+    """Loop run by each worker process, executing lines of Python in one namespace per conversation"""
+    # Keep the real stdin/stdout for talking to the pool, and point fds 0 and 1 at /dev/null, so code that reads
+    # input or writes to fd 1 (print, sys.__stdout__, os.system, child processes) can't break the protocol
+    requests = os.fdopen(os.dup(0), "rb")
+    replies = os.fdopen(os.dup(1), "wb")
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+    sys.stdin = open(os.devnull, "r")
+
+    namespaces = {}
+    for line in requests:
+        request = json.loads(line)
+        if "drop" in request:
+            namespaces.pop(request["drop"], None)
+            continue
+
+        # Give this call its own CPU allowance, going over it kills the worker and the pool replaces it.  The hard
+        # limit can't be raised, so the allowance stops at a finite one
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        soft = int(usage.ru_utime + usage.ru_stime + request["cpu"]) + 1
+        resource.setrlimit(resource.RLIMIT_CPU, (soft if hard == resource.RLIM_INFINITY else min(soft, hard), hard))
+
+        namespace = namespaces.setdefault(request["session"], {"__name__": "__main__"})
+        out = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(out):
+                try:
+                    result = eval(compile(request["code"], "<PYTHON>", "eval"), namespace)
+                except SyntaxError:
+                    # Statements (like assignments) can't be evaluated, so run them instead
+                    exec(compile(request["code"], "<PYTHON>", "exec"), namespace)
+                    result = None
+            if result is None and len(out.getvalue()) > 0:
+                result = out.getvalue().strip()
+            reply = {"ok": True, "result": "%s" % (result,)}
+        except BaseException as e:
+            reply = {"ok": False, "error": ("%s" % (e,)) or type(e).__name__}
+
+        replies.write((json.dumps(reply) + "\n").encode("utf-8"))
+        replies.flush()
+
+
+class PythonWorker:
+    def __init__(self, memory_limit: int):
+        self.memory_limit = memory_limit
+        self.lock = threading.Lock()
+        self.process = None
+        self.start()
+
+    def set_limits(self,):
+        # Runs in the child before it starts
+        if self.memory_limit:
+            _, hard = resource.getrlimit(resource.RLIMIT_AS)
+            limit = self.memory_limit if hard == resource.RLIM_INFINITY else min(self.memory_limit, hard)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    def start(self,):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--worker"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            preexec_fn=self.set_limits,
+        )
+
+    def restart(self,):
+        self.process.kill()
+        self.process.wait()
+        self.start()
+
+    def send(self, request: dict):
+        self.process.stdin.write((json.dumps(request) + "\n").encode("utf-8"))
+        self.process.stdin.flush()
+
+    def call(self, session: str, code: str, timeout: float, cpu_limit: float) -> dict:
+        with self.lock:
+            try:
+                self.send({"session": session, "code": code, "cpu": cpu_limit})
+                ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+                if not ready:
+                    self.restart()
+                    return {"ok": False, "error": "it ran for longer than %g seconds, so it was stopped and your variables were reset" % timeout}
+
+                line = self.process.stdout.readline()
+                if not line:
+                    raise BrokenPipeError
+                reply = json.loads(line)
+                if type(reply) != dict or "ok" not in reply or ("result" if reply["ok"] else "error") not in reply:
+                    raise ValueError("not a reply")
+                return reply
+            except BrokenPipeError:
+                # The worker died, most likely by going over its CPU or memory limit
+                self.restart()
+                return {"ok": False, "error": "it went over the CPU or memory limit, so it was stopped and your variables were reset"}
+            except ValueError:
+                # Restart rather than risk the next reply being out of step with its request
+                self.restart()
+                return {"ok": False, "error": "the worker running it sent back a reply that couldn't be read, so it was restarted and your variables were reset"}
+
+    def drop(self, session: str):
+        with self.lock:
+            try:
+                self.send({"drop": session})
+            except BrokenPipeError:
+                self.restart()
+
+    def close(self,):
+        self.process.kill()
+        self.process.wait()
+
+
+class PythonWorkerPool:
+    """Pre-started Python worker processes, each conversation always runs on the same worker so its variables persist"""
+    def __init__(self, n_workers: int = 4, memory_limit: int = 1024 * 1024 * 1024):
+        self.workers = [PythonWorker(memory_limit) for _ in range(n_workers)]
+        self.next_worker = itertools.count()
+
+    def assign(self,) -> int:
+        return next(self.next_worker) % len(self.workers)
+
+    def call(self, worker: int, session: str, code: str, timeout: float, cpu_limit: float) -> dict:
+        return self.workers[worker].call(session, code, timeout, cpu_limit)
+
+    def drop(self, worker: int, session: str):
+        self.workers[worker].drop(session)
+
+    def close(self,):
+        for worker in self.workers:
+            worker.close()
+
+
+shared_pool = None
+shared_pool_lock = threading.Lock()
+session_ids = itertools.count()
+
+
+def get_worker_pool() -> PythonWorkerPool:
+    # Tools in different threads can ask for the pool at the same time now that it is made on first use
+    global shared_pool
+    with shared_pool_lock:
+        if shared_pool is None:
+            shared_pool = PythonWorkerPool()
+    return shared_pool
+
+
 class PythonTool(Tool):
-    def __init__(self):
-        pass
+    def __init__(self, pool: PythonWorkerPool = None, timeout: float = 10.0, cpu_limit: float = 10.0):
+        # The shared pool's workers are only started when the first line of Python is run
+        self.pool = pool
+        self.timeout = timeout
+        self.cpu_limit = cpu_limit
+
+        # Each tool is one conversation with its own namespace on one of the workers
+        self.session = "%d-%d" % (os.getpid(), next(session_ids))
+        self.worker = None
 
     def get_name(self,):
         return "PYTHON"
@@ -19,15 +185,27 @@ class PythonTool(Tool):
         ] + super().get_commands()
 
     def run(self, args: List[str]):
-        try:
-            s = " ".join(args).strip().replace("print", "")
-            return ToolUseStatus.SUCCEEDED, "The results of the line of Python is '%s'" % (eval(s))
-        except Exception as e:
-            return ToolUseStatus.FAILED_REPROMPT, "The line of Python did not run because of %s" % e
-    
+        s = " ".join(args).strip()
+        if self.worker is None:
+            self.pool = self.pool or get_worker_pool()
+            self.worker = self.pool.assign()
+        reply = self.pool.call(self.worker, self.session, s, self.timeout, self.cpu_limit)
+        if reply["ok"]:
+            return ToolUseStatus.SUCCEEDED, "The results of the line of Python is '%s'" % reply["result"]
+        else:
+            return ToolUseStatus.FAILED_REPROMPT, "The line of Python did not run because of %s" % reply["error"]
+
+    def close(self,):
+        if self.worker is not None:
+            self.pool.drop(self.worker, self.session)
+
     def get_two_examples(self,):
         ex1 = "user: What is the sum of the first 10 numbers?\nassistant: %PYTHON RUN sum([i + 1 for i in range(10)])\nsystem: The results of the line of Python is '55'\nnassistant: The sum of the first 10 numbers is 55\n"
 
         ex2 = "user: Can you make a function that asks the user for a number and multiplies it by 12\nassistant: Sure, a function to do that could be 'lambda : 12 * int(input())'\nuser: Please run that function\nassistant: %PYTHON RUN lambda : 12 * int(input())\nsystem: The results of the line of Python is '60'\nassistant: The product of the number you entered and 12 is 60."
 
-        return ex1, ex2
\ No newline at end of file
+        return ex1, ex2
+
+
+if __name__ == "__main__" and "--worker" in sys.argv:
+    worker_main()
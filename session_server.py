@@ -0,0 +1,204 @@
+# Imports
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+import time
+
+from base_classes import Model, Tool, ScriptedModel, ToolRegistry, finish_turn
+from conversation_log import AGENT1, AGENT2, SYSTEM, ConversationLog
+
+
+class BatchScheduler:
+    """Collects the conversations waiting on a model turn and runs them through one batched Model.prompt call"""
+    def __init__(self, model: Model, max_batch_size: int = 64, max_wait: float = 0.01):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        # A single thread runs the model so the engine is never called from two threads at once
+        self.model_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model")
+        self.queue = None
+        self.loop = None
+        self.task = None
+
+        self.num_batches = 0
+        self.num_prompts = 0
+
+    async def start(self,):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self,):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.model_executor.shutdown(wait=False)
+
+    async def prompt(self, messages: List[dict]) -> str:
+        # Sessions pass their conversation view itself, not a copy, so a ContextWindow can keep its state for the
+        # conversation between turns.  Nothing is added to the log while the session waits for the reply
+        fut = self.loop.create_future()
+        await self.queue.put((messages, fut))
+        return await fut
+
+    def sync_prompt(self, messages):
+        """Blocking prompt for code running off the event loop (i.e. tools that summarize with the model)"""
+        if type(messages[0]) == dict:
+            return asyncio.run_coroutine_threadsafe(self.prompt(messages), self.loop).result()
+        else:
+            futs = [asyncio.run_coroutine_threadsafe(self.prompt(message), self.loop) for message in messages]
+            return [fut.result() for fut in futs]
+
+    async def next_batch(self,):
+        batch = [await self.queue.get()]
+        deadline = self.loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - self.loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Anything that queued up while we were waiting rides along for free
+        while len(batch) < self.max_batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+
+        return batch
+
+    async def run(self,):
+        while True:
+            batch = await self.next_batch()
+            batch = [(messages, fut) for messages, fut in batch if not fut.cancelled()]
+            if len(batch) == 0:
+                continue
+
+            self.num_batches += 1
+            self.num_prompts += len(batch)
+
+            try:
+                outputs = await self.loop.run_in_executor(self.model_executor, self.model.prompt, [messages for messages, _ in batch])
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+
+            for (_, fut), out in zip(batch, outputs):
+                if not fut.done():
+                    fut.set_result(out)
+
+
+class ScheduledModel(Model):
+    """Model that routes prompts through a BatchScheduler, usable as the summary model for tools running in threads"""
+    def __init__(self, scheduler: BatchScheduler):
+        self.scheduler = scheduler
+
+    def prompt(self, messages):
+        return self.scheduler.sync_prompt(messages)
+
+
+class QueueInput(Model):
+    """User side of a served session, messages are pushed with put and a None ends the session"""
+    def __init__(self,):
+        self.queue = asyncio.Queue()
+        self.replies = asyncio.Queue()
+
+    async def put(self, message: str):
+        await self.queue.put(message)
+
+    async def get_reply(self,) -> str:
+        return await self.replies.get()
+
+    async def aprompt(self, messages):
+        if messages[-1]["role"] == "user":
+            await self.replies.put(messages[-1]["content"])
+        return await self.queue.get()
+
+
+class SessionServer:
+    def __init__(self, model: Model, tools_factory: Callable[[], List[Tool]], max_batch_size: int = 64, max_wait: float = 0.01, tool_workers: int = 16):
+        self.scheduler = BatchScheduler(model, max_batch_size=max_batch_size, max_wait=max_wait)
+        self.tools_factory = tools_factory
+        self.tool_executor = ThreadPoolExecutor(max_workers=tool_workers, thread_name_prefix="tool")
+
+    async def __aenter__(self,):
+        await self.scheduler.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.scheduler.stop()
+        self.tool_executor.shutdown(wait=False)
+
+    async def prompt_user(self, user: Model, messages):
+        if hasattr(user, "aprompt"):
+            return await user.aprompt(messages)
+        return await asyncio.get_running_loop().run_in_executor(self.tool_executor, user.prompt, messages)
+
+    async def run_session(self, user: Model, max_rounds: int = None, log: ConversationLog = None, tools: List[Tool] = None, metrics: List[dict] = None) -> List[dict]:
+        """Async version of main_loop, the user is prompted directly and the assistant through the batch scheduler
+
+        tools replaces the ones from tools_factory for this session, and metrics gets the time of each model turn.
+        """
+        loop = asyncio.get_running_loop()
+        tools = ToolRegistry(tools if tools is not None else self.tools_factory())
+        ava_tools = tools.get_listing()
+
+        log = log if log is not None else ConversationLog()
+        if len(log) == 0:
+            log.append(SYSTEM, tools.get_system_prompt())
+        user_view = log.view(AGENT1)
+        model_view = log.view(AGENT2)
+
+        agent = log.last_agent() or AGENT1
+        if log.authors[-1] == agent:
+            _, agent = await loop.run_in_executor(self.tool_executor, finish_turn, log, agent, tools, ava_tools)
+
+        # A round is the user's turn followed by the model's
+        rounds = 0
+        new_round = True
+        while True:
+            if agent == AGENT1:
+                if new_round:
+                    if max_rounds is not None and rounds >= max_rounds:
+                        break
+                    rounds += 1
+                resp = await self.prompt_user(user, user_view)
+                if resp is None:
+                    break
+            else:
+                start = time.perf_counter()
+                resp = await self.scheduler.prompt(model_view)
+                if metrics is not None:
+                    metrics.append({"model": type(self.scheduler.model).__name__, "total_time": time.perf_counter() - start})
+
+            log.append(agent, resp)
+            status, next_agent = await loop.run_in_executor(self.tool_executor, finish_turn, log, agent, tools, ava_tools)
+            new_round = agent == AGENT2 and next_agent == AGENT1
+            agent = next_agent
+
+        return model_view.to_list()
+
+    async def run_sessions(self, users: List[Model], max_rounds: int = None) -> List[List[dict]]:
+        return await asyncio.gather(*[self.run_session(user, max_rounds=max_rounds) for user in users])
+
+
+if __name__ == "__main__":
+    # Run a few hundred scripted conversations against a stub model to show the batching
+    from file_manager import FileManagerTool
+    from python_runner import PythonTool
+
+    async def demo():
+        async with SessionServer(ScriptedModel(), lambda: [FileManagerTool(), PythonTool()]) as server:
+            users = [ScriptedModel(["Hello %d" % i, "%%PYTHON RUN %d * 2" % i, "Thanks"]) for i in range(256)]
+            await server.run_sessions(users, max_rounds=3)
+            print("Ran %d prompts in %d batches" % (server.scheduler.num_prompts, server.scheduler.num_batches))
+
+    asyncio.run(demo())
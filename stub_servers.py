@@ -0,0 +1,209 @@
+# Local HTTP servers standing in for the websites and the inference server, for the benchmarks and tests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import os
+import re
+import threading
+import time
+import zlib
+
+
+def make_wiki_page(i: int, sections: int = 60, paragraphs: int = 8) -> str:
+    body = "".join([
+        "<h2>Section %d <span>[edit]</span></h2>" % j + "".join([
+            "<p>Paragraph %d of section %d on page %d, with <a href=\"#\">a link</a> and <b>some</b> &amp; more text.  %s</p>" % (k, j, i, "Filler sentence. " * 20)
+            for k in range(paragraphs)
+        ]) + "<ul><li>List item</li></ul><table><tr><td>cell</td></tr></table>"
+        for j in range(sections)
+    ])
+    return "<html><head><script>var x = 1;</script><style>.a {}</style></head><body><div class=\"mw-page-container\"><div class=\"mw-page-container-inner\">%s</div></div><footer>footer</footer></body></html>" % body
+
+
+def make_result_page(i: int, paragraphs: int = 30) -> str:
+    return "<html><head><title>Result %d</title></head><body><h1>Result %d</h1>%s</body></html>" % (
+        i, i, "".join(["<p>Paragraph %d of result %d.  %s</p>" % (k, i, "Filler sentence. " * 20) for k in range(paragraphs)])
+    )
+
+
+def make_google_page(base_url: str, n: int = 10) -> str:
+    return "<html><body>%s</body></html>" % "".join([
+        "<div><a href=\"/url?q=%s/page/%d&amp;sa=U\"><h3>Result %d</h3></a></div>" % (base_url, i, i) for i in range(1, n + 1)
+    ])
+
+
+def make_scholar_page(base_url: str, n: int = 10) -> str:
+    return "<html><body>%s</body></html>" % "".join([
+        "<div class=\"gs_or\"><h3><a href=\"%s/page/%d\">Paper %d</a></h3><div class=\"gs_rs\">Abstract of paper %d.  %s</div></div>" % (
+            base_url, i, i, i, "Filler sentence. " * 5
+        )
+        for i in range(1, n + 1)
+    ])
+
+
+class FixtureServer:
+    """Local HTTP server standing in for Wikipedia, Google and Google Scholar
+
+    Serves /wiki/<title>, /search, /scholar and /page/<n>.  Pages come from wiki.html, google.html, scholar.html
+    and page.html in fixtures_dir when they are there (links in saved result pages are pointed back at this
+    server), otherwise they are generated.  Every page has an ETag while validators is set, and a request with a
+    matching If-None-Match gets a 304.
+    """
+    def __init__(self, fixtures_dir: str = None, wiki_sections: int = 60):
+        self.fixtures = {}
+        if fixtures_dir:
+            for kind in ["wiki", "google", "scholar", "page"]:
+                path = os.path.join(fixtures_dir, "%s.html" % kind)
+                if os.path.exists(path):
+                    with open(path, "r", errors="ignore") as f:
+                        self.fixtures[kind] = f.read()
+        self.wiki_sections = wiki_sections
+        self.validators = True
+        self.stats = {"200": 0, "304": 0}
+
+        fixture = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self,):
+                body = fixture.get_page(self.path).encode("utf-8")
+                etag = '"%08x"' % zlib.crc32(body)
+                if fixture.validators and self.headers.get("If-None-Match") == etag:
+                    fixture.stats["304"] += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                fixture.stats["200"] += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", "%d" % len(body))
+                if fixture.validators:
+                    self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def get_page(self, path: str) -> str:
+        kind = path.split("/")[1].split("?")[0]
+        kind = {"wiki": "wiki", "search": "google", "scholar": "scholar"}.get(kind, "page")
+        if kind in self.fixtures:
+            page = self.fixtures[kind]
+            if kind in ["google", "scholar"]:
+                # Every link in a saved result page leads to one of the local result pages
+                n = itertools.count(1)
+                page = re.sub(r"https?://[^\"&<>\s]+", lambda _: "%s/page/%d" % (self.url, next(n)), page)
+            return page
+
+        # Generated pages are the same for the same path, so runs are comparable
+        i = zlib.crc32(path.encode("utf-8"))
+        if kind == "wiki":
+            return make_wiki_page(i, sections=self.wiki_sections)
+        elif kind == "google":
+            return make_google_page(self.url)
+        elif kind == "scholar":
+            return make_scholar_page(self.url)
+        return make_result_page(i)
+
+    def close(self,):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class CompletionServer:
+    """Local stand-in for an OpenAI-compatible /v1/chat/completions server (i.e. vllm serve)
+
+    Answers every request with answer_words words after latency seconds plus token_latency per word, streaming
+    them as chunked server-sent events when asked to.  The next fail_next requests get a 503.  Counts the
+    connections opened, requests answered and streams the client hung up on.
+    """
+    def __init__(self, answer_words: int = 60, latency: float = 0.0, token_latency: float = 0.0):
+        self.answer_words = answer_words
+        self.latency = latency
+        self.token_latency = token_latency
+        self.fail_next = 0
+        self.stats = {"connections": 0, "requests": 0, "failed": 0, "cancelled": 0}
+        self.lock = threading.Lock()
+
+        fixture = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # Keep-alive, so connection reuse shows up in the stats
+
+            def setup(self,):
+                super().setup()
+                fixture.count("connections")
+
+            def do_POST(self,):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with fixture.lock:
+                    fail = fixture.fail_next > 0
+                    fixture.fail_next -= fail
+                if fail:
+                    fixture.count("failed")
+                    self.send_json(503, {"error": "overloaded"})
+                    return
+
+                fixture.count("requests")
+                time.sleep(fixture.latency)
+                words = ["word%d" % i for i in range(fixture.answer_words)]
+                if not request.get("stream"):
+                    time.sleep(fixture.token_latency * len(words))
+                    self.send_json(200, {
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": sum([len(m["content"].split()) for m in request["messages"]]), "completion_tokens": len(words)},
+                    })
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for i, word in enumerate(words):
+                        time.sleep(fixture.token_latency)
+                        self.send_chunk("data: %s\n\n" % json.dumps({"choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}}]}))
+                    self.send_chunk("data: [DONE]\n\n")
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    fixture.count("cancelled")
+                    self.close_connection = True
+
+            def send_json(self, status: int, body: dict):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", "%d" % len(data))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_chunk(self, text: str):
+                data = text.encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d/v1" % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def count(self, key: str):
+        with self.lock:
+            self.stats[key] += 1
+
+    def get_stats(self,) -> dict:
+        with self.lock:
+            return dict(self.stats)
+
+    def close(self,):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,87 @@
+from base_classes import ScriptedModel, ToolUseStatus, UserInput, handle_response, stream_response
+
+
+def test_parse_unquoted_args_split_on_single_spaces(notes):
+    tools, _ = notes
+    commands, done = tools.parse("  %NOTES GET a  b")
+    assert not done
+    assert [(c.tool, c.args) for c in commands] == [("NOTES", ["GET", "a", "", "b"])]
+
+
+def test_parse_quoted_args(notes):
+    tools, _ = notes
+    commands, _ = tools.parse('%NOTES WRITE "my note" some "quoted" text')
+    assert commands[0].args == ["WRITE", "my note", "some", '"quoted"', "text"]
+
+    # A last argument that is one quoted token loses its quotes, except in the contents of a multi-line command
+    assert tools.parse('%NOTES GET "my note"')[0][0].args == ["GET", "my note"]
+    assert tools.parse('%NOTES GET ""')[0][0].args == ["GET", ""]
+    assert tools.parse('%NOTES GET "my" "note"')[0][0].args == ["GET", '"my"', '"note"']
+    assert tools.parse('%NOTES WRITE a "quoted text"')[0][0].args == ["WRITE", "a", '"quoted', 'text"']
+
+
+def test_parse_multiline_command_runs_to_the_next_command(notes):
+    tools, _ = notes
+    commands, done = tools.parse("%NOTES WRITE a first line\nsecond line\n\n%NOTES GET a\nThat's all")
+    assert done
+    assert [c.text for c in commands] == ["%NOTES WRITE a first line\nsecond line\n", "%NOTES GET a"]
+    assert commands[0].args == ["WRITE", "a", "first", "line\nsecond", "line\n"]
+
+
+def test_parse_stops_at_text_after_commands(notes):
+    tools, _ = notes
+    assert tools.parse("%NOTES GET a\nSome answer\n%NOTES GET b")[1]
+    assert [c.text for c in tools.parse("%NOTES GET a\nSome answer\n%NOTES GET b")[0]] == ["%NOTES GET a"]
+    assert tools.parse("Just an answer %NOTES GET a") == ([], True)
+    assert tools.parse("") == ([], False)
+
+
+def test_handle_response_runs_commands_and_reports_errors(notes):
+    tools, written = notes
+    status, message = handle_response("%NOTES WRITE a hello\nworld\n%NOTES GET a", tools, tools.get_listing())
+    assert status == ToolUseStatus.SUCCEEDED
+    assert written["a"] == "hello\nworld"
+    assert "2. %NOTES GET a: hello\nworld" in message["content"]
+
+    status, message = handle_response("%NOTES GET", tools, tools.get_listing())
+    assert status == ToolUseStatus.FAILED_REPROMPT
+    assert "Not enough arguments were included to run %NOTES GET." in message["content"]
+
+    status, message = handle_response("%MISSING RUN", tools, tools.get_listing())
+    assert status == ToolUseStatus.FAILED_REPROMPT
+    assert "%MISSING is not an avaliable tool" in message["content"]
+
+
+def test_help_and_listing(notes):
+    tools, _ = notes
+    assert "    - %NOTES WRITE: Write a note\n" in tools.get_listing()
+    status, text = tools["NOTES"](["HELP"])
+    assert status == ToolUseStatus.SUCCEEDED and "WRITE: Write a note" in text
+
+
+def test_stream_response_stops_once_the_commands_are_complete(notes):
+    tools, _ = notes
+    model = ScriptedModel(["%NOTES WRITE a first\nsecond\n%NOTES GET a\nDone, the note says first second and more"])
+    assert stream_response(model, [{"role": "user", "content": "hi"}], tools) == "%NOTES WRITE a first\nsecond\n%NOTES GET a"
+    assert stream_response(ScriptedModel(["The answer\n%NOTES GET a"]), [{"role": "user", "content": "hi"}], tools) == "The answer\n%NOTES GET a"
+
+
+def test_user_input_skips_the_responses_it_streamed(monkeypatch, capsys):
+    monkeypatch.setattr("builtins.input", lambda prompt: "Thanks")
+    user = UserInput()
+    for chunk in ["%NOTES", " GET a"], ["The note", " says hi"]:
+        for c in chunk:
+            user.stream_chunk(c)
+        user.stream_end()
+    capsys.readouterr()
+
+    # In the user's view the assistant's responses have the user role
+    user.prompt([
+        {"role": "system", "content": "prompt"},
+        {"role": "assistant", "content": "What does note a say"},
+        {"role": "user", "content": "Not streamed"},
+        {"role": "user", "content": "%NOTES GET a"},
+        {"role": "system", "content": "hi"},
+        {"role": "user", "content": "The note says hi"},
+    ])
+    assert capsys.readouterr().out == "System: prompt\n > What does note a say\nAssistant: Not streamed\nSystem: hi\n"
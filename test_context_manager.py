@@ -0,0 +1,117 @@
+from base_classes import Model
+from context_manager import ContextWindow
+from conversation_log import AGENT1, AGENT2, SYSTEM, ConversationLog
+
+
+class LastPrompt(Model):
+    """Remembers the messages it was last prompted with"""
+    def __init__(self,):
+        self.messages = None
+        self.calls = 0
+
+    def prompt(self, messages):
+        self.messages = messages
+        self.calls += 1
+        return "ok"
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def words(n: int, word: str = "word") -> str:
+    return " ".join([word] * n)
+
+
+def make_conversation(turns: int, tool_words: int = 100) -> list:
+    messages = [{"role": "system", "content": "prompt"}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": "question %d" % i})
+        messages.append({"role": "assistant", "content": "%%TOOL RUN %d" % i})
+        messages.append({"role": "system", "content": words(tool_words, "output%d" % i)})
+    return messages
+
+
+def test_a_conversation_under_budget_is_passed_through():
+    model = LastPrompt()
+    window = ContextWindow(model, budget=1000, count_tokens=count_words)
+    messages = make_conversation(3, tool_words=10)
+    window.prompt(messages)
+    assert model.messages == messages
+
+
+def test_old_tool_output_is_compacted_then_dropped_to_fit_the_budget():
+    model = LastPrompt()
+    window = ContextWindow(model, budget=300, keep_recent=4, count_tokens=count_words, compact_tokens=20)
+    messages = make_conversation(10)
+    window.prompt(messages)
+
+    # The system prompt and recent messages are kept as they are
+    assert model.messages[0] == messages[0]
+    assert model.messages[-4:] == messages[-4:]
+    assert sum([count_words(m["content"]) for m in model.messages]) <= 300
+
+    old = model.messages[1:-4]
+    assert len(old) < len(messages) - 5 # The oldest messages were dropped
+    assert old[-1] == messages[-5] # The newest old ones were kept
+    tool_outputs = [m["content"] for m in old if m["role"] == "system"]
+    assert len(tool_outputs) > 0 and all(["tokens of earlier tool output truncated" in c for c in tool_outputs])
+
+
+def test_recent_tool_output_is_compacted_when_it_alone_is_too_big():
+    model = LastPrompt()
+    window = ContextWindow(model, budget=150, keep_recent=6, count_tokens=count_words, compact_tokens=20)
+    messages = make_conversation(2) + [{"role": "user", "content": "last"}]
+    window.prompt(messages)
+    assert sum([count_words(m["content"]) for m in model.messages]) <= 150
+
+    # The old question is dropped first, then only as much recent tool output is compacted as it takes
+    assert model.messages[1] == messages[2]
+    assert "tool output truncated" in model.messages[2]["content"]
+    assert model.messages[3:] == messages[4:]
+
+
+def test_tool_output_is_summarized_once():
+    summaries = LastPrompt()
+    model = LastPrompt()
+    window = ContextWindow(model, budget=10000, keep_recent=2, count_tokens=count_words, compact_tokens=20, summary_model=summaries)
+    messages = make_conversation(3)
+    window.prompt(messages)
+    assert [m["content"] for m in model.messages].count("ok") == 2
+    assert summaries.calls == 2
+
+    # A different list with the same old messages reuses their summaries
+    window.prompt(list(messages) + [{"role": "user", "content": "more"}, {"role": "assistant", "content": "%TOOL RUN 3"}])
+    assert [m["content"] for m in model.messages].count("ok") == 3
+    assert summaries.calls == 3
+
+
+def test_state_is_kept_for_a_view_across_turns():
+    log = ConversationLog()
+    view = log.view(AGENT2)
+    model = LastPrompt()
+    compacted = []
+
+    class CountingWindow(ContextWindow):
+        def compact(self, message):
+            compacted.append(message["content"])
+            return super().compact(message)
+
+    window = CountingWindow(model, budget=10000, keep_recent=2, count_tokens=count_words)
+    log.append(SYSTEM, "prompt")
+    for i in range(20):
+        log.append(AGENT1, "question %d" % i)
+        window.prompt(view)
+        log.append(AGENT2, "answer %d" % i)
+
+    # Each message left the recent window once, so it was only looked at once
+    assert len(compacted) == len(set(compacted)) == len(log) - 1 - 3
+    assert len(window.conversations) == 1
+    assert model.messages == view.to_list()[:-1]
+
+    # A log whose messages differ from the ones seen before gets new state
+    other = ConversationLog()
+    for author, content in zip(log.authors, log.contents):
+        other.append(author, content + " ")
+    window.prompt(other.view(AGENT2))
+    assert len(window.conversations) == 2
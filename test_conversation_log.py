@@ -0,0 +1,52 @@
+import pytest
+
+from base_classes import ScriptedModel, ScriptedUser, ScriptEnded, main_loop
+from conversation_log import AGENT1, AGENT2, SYSTEM, ConversationLog
+
+
+def run_conversation(log, user_script, assistant_script, tools):
+    with pytest.raises(ScriptEnded):
+        main_loop(ScriptedUser(user_script), ScriptedModel(assistant_script), tools, log=log)
+
+
+def test_main_loop_runs_tools_until_the_answer(notes):
+    tools, written = notes
+    log = ConversationLog()
+    run_conversation(log, ["Save a note"], ["%NOTES WRITE a hi", "Saved it"], list(tools.values()))
+    assert written == {"a": "hi"}
+    assert list(log.authors) == [SYSTEM, AGENT1, AGENT2, SYSTEM, AGENT2]
+    assert log.view(AGENT1)[-1] == {"role": "user", "content": "Saved it"}
+    assert log.view(AGENT2)[-1] == {"role": "assistant", "content": "Saved it"}
+
+
+def test_log_resumes_and_reruns_unfinished_commands(notes, tmp_path):
+    path = str(tmp_path / "log.jsonl")
+    log = ConversationLog(path)
+    log.append(SYSTEM, "prompt")
+    log.append(AGENT1, "Save a note")
+    log.append(AGENT2, "%NOTES WRITE a hi") # Its result was never logged
+    log.close()
+
+    tools, written = notes
+    log = ConversationLog(path)
+    assert len(log) == 3 and log.last_agent() == AGENT2
+    run_conversation(log, [], ["Saved it"], list(tools.values()))
+    assert written == {"a": "hi"}
+    assert list(log.authors) == [SYSTEM, AGENT1, AGENT2, SYSTEM, AGENT2]
+    log.close()
+
+
+def test_log_drops_a_torn_last_line(tmp_path):
+    path = str(tmp_path / "log.jsonl")
+    log = ConversationLog(path)
+    log.append(SYSTEM, "prompt")
+    log.append(AGENT1, "hello")
+    log.close()
+    with open(path, "ab") as f:
+        f.write(b'[2, "half a mess')
+
+    log = ConversationLog(path)
+    assert log.contents == ["prompt", "hello"]
+    log.append(AGENT2, "hi")
+    log.close()
+    assert ConversationLog(path).contents == ["prompt", "hello", "hi"]
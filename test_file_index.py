@@ -0,0 +1,77 @@
+import os
+
+from file_index import FileIndex
+
+
+def make_index(tmp_path) -> FileIndex:
+    return FileIndex(str(tmp_path / "tree"), index_path=str(tmp_path / "index.pickle"), refresh_interval=0)
+
+
+def write(tmp_path, rel: str, text: str):
+    path = tmp_path / "tree" / rel
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def found(index: FileIndex, query: str) -> list:
+    return sorted([rel for rel, _ in index.search(query)])
+
+
+def test_index_finds_and_ranks_files(tmp_path):
+    write(tmp_path, "a.txt", "the quick brown fox")
+    write(tmp_path, "docs/b.txt", "a fox and another fox and a dog")
+    write(tmp_path, ".hidden/c.txt", "fox")
+    (tmp_path / "tree" / "d.bin").write_bytes(b"fox\0fox")
+    index = make_index(tmp_path)
+
+    assert [rel for rel, _ in index.search("fox")] == [os.path.join("docs", "b.txt"), "a.txt"]
+    assert found(index, "dog brown") == ["a.txt", os.path.join("docs", "b.txt")]
+    assert index.search("cat") == []
+    assert index.get_snippets("a.txt", "brown") == [(1, "the quick brown fox")]
+
+
+def test_refresh_only_reindexes_changed_files(tmp_path):
+    for i in range(5):
+        write(tmp_path, "f%d.txt" % i, "common file%d" % i)
+    index = make_index(tmp_path)
+    assert index.refresh(force=True) == {"added": 5, "updated": 0, "removed": 0}
+    assert index.refresh(force=True) == {"added": 0, "updated": 0, "removed": 0}
+
+    write(tmp_path, "f1.txt", "common changed words")
+    os.remove(tmp_path / "tree" / "f2.txt")
+    write(tmp_path, "f5.txt", "common file5")
+    assert index.refresh(force=True) == {"added": 1, "updated": 1, "removed": 1}
+    assert found(index, "file1") == []
+    assert found(index, "changed") == ["f1.txt"]
+    assert found(index, "file2") == []
+    assert found(index, "common") == ["f0.txt", "f1.txt", "f3.txt", "f4.txt", "f5.txt"]
+
+    # A new FileIndex picks up the saved index, and only has to look for changes
+    again = make_index(tmp_path)
+    assert again.refresh(force=True) == {"added": 0, "updated": 0, "removed": 0}
+    assert found(again, "changed") == ["f1.txt"]
+
+
+def test_searches_only_refresh_after_refresh_interval(tmp_path):
+    write(tmp_path, "a.txt", "first")
+    index = FileIndex(str(tmp_path / "tree"), index_path=str(tmp_path / "index.pickle"), refresh_interval=3600)
+    assert found(index, "first") == ["a.txt"]
+    write(tmp_path, "b.txt", "first")
+    assert found(index, "first") == ["a.txt"]
+    index.refresh(force=True)
+    assert found(index, "first") == ["a.txt", "b.txt"]
+
+
+def test_compact_drops_dead_ids(tmp_path):
+    write(tmp_path, "keep.txt", "kept words")
+    index = make_index(tmp_path)
+    for i in range(20):
+        write(tmp_path, "changing.txt", "version %d" % i + " padding" * i)
+        index.refresh(force=True)
+    assert index.next_id == 21
+    before = {query: index.search(query) for query in ["kept", "version", "padding", "19"]}
+
+    index.compact()
+    assert index.next_id == 2 and sorted(index.paths) == [0, 1]
+    assert all([len(postings) == 2 for postings in index.postings.values()])
+    assert {query: index.search(query) for query in before} == before
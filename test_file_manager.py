@@ -0,0 +1,32 @@
+from base_classes import ToolRegistry, ToolUseStatus, run_command
+from file_manager import FileManagerTool
+
+
+def test_file_manager_reports_cut_off_output(tmp_path):
+    (tmp_path / "t.txt").write_text("".join(["line %d\n" % i for i in range(1, 1001)]))
+    files = FileManagerTool(str(tmp_path))
+    assert "READ t.txt BYTES" in files(["TAIL", "t.txt", "500"])[1]
+    assert "[Output was cut off at line 200.  To keep reading, run %FILE_MANAGER READ t.txt 201 400]" in files(["HEAD", "t.txt", "500"])[1]
+    status, text = files(["READ", "t.txt", "2000", "2100"])
+    assert status == ToolUseStatus.FAILED_REPROMPT and "only has 1000 lines" in text
+
+    for start, end in [("-3", "8"), ("20", "10"), ("1000000", "1000010")]:
+        assert files(["READ", "t.txt", "BYTES", start, end])[0] == ToolUseStatus.FAILED_REPROMPT
+    assert files(["READ", "t.txt", "BYTES", "0", "7"]) == (ToolUseStatus.SUCCEEDED, "The file t.txt's bytes 0 to 7 (of 8893) are: 'line 1\n'")
+
+
+def test_file_manager_grep_matches_whole_lines(tmp_path):
+    (tmp_path / "log.txt").write_text("start ok\nERROR one\nwarn\nERROR two ok\nnot ERROR\nfoo\nbar\n")
+    files = FileManagerTool(str(tmp_path), chunk_size=16)
+    assert files(["GREP", "^ERROR", "log.txt"])[1] == "The lines of log.txt that match ^ERROR are:\n2: ERROR one\n4: ERROR two ok"
+    assert files(["GREP", "ok$", "log.txt"])[1] == "The lines of log.txt that match ok$ are:\n1: start ok\n4: ERROR two ok"
+    assert files(["GREP", "foo\\s+bar", "log.txt"])[1] == "No lines of log.txt match foo\\s+bar"
+    assert files(["GREP", "n\\s*\\w", "log.txt"])[1] == "The lines of log.txt that match n\\s*\\w are:\n2: ERROR one\n5: not ERROR"
+
+
+def test_file_manager_takes_quoted_file_names(tmp_path):
+    (tmp_path / "my notes.txt").write_text("first\nsecond\n")
+    tools = ToolRegistry([FileManagerTool(str(tmp_path))])
+    for text in ['%FILE_MANAGER READ "my notes.txt"', '%FILE_MANAGER READ "my notes.txt" 2 2', '%FILE_MANAGER READ "my notes.txt" BYTES 6 13']:
+        status, resp = run_command(tools.parse(text)[0][0], tools)
+        assert status == ToolUseStatus.SUCCEEDED and "second" in resp, resp
@@ -0,0 +1,123 @@
+import time
+
+import pytest
+
+from base_classes import Model
+from internet_tools import REDUCE_PROMPT, SUMMARY_PROMPT, Fetcher, Summarizer, SummaryCache
+from stub_servers import FixtureServer
+
+
+@pytest.fixture(scope="module")
+def fixture_server():
+    server = FixtureServer(wiki_sections=5)
+    yield server
+    server.close()
+
+
+def test_fetcher_hits_revalidates_and_evicts(fixture_server, tmp_path):
+    url = fixture_server.url + "/wiki/Cat"
+    fetcher = Fetcher(cache_dir=str(tmp_path), ttl=3600)
+    assert fetcher.fetch_or_revalidate(url)[1] == "miss"
+    page, cache = fetcher.fetch_or_revalidate(url)
+    assert cache == "hit"
+
+    # A new fetcher finds the cache on disk, and with no ttl revalidates with the ETag
+    stale = Fetcher(cache_dir=str(tmp_path), ttl=0)
+    not_modified = fixture_server.stats["304"]
+    assert stale.fetch_or_revalidate(url) == (page, "revalidated")
+    assert fixture_server.stats["304"] == not_modified + 1
+
+    # Only room for one page, so the least recently used one goes
+    small = Fetcher(cache_dir=str(tmp_path / "small"), ttl=3600, max_cache_bytes=len(page) + 100)
+    small.fetch(url)
+    time.sleep(0.01)
+    small.fetch(fixture_server.url + "/wiki/Dog")
+    assert small.get_stats()["cache_bytes"] <= len(page) + 100
+    assert small.fetch_or_revalidate(url)[1] == "miss"
+
+
+def test_fetcher_keeps_a_stale_body_downloaded_again(fixture_server, tmp_path):
+    url = fixture_server.url + "/wiki/Bird"
+    fixture_server.validators = False
+    try:
+        fetcher = Fetcher(cache_dir=str(tmp_path), ttl=3600)
+        page = fetcher.fetch(url)
+
+        # Without an ETag the stale entry is downloaded again, with the same body as before
+        fetcher.ttl = 0
+        assert fetcher.fetch_or_revalidate(url) == (page, "miss")
+        fetcher.ttl = 3600
+        assert fetcher.fetch_or_revalidate(url) == (page, "hit")
+        assert Fetcher(cache_dir=str(tmp_path), ttl=3600).fetch_or_revalidate(url) == (page, "hit")
+        assert fetcher.get_stats()["cache_bytes"] == len(page)
+    finally:
+        fixture_server.validators = True
+
+
+class SnippetModel(Model):
+    """Summarizes a snippet as its first word, and records each batch of prompts"""
+    def __init__(self,):
+        self.batches = []
+
+    def prompt(self, messages):
+        self.batches.append([(m[0]["content"], m[1]["content"]) for m in messages])
+        return ["%s (%d words)" % (m[1]["content"].split()[3], len(m[1]["content"].split()) - 3) for m in messages]
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def make_summarizer(model: Model, cache: SummaryCache = None, **kwargs) -> Summarizer:
+    return Summarizer(model, count_tokens=count_words, cache=cache or SummaryCache(cache_dir=None), **kwargs)
+
+
+def test_summarizer_splits_on_lines_within_the_chunk_budget():
+    summarizer = make_summarizer(SnippetModel(), chunk_tokens=10)
+    assert summarizer.split("a short section") == ["a short section"]
+
+    text = "".join(["line %d has five words\n" % i for i in range(6)]) + " ".join(["long"] * 25) + "\n"
+    chunks = summarizer.split(text)
+    assert "".join(chunks) == text
+    assert all([count_words(chunk) <= 10 for chunk in chunks])
+    assert chunks[:3] == ["line 0 has five words\nline 1 has five words\n", "line 2 has five words\nline 3 has five words\n", "line 4 has five words\nline 5 has five words\n"]
+
+
+def test_summarizer_maps_chunks_in_sorted_batches_and_reduces_long_sections():
+    model = SnippetModel()
+    summarizer = make_summarizer(model, chunk_tokens=10, batch_size=2)
+    sections = [
+        (None, "intro text\n"),
+        ("History", "".join(["history part %d of it\n" % i for i in range(4)])),
+        ("Empty", ""),
+    ]
+    summary = summarizer.summarize_sections(sections)
+
+    # Three chunks mapped in batches of at most two (shortest first), then one reduce of the history section's two
+    assert [len(batch) for batch in model.batches] == [2, 1, 1]
+    assert [prompt for batch in model.batches[:2] for prompt, _ in batch] == [SUMMARY_PROMPT] * 3
+    assert model.batches[0][0][1] == "The snippet says intro text\n"
+    assert model.batches[2][0][0] == REDUCE_PROMPT
+    assert summary.split("\n") == ["intro (2 words)", "History", "history (6 words)", "Empty"]
+    assert summarizer.get_stats() == {"chunks_summarized": 4, "chunks_cached": 0}
+
+
+def test_summarizer_reuses_cached_chunks(tmp_path):
+    sections = [("Section %d" % i, "".join(["section %d line %d\n" % (i, j) for j in range(4)])) for i in range(3)]
+    first = make_summarizer(SnippetModel(), cache=SummaryCache(cache_dir=str(tmp_path)), chunk_tokens=10)
+    summary = first.summarize_sections(sections)
+
+    # A new Summarizer with a new in-memory cache finds every summary on disk
+    model = SnippetModel()
+    second = make_summarizer(model, cache=SummaryCache(cache_dir=str(tmp_path)), chunk_tokens=10)
+    assert second.summarize_sections(sections) == summary
+    assert model.batches == []
+    # Every section's reduce had the same input, so the first run only summarized it once
+    assert first.get_stats() == {"chunks_summarized": 6 + 1, "chunks_cached": 0}
+    assert second.get_stats() == {"chunks_summarized": 0, "chunks_cached": 6 + 3}
+
+    # The same content twice is only summarized once
+    model = SnippetModel()
+    third = make_summarizer(model, chunk_tokens=100)
+    third.summarize_sections([("A", "same text\n"), ("B", "same text\n")])
+    assert third.get_stats()["chunks_summarized"] == 1 and len(model.batches[0]) == 1
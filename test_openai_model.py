@@ -0,0 +1,51 @@
+import time
+
+import pytest
+
+from openai_model import OpenAIModel
+from stub_servers import CompletionServer
+
+
+@pytest.fixture
+def completion_server():
+    server = CompletionServer(answer_words=20)
+    yield server
+    server.close()
+
+
+def test_openai_model_prompts_streams_and_reuses_connections(completion_server):
+    model = OpenAIModel(base_url=completion_server.url)
+    messages = [{"role": "user", "content": "hi"}]
+    try:
+        assert model.prompt(messages).startswith("word0 word1")
+        assert model.prompt([messages] * 3) == [model.prompt(messages)] * 3
+        for _ in range(3):
+            assert "".join(model.stream(messages)) == " ".join(["word%d" % i for i in range(20)])
+        stats = completion_server.get_stats()
+        assert stats["requests"] == 8 and stats["connections"] <= 3
+    finally:
+        model.close()
+
+
+def test_openai_model_cancels_and_retries(completion_server):
+    model = OpenAIModel(base_url=completion_server.url, backoff=0.01, retries=2)
+    messages = [{"role": "user", "content": "hi"}]
+    try:
+        completion_server.token_latency = 0.01
+        stream = model.stream(messages)
+        next(stream)
+        stream.close()
+        deadline = time.time() + 2
+        while completion_server.get_stats()["cancelled"] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        assert completion_server.get_stats()["cancelled"] == 1
+        completion_server.token_latency = 0.0
+
+        completion_server.fail_next = 2
+        assert model.prompt(messages).startswith("word0")
+        completion_server.fail_next = 10
+        with pytest.raises(RuntimeError, match="503"):
+            model.prompt(messages)
+    finally:
+        completion_server.fail_next = 0
+        model.close()
@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from base_classes import ToolUseStatus
+import python_runner
+from python_runner import PythonTool, PythonWorkerPool
+
+
+@pytest.fixture
+def python_pool():
+    pool = PythonWorkerPool(n_workers=1)
+    yield pool
+    pool.close()
+
+
+def test_python_writes_to_fd_1_keep_the_protocol(python_pool):
+    tool = PythonTool(pool=python_pool)
+    tool.run(["x = 6"])
+    tool.run(["__import__('os').system('echo hi')"])
+    tool.run(["__import__('sys').__stdout__.write('{}\\n')"])
+    assert tool.run(["x * 7"]) == (ToolUseStatus.SUCCEEDED, "The results of the line of Python is '42'")
+
+
+def test_python_worker_restarts_after_a_timeout_or_crash(python_pool):
+    tool = PythonTool(pool=python_pool, timeout=0.5)
+    tool.run(["x = 1"])
+    status, text = tool.run(["[0 for _ in iter(int, 1)]"])
+    assert status == ToolUseStatus.FAILED_REPROMPT and "longer than 0.5 seconds" in text
+    assert "not defined" in tool.run(["x"])[1] # The restart reset the namespace
+
+    status, text = tool.run(["__import__('os')._exit(1)"])
+    assert status == ToolUseStatus.FAILED_REPROMPT and "reset" in text
+    assert tool.run(["1 + 1"])[1] == "The results of the line of Python is '2'"
+
+
+def test_python_sessions_are_separate_and_dropped(python_pool):
+    a, b = PythonTool(pool=python_pool), PythonTool(pool=python_pool)
+    a.run(["x = 'a'"])
+    b.run(["x = 'b'"])
+    assert a.run(["x"])[1].endswith("'a'") and b.run(["x"])[1].endswith("'b'")
+    a.close()
+    assert b.run(["x"])[1].endswith("'b'")
+
+
+def test_python_runs_under_finite_hard_limits():
+    # Lowering a hard limit can't be undone, so it's done in a process of its own
+    script = (
+        "import resource\n"
+        "resource.setrlimit(resource.RLIMIT_CPU, (3600, 3600))\n"
+        "resource.setrlimit(resource.RLIMIT_AS, (64 * 1024 ** 3, 64 * 1024 ** 3))\n"
+        "from python_runner import PythonTool, PythonWorkerPool\n"
+        "pool = PythonWorkerPool(n_workers=1)\n"
+        "print(PythonTool(pool=pool).run(['6 * 7'])[1])\n"
+        "pool.close()\n"
+    )
+    result = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(python_runner.__file__)), capture_output=True, text=True, timeout=60)
+    assert result.stdout.strip() == "The results of the line of Python is '42'", result.stderr
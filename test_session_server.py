@@ -0,0 +1,138 @@
+import asyncio
+import threading
+
+from base_classes import FunctionTool, Model, ScriptedModel
+from session_server import BatchScheduler, ScheduledModel, SessionServer
+
+
+class ReplyModel(Model):
+    """Answers each conversation with reply(its last message), and records the size of every batch"""
+    def __init__(self, reply=lambda content: "Re: %s" % content, error: Exception = None):
+        self.reply = reply
+        self.error = error
+        self.batches = []
+
+    def prompt(self, messages):
+        if type(messages[0]) == dict:
+            return self.prompt([messages])[0]
+        self.batches.append(len(messages))
+        if self.error:
+            raise self.error
+        return [self.reply(m[-1]["content"]) for m in messages]
+
+
+def conversation(content: str):
+    return [{"role": "user", "content": content}]
+
+
+async def run_scheduler(scheduler: BatchScheduler, fn):
+    await scheduler.start()
+    try:
+        return await fn()
+    finally:
+        await scheduler.stop()
+
+
+def test_batches_are_cut_at_max_batch_size():
+    model = ReplyModel()
+    scheduler = BatchScheduler(model, max_batch_size=4, max_wait=0.05)
+
+    async def prompts():
+        return await asyncio.gather(*[scheduler.prompt(conversation("%d" % i)) for i in range(10)])
+
+    assert asyncio.run(run_scheduler(scheduler, prompts)) == ["Re: %d" % i for i in range(10)]
+    assert model.batches == [4, 4, 2]
+    assert (scheduler.num_batches, scheduler.num_prompts) == (3, 10)
+
+
+def test_a_batch_waits_at_most_max_wait():
+    model = ReplyModel()
+    scheduler = BatchScheduler(model, max_batch_size=64, max_wait=0.02)
+
+    async def prompts():
+        first = asyncio.create_task(scheduler.prompt(conversation("a")))
+        await asyncio.sleep(0.005)
+        second = asyncio.create_task(scheduler.prompt(conversation("b"))) # Joins the first's batch
+        await asyncio.sleep(0.1)
+        third = await scheduler.prompt(conversation("c")) # Comes after max_wait, so gets its own
+        return [await first, await second, third]
+
+    assert asyncio.run(run_scheduler(scheduler, prompts)) == ["Re: a", "Re: b", "Re: c"]
+    assert model.batches == [2, 1]
+
+
+def test_a_failed_batch_fails_every_prompt_in_it():
+    model = ReplyModel(error=RuntimeError("out of memory"))
+    scheduler = BatchScheduler(model, max_wait=0.02)
+
+    async def prompts():
+        results = await asyncio.gather(*[scheduler.prompt(conversation("%d" % i)) for i in range(3)], return_exceptions=True)
+        # The scheduler keeps going after a failed batch
+        model.error = None
+        return results, await scheduler.prompt(conversation("again"))
+
+    results, again = asyncio.run(run_scheduler(scheduler, prompts))
+    assert [str(r) for r in results] == ["out of memory"] * 3 and all([type(r) == RuntimeError for r in results])
+    assert again == "Re: again"
+    assert model.batches == [3, 1]
+
+
+def test_sync_prompt_from_other_threads():
+    model = ReplyModel()
+    scheduler = BatchScheduler(model, max_wait=0.05)
+    results = {}
+
+    def summarize(i):
+        results[i] = ScheduledModel(scheduler).prompt([conversation("%d-a" % i), conversation("%d-b" % i)])
+
+    async def prompts():
+        threads = [threading.Thread(target=summarize, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        # The threads block on their replies, so they have to wait off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, lambda: [thread.join(5) for thread in threads])
+
+    asyncio.run(run_scheduler(scheduler, prompts))
+    assert results == {i: ["Re: %d-a" % i, "Re: %d-b" % i] for i in range(4)}
+    assert sum(model.batches) == 8 and len(model.batches) < 8
+
+
+def test_tools_prompt_the_model_through_the_scheduler():
+    def reply(content):
+        if content == "Look it up":
+            return "%LOOKUP RUN it"
+        elif content.startswith("Text:"):
+            return "a summary"
+        return "Done"
+
+    model = ReplyModel(reply)
+
+    async def session():
+        async with SessionServer(model, lambda: [], max_wait=0.01) as server:
+            # The tool runs in a tool thread and summarizes with the same model the session is using
+            lookup = FunctionTool("LOOKUP", "Looks things up")
+            summary_model = ScheduledModel(server.scheduler)
+            lookup.command("RUN", "Look something up", ("Name",))(lambda args: "Found %s" % summary_model.prompt(conversation("Text: %s" % args[0])))
+            return await server.run_session(ScriptedModel(["Look it up"]), max_rounds=1, tools=[lookup])
+
+    view = asyncio.run(session())
+    assert [m["content"] for m in view[1:]] == [
+        "Look it up",
+        "%LOOKUP RUN it",
+        "Found a summary.  Now, please inform the user of the command you just ran or run another command if you haven't completed their query.",
+        "Done",
+    ]
+    assert model.batches == [1, 1, 1]
+
+
+def test_sessions_share_batches():
+    model = ReplyModel()
+
+    async def sessions():
+        async with SessionServer(model, lambda: [], max_wait=0.05) as server:
+            users = [ScriptedModel(["Hello %d" % i, "Bye %d" % i]) for i in range(8)]
+            return await server.run_sessions(users, max_rounds=2)
+
+    views = asyncio.run(sessions())
+    assert [view[-1]["content"] for view in views] == ["Re: Bye %d" % i for i in range(8)]
+    assert model.batches == [8, 8]
@@ -0,0 +1,23 @@
+import bz2
+
+from wiki_dump import WikipediaDump
+
+
+def test_wiki_dump_ignores_contributor_ids(tmp_path):
+    xml = (
+        "<mediawiki>\n"
+        "  <page>\n    <title>First</title>\n    <ns>0</ns>\n    <id>5</id>\n"
+        "    <revision><id>900</id><contributor><id>7</id></contributor><text>wrong page</text></revision>\n  </page>\n"
+        "  <page>\n    <title>Second</title>\n    <ns>0</ns>\n    <id>7</id>\n"
+        "    <revision><id>901</id><text>right page</text></revision>\n  </page>\n"
+        "</mediawiki>"
+    )
+    path = str(tmp_path / "dump.xml.bz2")
+    with open(path, "wb") as f:
+        f.write(bz2.compress(xml.encode("utf-8")))
+
+    dump = WikipediaDump(path)
+    try:
+        assert "right page" in dump.read_page(*dump.find("Second"))
+    finally:
+        dump.close()
@@ -0,0 +1,207 @@
+from typing import List
+import contextvars
+import cProfile
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
+
+current_span = contextvars.ContextVar("current_span", default=None)
+span_ids = itertools.count(1)
+
+
+class Span:
+    """One timed stage (a turn, a model call, a tool command, a fetch...), nested under whatever span was open when it started
+
+    Use it as a context manager.  Counters like token counts, bytes fetched and cache hits go in its attributes.
+    """
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_id", "start", "wall", "attrs", "profile", "profiler", "token")
+
+    def __init__(self, tracer, name: str, profile: bool, attrs: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.profile = profile
+        self.profiler = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, key: str, n: int = 1):
+        self.attrs[key] = self.attrs.get(key, 0) + n
+
+    def __enter__(self,):
+        parent = current_span.get()
+        self.span_id = next(span_ids)
+        self.parent_id = parent.span_id if parent else None
+        self.trace_id = parent.trace_id if parent else self.span_id
+        self.token = current_span.set(self)
+        if self.profile:
+            self.profiler = self.tracer.start_profile()
+        self.start = time.time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.wall = time.perf_counter() - self.wall
+        if self.profiler:
+            self.profiler.disable()
+        current_span.reset(self.token)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.tracer.record(self)
+        return False
+
+
+class NullSpan:
+    """What spans are when tracing is off, so instrumented code costs next to nothing"""
+    span_id = None
+    trace_id = None
+
+    def set(self, **attrs):
+        pass
+
+    def add(self, key: str, n: int = 1):
+        pass
+
+    def __enter__(self,):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    """Writes finished spans as JSON lines to path, rotating it to path.1, path.2... once it is over max_bytes
+
+    With profile_turns set, profile_rate of the spans opened with profile=True (the turns of main_loop) run under
+    cProfile, and the profiles of the slowest profile_turns of them are kept next to the trace as .prof files.
+    A tracer without a path records nothing.
+    """
+    def __init__(self, path: str = None, max_bytes: int = 64 * 1024 * 1024, backups: int = 3, profile_turns: int = 0, profile_rate: float = 0.1):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.profile_turns = profile_turns
+        self.profile_rate = profile_rate
+
+        self.lock = threading.Lock()
+        self.file = None
+        self.profiling = False # Only one profiler can run at a time
+        self.profiles = [] # (wall time, path) of the kept profiles
+
+    def span(self, name: str, profile: bool = False, **attrs):
+        if self.path is None:
+            return NULL_SPAN
+        return Span(self, name, profile, attrs)
+
+    def record(self, span: Span):
+        line = json.dumps({
+            "name": span.name,
+            "trace": span.trace_id,
+            "span": span.span_id,
+            "parent": span.parent_id,
+            "pid": os.getpid(),
+            "start": span.start,
+            "wall_ms": 1000 * span.wall,
+            "attrs": span.attrs,
+        }, default=str) + "\n"
+
+        with self.lock:
+            if self.file is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self.file = open(self.path, "a")
+            self.file.write(line)
+            if self.file.tell() > self.max_bytes:
+                self.rotate()
+
+        if span.profiler:
+            self.keep_profile(span)
+
+    def rotate(self,):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("%s.%d" % (self.path, i)):
+                os.replace("%s.%d" % (self.path, i), "%s.%d" % (self.path, i + 1))
+        if self.backups > 0:
+            os.replace(self.path, "%s.1" % self.path)
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, "a")
+
+    def start_profile(self,) -> cProfile.Profile:
+        if self.profile_turns <= 0 or random.random() >= self.profile_rate:
+            return None
+        with self.lock:
+            if self.profiling:
+                return None
+            self.profiling = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def keep_profile(self, span: Span):
+        with self.lock:
+            self.profiling = False
+            if len(self.profiles) >= self.profile_turns and span.wall <= self.profiles[0][0]:
+                return
+
+            path = "%s.%s-%d-%d.prof" % (self.path, span.name, os.getpid(), span.span_id)
+            span.profiler.dump_stats(path)
+            self.profiles.append((span.wall, path))
+            self.profiles.sort()
+            while len(self.profiles) > self.profile_turns:
+                _, old = self.profiles.pop(0)
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+
+    def get_profiles(self,) -> List[str]:
+        """Paths of the kept profiles, slowest first"""
+        return [path for _, path in reversed(self.profiles)]
+
+    def flush(self,):
+        with self.lock:
+            if self.file:
+                self.file.flush()
+
+    def close(self,):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+
+shared_tracer = None
+
+
+def get_tracer() -> Tracer:
+    global shared_tracer
+    if shared_tracer is None:
+        shared_tracer = Tracer()
+    return shared_tracer
+
+
+def set_tracer(tracer: Tracer):
+    global shared_tracer
+    shared_tracer = tracer
+
+
+def span(name: str, profile: bool = False, **attrs):
+    return get_tracer().span(name, profile=profile, **attrs)
+
+
+def get_current_span():
+    # The innermost open span, to add counters to from code that didn't open it
+    return current_span.get() or NULL_SPAN
+
+
+def default_trace_path() -> str:
+    return os.path.join(os.path.expanduser("~"), ".cache", "language_model_tooling", "traces", "trace.jsonl")
@@ -0,0 +1,248 @@
+from collections import OrderedDict
+from typing import List
+import bz2
+import html
+import mmap
+import os
+import re
+import struct
+import threading
+
+
+MAGIC = b"WIKIIDX1"
+HEADER = struct.Struct("<8sQ")
+RECORD = struct.Struct("<QIQQ") # Title offset in the heap, title length, bz2 block offset, page id
+
+
+def normalize_title(title: str) -> str:
+    # The same rules MediaWiki uses for page titles: underscores are spaces and the first letter is capitalized
+    title = " ".join(title.replace("_", " ").split())
+    return title[:1].upper() + title[1:]
+
+
+def title_key(title: str) -> bytes:
+    # The index is sorted case-insensitively so a lookup with the wrong capitalization still finds the page
+    return normalize_title(title).casefold().encode("utf-8")
+
+
+def strip_wikitext(text: str) -> str:
+    text = re.sub(r"<!--.*?-->", "", text, flags=re.S)
+    text = re.sub(r"<ref[^>]*/>", "", text)
+    text = re.sub(r"<ref[^>]*>.*?</ref>", "", text, flags=re.S)
+
+    # Templates and tables nest, so remove the innermost ones until there are none left
+    for pattern in [r"\{\{[^{}]*\}\}", r"\{\|[^{}]*?\|\}"]:
+        n = 1
+        while n > 0:
+            text, n = re.subn(pattern, "", text, flags=re.S)
+
+    text = re.sub(r"\[\[(?:File|Image|Category):(?:[^\[\]]|\[\[[^\]]*\]\])*\]\]", "", text, flags=re.I)
+    text = re.sub(r"\[\[(?:[^|\]]*\|)?([^\]]*)\]\]", r"\1", text)
+    text = re.sub(r"\[https?://[^\s\]]+\s*([^\]]*)\]", r"\1", text)
+    text = re.sub(r"'{2,}", "", text)
+    text = re.sub(r"<[^>]+>", "", text)
+    return html.unescape(text)
+
+
+def wikitext_sections(text: str) -> List[tuple[str, str]]:
+    """(header, section text) pairs from the level 2 headers and paragraphs of a page, like extract_sections gives for the HTML"""
+    sections = [(None, [])]
+    for line in strip_wikitext(text).split("\n"):
+        header = re.match(r"^==\s*([^=].*?)\s*==\s*$", line)
+        if header:
+            sections.append((header.group(1), []))
+        elif len(line.strip()) > 0 and not line.startswith(("=", "*", "#", ":", ";", "|", "!")):
+            sections[-1][1].append(line.strip() + "\n")
+    return [(header, "".join(section)) for header, section in sections]
+
+
+def build_index(dump_path: str, index_path: str, dump_index_path: str = None):
+    """Write the sorted title index for a multistream dump
+
+    Reads the offset:page id:title lines of the dump's own index file if there is one, otherwise finds the bz2
+    streams by scanning the dump.
+    """
+    entries = []
+    if dump_index_path:
+        opener = bz2.open if dump_index_path.endswith(".bz2") else open
+        with opener(dump_index_path, "rt", encoding="utf-8") as f:
+            for line in f:
+                offset, page_id, title = line.rstrip("\n").split(":", 2)
+                entries.append((title_key(title), title.encode("utf-8"), int(offset), int(page_id)))
+    else:
+        for offset, data in iter_streams(dump_path):
+            for page in re.finditer(r"<page>\s*<title>(.*?)</title>.*?<id>(\d+)</id>", data, flags=re.S):
+                title = html.unescape(page.group(1))
+                entries.append((title_key(title), title.encode("utf-8"), offset, int(page.group(2))))
+
+    entries.sort()
+
+    with open(index_path + ".tmp", "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(entries)))
+        heap_offset = 0
+        for _, title, offset, page_id in entries:
+            f.write(RECORD.pack(heap_offset, len(title), offset, page_id))
+            heap_offset += len(title)
+        for _, title, _, _ in entries:
+            f.write(title)
+    os.replace(index_path + ".tmp", index_path)
+
+
+def iter_streams(dump_path: str, chunk_size: int = 1024 * 1024):
+    # Yields (offset, decompressed text) for each bz2 stream in the file
+    with open(dump_path, "rb") as f:
+        offset = 0
+        data = f.read(chunk_size)
+        while len(data) > 0:
+            decompressor = bz2.BZ2Decompressor()
+            out = []
+            length = 0
+            while True:
+                out.append(decompressor.decompress(data))
+                if decompressor.eof:
+                    length += len(data) - len(decompressor.unused_data)
+                    data = decompressor.unused_data
+                    break
+                length += len(data)
+                data = f.read(chunk_size)
+                if len(data) == 0:
+                    return
+
+            yield offset, b"".join(out).decode("utf-8", errors="ignore")
+            offset += length
+            if len(data) == 0:
+                data = f.read(chunk_size)
+
+
+class WikipediaDump:
+    """Offline Wikipedia pages from a local multistream .xml.bz2 dump
+
+    Titles are looked up with a binary search of the memory-mapped index (built once with build_index) and only
+    the bz2 stream holding the page is decompressed, stopping as soon as the page has been read.
+    """
+    def __init__(self, dump_path: str, index_path: str = None, dump_index_path: str = None, cache_pages: int = 64):
+        self.dump_path = dump_path
+        self.index_path = index_path or dump_path + ".titles"
+        if not os.path.exists(self.index_path):
+            build_index(dump_path, self.index_path, dump_index_path=dump_index_path)
+
+        with open(self.index_path, "rb") as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.index, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a Wikipedia title index" % self.index_path)
+        self.heap = HEADER.size + self.count * RECORD.size
+
+        self.dump = open(dump_path, "rb")
+        self.pages = OrderedDict() # Page id -> page XML, for pages looked up recently
+        self.cache_pages = cache_pages
+        self.lock = threading.Lock()
+
+    def record(self, i: int) -> (bytes, int, int):
+        heap_offset, length, offset, page_id = RECORD.unpack_from(self.index, HEADER.size + i * RECORD.size)
+        return self.index[self.heap + heap_offset:self.heap + heap_offset + length], offset, page_id
+
+    def find(self, title: str) -> (int, int):
+        """Block offset and page id of a title, preferring an exact match over one that only differs by case"""
+        key = title_key(title)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if title_key(self.record(mid)[0].decode("utf-8")) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        exact = normalize_title(title).encode("utf-8")
+        found = None
+        i = lo
+        while i < self.count:
+            name, offset, page_id = self.record(i)
+            if title_key(name.decode("utf-8")) != key:
+                break
+            if name == exact:
+                return offset, page_id
+            found = found or (offset, page_id)
+            i += 1
+        return found or (None, None)
+
+    def read_page(self, offset: int, page_id: int, chunk_size: int = 65536) -> str:
+        with self.lock:
+            if page_id in self.pages:
+                self.pages.move_to_end(page_id)
+                return self.pages[page_id]
+
+        # Decompress the block until the page's closing tag comes out, pread keeps this safe to call from several threads
+        decompressor = bz2.BZ2Decompressor()
+        data = b""
+        # The page's own id comes straight after its namespace, revisions and contributors have <id>s of their own
+        marker = re.compile(rb"</ns>\s*<id>%d</id>" % page_id)
+        page = None
+        while not decompressor.eof:
+            chunk = os.pread(self.dump.fileno(), chunk_size, offset)
+            if len(chunk) == 0:
+                break
+            offset += len(chunk)
+            data += decompressor.decompress(chunk)
+            match = marker.search(data)
+            at = match.start() if match else -1
+            end = data.find(b"</page>", at) if at != -1 else -1
+            if end != -1:
+                page = data[data.rfind(b"<page>", 0, at):end + len(b"</page>")].decode("utf-8", errors="ignore")
+                break
+
+        if page is None:
+            raise KeyError("page %d is not in the block at %d" % (page_id, offset))
+
+        with self.lock:
+            self.pages[page_id] = page
+            if len(self.pages) > self.cache_pages:
+                self.pages.popitem(last=False)
+        return page
+
+    def get_page(self, title: str, max_redirects: int = 3) -> (str, str):
+        """Title and wikitext of a page, following redirects"""
+        for _ in range(max_redirects + 1):
+            offset, page_id = self.find(title)
+            if offset is None:
+                raise KeyError("There is no Wikipedia page called %s" % normalize_title(title))
+            page = self.read_page(offset, page_id)
+            title = html.unescape(re.search(r"<title>(.*?)</title>", page, flags=re.S).group(1))
+
+            redirect = re.search(r"<redirect\s+title=\"(.*?)\"", page)
+            if redirect is None:
+                text = re.search(r"<text[^>]*>(.*?)</text>", page, flags=re.S)
+                return title, html.unescape(text.group(1)) if text else ""
+            title = html.unescape(redirect.group(1))
+        raise KeyError("Too many redirects looking up %s" % title)
+
+    def get_sections(self, title: str) -> List[tuple[str, str]]:
+        return wikitext_sections(self.get_page(title)[1])
+
+    def close(self,):
+        self.index.close()
+        self.dump.close()
+
+
+def write_multistream(dump_path: str, pages: List[tuple[str, str]], pages_per_stream: int = 100, redirects: dict = {}):
+    """Write a small multistream dump (and its index file) in the same format as the real ones, for testing"""
+    records = [(title, text, None) for title, text in pages] + [(title, "", target) for title, target in redirects.items()]
+    index_lines = []
+    with open(dump_path, "wb") as f:
+        f.write(bz2.compress(b"<mediawiki>\n"))
+        for s in range(0, len(records), pages_per_stream):
+            offset = f.tell()
+            xml = ""
+            for i, (title, text, target) in enumerate(records[s:s + pages_per_stream]):
+                page_id = s + i + 1
+                index_lines.append("%d:%d:%s\n" % (offset, page_id, title))
+                xml += "  <page>\n    <title>%s</title>\n    <ns>0</ns>\n    <id>%d</id>\n%s    <revision>\n      <text xml:space=\"preserve\">%s</text>\n    </revision>\n  </page>\n" % (
+                    html.escape(title, quote=False), page_id,
+                    "    <redirect title=\"%s\" />\n" % html.escape(target) if target else "",
+                    html.escape(text if not target else "#REDIRECT [[%s]]" % target, quote=False),
+                )
+            f.write(bz2.compress(xml.encode("utf-8")))
+        f.write(bz2.compress(b"</mediawiki>\n"))
+
+    with bz2.open(dump_path.replace(".xml.bz2", "") + "-index.txt.bz2", "wt", encoding="utf-8") as f:
+        f.writelines(index_lines)